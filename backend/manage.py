@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Comandos de mantenimiento de datos para Bonchef Mantenimiento
+Usage: python manage.py <comando> [opciones]   (desde el directorio backend, con el mismo .env que server.py)
+"""
+
+import asyncio
+from typing import List, Optional
+
+import typer
+
+import server
+
+app = typer.Typer(help="Comandos de mantenimiento de datos")
+
+def run(coro):
+    """Ejecuta una corrutina y cierra la conexión con Mongo al terminar"""
+    try:
+        return asyncio.run(coro)
+    finally:
+        server.client.close()
+
+@app.command("backfill-dates")
+def backfill_dates(
+    collection: Optional[List[str]] = typer.Option(None, "--collection", "-c", help="Colección a procesar (por defecto todas)"),
+    batch_size: int = typer.Option(1000, help="Documentos por lote"),
+    restart: bool = typer.Option(False, help="Ignorar el progreso guardado y empezar de cero")
+):
+    """Rellena los campos de fecha BSON (<campo>_dt). Reanudable: continúa desde el último lote guardado."""
+    collections = collection or list(server.DATE_SHADOW_FIELDS.keys())
+    unknown = [c for c in collections if c not in server.DATE_SHADOW_FIELDS]
+    if unknown:
+        raise typer.BadParameter(f"Colecciones sin campos de fecha: {', '.join(unknown)}")
+
+    async def _run():
+        if restart:
+            await server.db.migrations.delete_many({"id": {"$in": [f"bson_dates:{c}" for c in collections]}})
+        return await server.backfill_date_fields(collections, batch_size)
+
+    processed = run(_run())
+    for name, count in processed.items():
+        typer.echo(f"{name}: {count} documentos")
+    typer.echo("✅ Fechas BSON al día")
+
+@app.command("rebuild-stop-rollups")
+def rebuild_stop_rollups():
+    """Regenera la colección stop_rollups a partir de todas las paradas"""
+    rows = run(server.rebuild_stop_rollups())
+    typer.echo(f"✅ stop_rollups reconstruida: {rows} filas")
+
+@app.command("migrate-machine-stops")
+def migrate_machine_stops(
+    batch_size: int = typer.Option(1000, help="Paradas por lote"),
+    restart: bool = typer.Option(False, help="Ignorar el progreso guardado y copiar de nuevo toda la colección")
+):
+    """Copia machine_stops al almacén único de paradas (stops). Reanudable y sin duplicar paradas."""
+    async def _run():
+        if restart:
+            await server.db.migrations.delete_many({"id": "stop_store:machine_stops"})
+        return await server.migrate_machine_stops(batch_size)
+
+    copied = run(_run())
+    typer.echo(f"✅ {copied} paradas copiadas a stops")
+
+@app.command("scan-stop-overlaps")
+def scan_stop_overlaps():
+    """Busca paradas solapadas de una misma máquina en todo el histórico (una sola pasada)"""
+    overlaps = run(server.scan_stop_overlaps())
+    for o in overlaps:
+        stop, other = o["stop"], o["overlaps_with"]
+        typer.echo(f"{o['machine_id']}: {stop['id']} ({stop['start_time']} - {stop['end_time']}) se solapa con {other['id']} ({other['start_time']} - {other['end_time']})")
+    if overlaps:
+        typer.echo(f"❌ {len(overlaps)} paradas solapadas")
+        raise typer.Exit(code=1)
+    typer.echo("✅ Sin paradas solapadas")
+
+@app.command("rebuild-start-rollups")
+def rebuild_start_rollups():
+    """Regenera machine_start_rollups y line_start_rollups a partir de todos los arranques"""
+    rows = run(server.rebuild_start_rollups())
+    for name, count in rows.items():
+        typer.echo(f"✅ {name} reconstruida: {count} filas")
+
+@app.command("recompute-start-delays")
+def recompute_start_delays(
+    batch_size: int = typer.Option(server.START_RECOMPUTE_BATCH_SIZE, help="Arranques por lote")
+):
+    """Recalcula on_time/delay_minutes de todos los arranques (machine_starts y line_starts), sus rollups y
+    los precálculos de analytics/line-starts.
+
+    La caché en memoria del servidor en marcha no se ve desde este proceso: las respuestas ya cacheadas
+    caducan solas (CACHE_TTL_COMPLIANCE / CACHE_TTL_ANALYTICS segundos).
+    """
+    async def _run():
+        changed = {
+            "machine_starts": await server.recompute_machine_start_delays({}, batch_size=batch_size),
+            "line_starts": await server.recompute_line_start_delays(batch_size)
+        }
+        snapshots = 0
+        if changed["line_starts"]:
+            snapshots = await server.precompute_analytics_snapshots(endpoints=["analytics/line-starts"])
+        return changed, snapshots
+
+    changed, snapshots = run(_run())
+    for name, count in changed.items():
+        typer.echo(f"{name}: {count} arranques recalculados")
+    if snapshots:
+        typer.echo(f"analytics_snapshots: {snapshots} payloads de analytics/line-starts recalculados")
+    typer.echo("✅ Retrasos de arranque al día")
+
+@app.command("precompute-analytics")
+def precompute_analytics(
+    months: int = typer.Option(server.ANALYTICS_SNAPSHOT_MONTHS, help="Meses hacia atrás que se precalculan")
+):
+    """Precalcula las analíticas diarias en analytics_snapshots (para cron, con ANALYTICS_SNAPSHOT_HOUR=off)"""
+    stored = run(server.precompute_analytics_snapshots(months))
+    typer.echo(f"✅ analytics_snapshots actualizada: {stored} payloads")
+
+@app.command("generate-start-sheet")
+def generate_start_sheet(
+    date: Optional[str] = typer.Option(None, help="Fecha YYYY-MM-DD (por defecto mañana, UTC)")
+):
+    """Crea los arranques pendientes de las líneas activas para un día (para cron, con START_SHEET_HOUR=off)"""
+    created = run(server.generate_start_sheet(date))
+    typer.echo(f"✅ {created} arranques pendientes creados")
+
+@app.command("export-snapshot")
+def export_snapshot(
+    collection: Optional[List[str]] = typer.Option(None, "--collection", "-c", help="Colección a exportar (por defecto todas)"),
+    format: str = typer.Option("parquet", "--format", "-f", help="parquet o feather"),
+    full: bool = typer.Option(False, help="Exportar todo y sustituir los ficheros anteriores"),
+    batch_size: int = typer.Option(server.SNAPSHOT_BATCH_SIZE, help="Documentos por fichero")
+):
+    """Exporta las colecciones de mantenimiento a ficheros columnares, de forma incremental desde la última exportación"""
+    unknown = [c for c in collection or [] if c not in server.SNAPSHOT_COLLECTIONS]
+    if unknown:
+        raise typer.BadParameter(f"Colecciones no exportables: {', '.join(unknown)}")
+    if format not in server.SNAPSHOT_FORMATS:
+        raise typer.BadParameter(f"Formato no soportado: {format}")
+    result = run(server.export_snapshots(collection or None, format, full, batch_size))
+    for name, exported in result["collections"].items():
+        typer.echo(f"{name}: {exported['docs']} documentos en {len(exported['files'])} ficheros")
+    typer.echo(f"✅ Snapshot {result['run_id']} en {result['directory']}")
+
+if __name__ == "__main__":
+    app()
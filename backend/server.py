@@ -1,15 +1,35 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReplaceOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import ObjectId
+import io
 import os
+import re
+import copy
+import json
+import time
+import unicodedata
+import bisect
+import hashlib
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional
 import uuid
+from contextlib import asynccontextmanager, AsyncExitStack
 from datetime import datetime, timezone, timedelta
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 import jwt
 import bcrypt
 import base64
@@ -27,6 +47,35 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'bonchef-mantenimiento-secret-key-2024
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
+# Intervalo de la reconciliación de contadores del dashboard (minutos)
+DASHBOARD_RECONCILE_MINUTES = int(os.environ.get('DASHBOARD_RECONCILE_MINUTES', '15'))
+
+def utc_hour_setting(name: str, default: str) -> Optional[int]:
+    """Lee una hora UTC (0-23) del entorno; "off" devuelve None. Falla al arrancar si no es válida"""
+    value = os.environ.get(name, default).strip().lower()
+    if value == "off":
+        return None
+    if not value.isdigit() or not 0 <= int(value) <= 23:
+        raise ValueError(f"{name} debe ser una hora UTC entre 0 y 23 u 'off' (recibido: {value!r})")
+    return int(value)
+
+# Precálculo nocturno de analíticas: hora UTC de la ejecución ("off" para lanzarlo desde cron con manage.py)
+# y número de meses hacia atrás que se precalculan
+ANALYTICS_SNAPSHOT_HOUR = utc_hour_setting('ANALYTICS_SNAPSHOT_HOUR', '3')
+ANALYTICS_SNAPSHOT_MONTHS = int(os.environ.get('ANALYTICS_SNAPSHOT_MONTHS', '12'))
+
+# Hora UTC a la que se genera la hoja de arranques pendientes del día siguiente ("off" para lanzarla desde cron con manage.py)
+START_SHEET_HOUR = utc_hour_setting('START_SHEET_HOUR', '20')
+
+# Resincronización del registro en memoria de paradas abiertas con Mongo (segundos)
+OPEN_STOPS_RELOAD_SECONDS = int(os.environ.get('OPEN_STOPS_RELOAD_SECONDS', '60'))
+
+# Directorio de las exportaciones columnares (Parquet/Feather) para los notebooks de fiabilidad
+SNAPSHOT_DIR = Path(os.environ.get('SNAPSHOT_DIR', str(ROOT_DIR / 'snapshots')))
+
+# Origen de los eventos en vivo: "writes" (endpoints de escritura) o "change_stream" (replica set)
+EVENTS_SOURCE = os.environ.get('EVENTS_SOURCE', 'writes')
+
 # Create the main app
 app = FastAPI(title="Bonchef Mantenimiento API")
 api_router = APIRouter(prefix="/api")
@@ -159,6 +208,16 @@ class MachineStartResponse(BaseModel):
     created_by_name: Optional[str] = ""
     created_at: str
 
+class MachineStartBulkItem(BaseModel):
+    production_line_id: str
+    actual_time: Optional[str] = None  # Hora real de arranque (HH:MM)
+    delay_reason: Optional[str] = None
+    target_time: Optional[str] = None  # Por defecto la del arranque pendiente o la de la línea
+
+class MachineStartBulkCreate(BaseModel):
+    date: str  # Fecha de la hoja de arranques
+    starts: List[MachineStartBulkItem]
+
 # ============== SPARE PARTS (ALMACÉN) ==============
 
 class SparePartCreate(BaseModel):
@@ -347,6 +406,19 @@ class StopUpdate(BaseModel):
     end_time: Optional[str] = None
     notes: Optional[str] = None
 
+class OpenStopResponse(BaseModel):
+    id: str
+    machine_id: str
+    machine_name: str = ""
+    department_id: Optional[str] = None
+    department_name: str = ""
+    stop_type: str
+    reason: str
+    start_time: str
+    source: str
+    created_by: Optional[str] = None
+    duration_minutes: int  # Minutos transcurridos en el momento de la respuesta
+
 class StopResponse(BaseModel):
     id: str
     machine_id: str
@@ -419,9 +491,8 @@ def create_token(user_id: str, email: str, role: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_user_from_token(token: str):
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
         if not user:
@@ -432,6 +503,9 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Token inválido")
 
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await get_user_from_token(credentials.credentials)
+
 def require_role(allowed_roles: List[str]):
     async def role_checker(user: dict = Depends(get_current_user)):
         if user["role"] not in allowed_roles:
@@ -439,6 +513,229 @@ def require_role(allowed_roles: List[str]):
         return user
     return role_checker
 
+# ============== LIVE EVENTS ==============
+
+class EventBroker:
+    """Reparte eventos de cambios a los clientes conectados (SSE/WebSocket) de este proceso"""
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self.subscribers = {}  # queue -> filtros
+
+    def subscribe(self, department_id: Optional[str] = None, assigned_to: Optional[str] = None) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers[queue] = {"department_id": department_id, "assigned_to": assigned_to}
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.pop(queue, None)
+
+    def publish(self, event: dict):
+        for queue, filters in list(self.subscribers.items()):
+            # Los avisos de recarga no traen departamento ni asignado: llegan a todos los clientes
+            if not event.get("refetch"):
+                if filters["department_id"] and event.get("department_id") != filters["department_id"]:
+                    continue
+                if filters["assigned_to"] and event.get("assigned_to") != filters["assigned_to"]:
+                    continue
+            if queue.full():
+                # Cliente lento: se descarta el evento más antiguo
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+event_broker = EventBroker()
+
+def build_event(entity: str, action: str, doc: dict, department_id: Optional[str] = None) -> dict:
+    return {
+        "entity": entity,  # work_order, stop, machine_stop, machine_start, line_start
+        "action": action,  # created, updated, deleted
+        "id": doc.get("id"),
+        "department_id": department_id or doc.get("department_id"),
+        "machine_id": doc.get("machine_id"),
+        "assigned_to": doc.get("assigned_to"),
+        "status": doc.get("status"),
+        "type": doc.get("type") or doc.get("stop_type"),
+        "refetch": False,  # True: no se sabe qué documento cambió (id None), el cliente recarga la entidad
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
+async def get_machine_department_id(machine_id: Optional[str]) -> Optional[str]:
+    if not machine_id:
+        return None
+    machine = await db.machines.find_one({"id": machine_id}, {"_id": 0, "department_id": 1})
+    return machine.get("department_id") if machine else None
+
+async def get_event_department_id(doc: dict) -> Optional[str]:
+    """Departamento de un documento: el suyo, el de su máquina o, en los arranques de línea, el de la línea"""
+    if doc.get("department_id"):
+        return doc["department_id"]
+    if doc.get("machine_id"):
+        return await get_machine_department_id(doc["machine_id"])
+    if doc.get("line_id"):
+        line = await db.lines.find_one({"id": doc["line_id"]}, {"_id": 0, "department_id": 1})
+        return line.get("department_id") if line else None
+    return None
+
+async def publish_event(entity: str, action: str, doc: dict, department_id: Optional[str] = None):
+    """Publica un evento desde los endpoints de escritura (si no se usa change stream)"""
+    if EVENTS_SOURCE != "writes":
+        return
+    if not department_id:
+        department_id = await get_event_department_id(doc)
+    event_broker.publish(build_event(entity, action, doc, department_id))
+
+# ============== RESPONSE CACHE ==============
+
+class ResponseCache:
+    """Caché en memoria de respuestas calculadas (dashboard, analíticas).
+
+    - Cada entrada caduca a los `ttl` segundos.
+    - Las peticiones concurrentes con la misma clave esperan a un único cálculo (singleflight).
+    - Cada colección tiene una versión de escritura; una entrada calculada con versiones
+      anteriores deja de ser válida en cuanto alguna de sus colecciones cambia.
+    - Como mucho `max_entries` entradas: al llenarse se descartan las caducadas y, si no basta,
+      las que caducan antes.
+    - Cada llamada recibe su propia copia del valor: los handlers pueden modificarla sin tocar la caché.
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self.entries = {}   # key -> (expires_at, versions, value)
+        self.inflight = {}  # (key, versions) -> task
+        self.versions = {}  # collection -> versión
+
+    def bump(self, *collections: str):
+        for collection in collections:
+            self.versions[collection] = self.versions.get(collection, 0) + 1
+
+    def snapshot(self, collections: List[str]) -> tuple:
+        return tuple(self.versions.get(c, 0) for c in collections)
+
+    async def get_or_compute(self, endpoint: str, params: dict, ttl: float, collections: List[str], compute):
+        key = (endpoint, tuple(sorted((k, str(v)) for k, v in params.items() if v is not None)))
+        versions = self.snapshot(collections)
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic() and entry[1] == versions:
+            return copy.deepcopy(entry[2])
+
+        flight_key = (key, versions)
+        task = self.inflight.get(flight_key)
+        if task is None:
+            # El cálculo corre en su propia tarea: si el cliente que lo lanzó se desconecta,
+            # el resto de peticiones en espera siguen recibiendo el resultado
+            task = asyncio.ensure_future(compute())
+            self.inflight[flight_key] = task
+            task.add_done_callback(lambda t: self._store(key, flight_key, versions, collections, ttl, t))
+        return copy.deepcopy(await asyncio.shield(task))
+
+    def _store(self, key, flight_key, versions, collections, ttl, task):
+        self.inflight.pop(flight_key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        if self.snapshot(collections) != versions:
+            return  # hubo escrituras durante el cálculo
+        self.entries.pop(key, None)
+        if len(self.entries) >= self.max_entries:
+            now = time.monotonic()
+            self.entries = {k: v for k, v in self.entries.items() if v[0] > now}
+        if len(self.entries) >= self.max_entries:
+            # Siguen llenas de entradas vigentes: fuera las que caducan antes hasta dejar sitio a la nueva
+            keep = sorted(self.entries.items(), key=lambda item: item[1][0])[len(self.entries) - self.max_entries + 1:]
+            self.entries = dict(keep)
+        self.entries[key] = (time.monotonic() + ttl, versions, task.result())
+
+response_cache = ResponseCache()
+
+# TTL por endpoint (segundos)
+CACHE_TTL_DASHBOARD = 10
+CACHE_TTL_ANALYTICS = 300
+CACHE_TTL_COMPLIANCE = 60
+
+def invalidate_cache(*collections: str):
+    """Marca colecciones como modificadas para invalidar las respuestas cacheadas que dependen de ellas"""
+    response_cache.bump(*collections)
+
+# ============== BSON DATE FIELDS ==============
+# Las fechas se guardan como texto ISO en formatos mezclados ('Z', sin zona, solo fecha).
+# Cada campo de fecha tiene una copia <campo>_dt como datetime BSON (UTC) para consultar y agregar en Mongo.
+
+DATE_SHADOW_FIELDS = {
+    "work_orders": ["created_at", "scheduled_date", "completed_date", "closed_date", "postponed_date"],
+    "stops": ["start_time", "end_time", "created_at"],
+    "machine_starts": ["created_at"],
+    "line_starts": ["created_at"],
+    "spare_part_requests": ["requested_at", "resolved_at"],
+    "work_order_history": ["timestamp"]
+}
+
+def parse_iso_datetime(value) -> Optional[datetime]:
+    """Convierte un texto ISO (con 'Z', con offset, sin zona o solo fecha) a datetime UTC.
+
+    Los valores sin zona se interpretan como UTC. Devuelve None si no se puede interpretar.
+    """
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if not value or not isinstance(value, str):
+        return None
+    text = value.strip()
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    try:
+        dt = datetime.strptime(text, "%Y-%m-%d") if len(text) == 10 else datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+def date_shadow_fields(collection: str, doc: dict) -> dict:
+    """Campos <campo>_dt para los campos de fecha presentes en doc (documento o $set)"""
+    return {f"{field}_dt": parse_iso_datetime(doc[field]) for field in DATE_SHADOW_FIELDS[collection] if field in doc}
+
+# Marca de última modificación (datetime BSON) para las exportaciones incrementales.
+# Se añade a cada update de las colecciones exportadas; las altas se detectan por el _id.
+MODIFIED_AT = {"$currentDate": {"modified_at_dt": True}}
+
+# Campos internos que no se devuelven en las respuestas sin response_model
+INTERNAL_FIELDS_PROJECTION = {
+    "issue_fingerprint": 0,
+    "issue_lsh": 0,
+    "issue_fingerprint_version": 0,
+    "modified_at_dt": 0,
+    **{f"{field}_dt": 0 for fields in DATE_SHADOW_FIELDS.values() for field in fields}
+}
+
+async def backfill_date_fields(collections: Optional[List[str]] = None, batch_size: int = 1000) -> dict:
+    """Rellena los campos <campo>_dt de los documentos existentes, por lotes y reanudable.
+
+    El progreso (último _id procesado) se guarda en la colección migrations, de modo que una
+    ejecución interrumpida continúa donde se quedó.
+    """
+    processed = {}
+    for collection in collections or list(DATE_SHADOW_FIELDS.keys()):
+        fields = DATE_SHADOW_FIELDS[collection]
+        migration_id = f"bson_dates:{collection}"
+        state = await db.migrations.find_one({"id": migration_id}) or {}
+        if state.get("done"):
+            continue
+        last_id = state.get("last_id")
+        processed[collection] = 0
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id else {}
+            docs = await db[collection].find(query, {field: 1 for field in fields}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not docs:
+                await db.migrations.update_one({"id": migration_id}, {"$set": {"done": True, "finished_at": datetime.now(timezone.utc).isoformat()}}, upsert=True)
+                break
+            ops = [UpdateOne({"_id": d["_id"]}, {"$set": date_shadow_fields(collection, d)}) for d in docs if any(f in d for f in fields)]
+            if ops:
+                await db[collection].bulk_write(ops, ordered=False)
+            last_id = docs[-1]["_id"]
+            processed[collection] += len(docs)
+            await db.migrations.update_one({"id": migration_id}, {"$set": {"last_id": last_id, "done": False}}, upsert=True)
+        if processed[collection]:
+            logger.info(f"Fechas BSON: {processed[collection]} documentos procesados en {collection}")
+    return processed
+
 # ============== AUTH ENDPOINTS ==============
 
 @api_router.post("/auth/register", response_model=dict)
@@ -541,6 +838,7 @@ async def create_department(dept: DepartmentCreate, user: dict = Depends(require
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.departments.insert_one(department)
+    invalidate_cache("departments")
     return DepartmentResponse(**department)
 
 @api_router.get("/departments", response_model=List[DepartmentResponse])
@@ -561,6 +859,7 @@ async def update_department(dept_id: str, dept: DepartmentCreate, user: dict = D
         {"id": dept_id},
         {"$set": {"name": dept.name, "description": dept.description or "", "location": dept.location or ""}}
     )
+    invalidate_cache("departments")
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Departamento no encontrado")
     updated = await db.departments.find_one({"id": dept_id}, {"_id": 0})
@@ -574,6 +873,7 @@ async def delete_department(dept_id: str, user: dict = Depends(require_role(["ad
     result = await db.departments.delete_one({"id": dept_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Departamento no encontrado")
+    invalidate_cache("departments")
     return {"message": "Departamento eliminado"}
 
 # ============== PRODUCTION LINES ==============
@@ -592,6 +892,7 @@ async def create_production_line(line: ProductionLineCreate, user: dict = Depend
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.production_lines.insert_one(prod_line)
+    invalidate_cache("production_lines")
     
     dept = await db.departments.find_one({"id": line.department_id}, {"_id": 0})
     prod_line["department_name"] = dept["name"] if dept else ""
@@ -617,6 +918,7 @@ async def get_production_line(line_id: str, user: dict = Depends(get_current_use
 
 @api_router.put("/production-lines/{line_id}", response_model=ProductionLineResponse)
 async def update_production_line(line_id: str, line: ProductionLineCreate, user: dict = Depends(require_role(["admin", "supervisor"]))):
+    previous = await db.production_lines.find_one({"id": line_id}, {"_id": 0, "target_start_time": 1})
     result = await db.production_lines.update_one(
         {"id": line_id},
         {"$set": {
@@ -627,8 +929,12 @@ async def update_production_line(line_id: str, line: ProductionLineCreate, user:
             "target_start_time": line.target_start_time or ""
         }}
     )
+    invalidate_cache("production_lines")
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Línea no encontrada")
+    old_target = (previous or {}).get("target_start_time") or ""
+    if old_target != (line.target_start_time or ""):
+        schedule_start_retarget(line_id, old_target, line.target_start_time or "")
     updated = await db.production_lines.find_one({"id": line_id}, {"_id": 0})
     dept = await db.departments.find_one({"id": updated["department_id"]}, {"_id": 0})
     updated["department_name"] = dept["name"] if dept else ""
@@ -641,6 +947,7 @@ async def toggle_production_line_status(line_id: str, user: dict = Depends(requi
         raise HTTPException(status_code=404, detail="Línea no encontrada")
     new_status = "inactiva" if line["status"] == "activa" else "activa"
     await db.production_lines.update_one({"id": line_id}, {"$set": {"status": new_status}})
+    invalidate_cache("production_lines")
     return {"message": f"Línea {'desactivada' if new_status == 'inactiva' else 'activada'}"}
 
 @api_router.delete("/production-lines/{line_id}")
@@ -652,6 +959,7 @@ async def delete_production_line(line_id: str, user: dict = Depends(require_role
     result = await db.production_lines.delete_one({"id": line_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Línea no encontrada")
+    invalidate_cache("production_lines")
     return {"message": "Línea eliminada"}
 
 # ============== MACHINES ENDPOINTS ==============
@@ -676,6 +984,8 @@ async def create_machine(machine: MachineCreate, user: dict = Depends(require_ro
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.machines.insert_one(machine_doc)
+    invalidate_cache("machines")
+    await apply_counter_delta(machine.department_id, machine_counter_delta(machine_doc))
     return MachineResponse(**machine_doc, department_name=dept["name"])
 
 @api_router.get("/machines", response_model=List[MachineResponse])
@@ -702,7 +1012,10 @@ async def get_machine(machine_id: str, user: dict = Depends(get_current_user)):
 
 @api_router.put("/machines/{machine_id}", response_model=MachineResponse)
 async def update_machine(machine_id: str, machine: MachineCreate, user: dict = Depends(require_role(["admin", "supervisor"]))):
-    result = await db.machines.update_one(
+    existing = await db.machines.find_one({"id": machine_id}, {"_id": 0, "department_id": 1, "status": 1})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Máquina no encontrada")
+    await db.machines.update_one(
         {"id": machine_id},
         {"$set": {
             "name": machine.name, "code": machine.code, "department_id": machine.department_id,
@@ -710,8 +1023,19 @@ async def update_machine(machine_id: str, machine: MachineCreate, user: dict = D
             "model": machine.model or "", "serial_number": machine.serial_number or "", "status": machine.status
         }}
     )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Máquina no encontrada")
+    invalidate_cache("machines")
+    
+    old_delta = machine_counter_delta(existing, -1)
+    new_delta = machine_counter_delta({"status": machine.status})
+    if existing.get("department_id") == machine.department_id:
+        await apply_counter_delta(machine.department_id, merge_counter_deltas(old_delta, new_delta))
+    else:
+        # Las órdenes de la máquina cambian de departamento con ella
+        orders_delta = await machine_orders_counter_delta(machine_id)
+        await apply_counter_delta(existing.get("department_id"), merge_counter_deltas(old_delta, negate_counter_delta(orders_delta)))
+        await apply_counter_delta(machine.department_id, merge_counter_deltas(new_delta, orders_delta))
+        await db.stop_rollups.update_many({"machine_id": machine_id}, {"$set": {"department_id": machine.department_id}})
+        invalidate_cache("stops")
     updated = await db.machines.find_one({"id": machine_id}, {"_id": 0})
     dept = await db.departments.find_one({"id": updated["department_id"]}, {"_id": 0})
     updated["department_name"] = dept["name"] if dept else ""
@@ -724,9 +1048,11 @@ async def delete_machine(machine_id: str, user: dict = Depends(require_role(["ad
     orders = await db.work_orders.find_one({"machine_id": machine_id})
     if orders:
         raise HTTPException(status_code=400, detail="No se puede eliminar: hay órdenes asociadas")
-    result = await db.machines.delete_one({"id": machine_id})
-    if result.deleted_count == 0:
+    deleted = await db.machines.find_one_and_delete({"id": machine_id}, {"_id": 0, "department_id": 1, "status": 1})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Máquina no encontrada")
+    await apply_counter_delta(deleted.get("department_id"), machine_counter_delta(deleted, -1))
+    invalidate_cache("machines")
     return {"message": "Máquina eliminada"}
 
 # ============== MACHINE ATTACHMENTS (Visible to all users) ==============
@@ -813,6 +1139,224 @@ async def delete_machine_attachment(machine_id: str, attachment_id: str, user: d
     
     return {"message": "Archivo eliminado"}
 
+# ============== STOP STORE ==============
+# Almacén único de paradas: la colección stops guarda las paradas de /stops y de /machine-stops.
+# Cada parada lleva su origen en source; cada API solo ve y modifica las suyas, mientras que los rollups
+# y las analíticas recorren todas. Las paradas anteriores a source (sin el campo) son de /stops.
+
+STOP_SOURCE_STOPS = "stops"
+STOP_SOURCE_MACHINE_STOPS = "machine_stops"
+STOPS_API_SCOPE = {"source": {"$ne": STOP_SOURCE_MACHINE_STOPS}}
+MACHINE_STOPS_API_SCOPE = {"source": STOP_SOURCE_MACHINE_STOPS}
+
+async def migrate_machine_stops(batch_size: int = 1000) -> int:
+    """Copia la antigua colección machine_stops a stops por lotes, reanudable desde el último _id copiado.
+
+    Las copias conservan el id y llevan source="machine_stops"; al reemplazar por id, repetir un lote
+    interrumpido no duplica paradas. La colección original no se borra.
+    """
+    migration_id = "stop_store:machine_stops"
+    state = await db.migrations.find_one({"id": migration_id}) or {}
+    if state.get("done"):
+        return 0
+    last_id = state.get("last_id")
+    copied = 0
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        docs = await db.machine_stops.find(query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not docs:
+            await db.migrations.update_one({"id": migration_id}, {"$set": {"done": True, "finished_at": datetime.now(timezone.utc).isoformat()}}, upsert=True)
+            break
+        ops = []
+        for doc in docs:
+            stop = {k: v for k, v in doc.items() if k != "_id"}
+            stop["source"] = STOP_SOURCE_MACHINE_STOPS
+            stop.update(date_shadow_fields("stops", stop))
+            ops.append(ReplaceOne({"id": stop["id"]}, stop, upsert=True))
+        await db.stops.bulk_write(ops, ordered=False)
+        last_id = docs[-1]["_id"]
+        copied += len(docs)
+        await db.migrations.update_one({"id": migration_id}, {"$set": {"last_id": last_id, "done": False}}, upsert=True)
+    if copied:
+        await rebuild_stop_rollups()
+        invalidate_cache("stops")
+        logger.info(f"Almacén de paradas: {copied} paradas copiadas desde machine_stops")
+    return copied
+
+async def ensure_no_overlapping_stop(machine_id: str, start_time: str, end_time: Optional[str] = None, exclude_id: Optional[str] = None):
+    """409 con la parada en conflicto si la máquina ya tiene otra parada que se solapa con [start_time, end_time).
+
+    Sin end_time la parada sigue abierta y se solapa con todo lo posterior. Dos paradas que solo se tocan
+    (una acaba cuando empieza la otra) no se solapan.
+    """
+    start = parse_iso_datetime(start_time)
+    if not start:
+        return
+    # Solo las paradas de la máquina que terminan después del inicio (o siguen abiertas): índice
+    # (machine_id, end_time_dt, start_time_dt), sin recorrer el histórico de la máquina
+    query = {"machine_id": machine_id, "$or": [{"end_time_dt": {"$gt": start}}, {"end_time_dt": None, "end_time": None}]}
+    end = parse_iso_datetime(end_time) if end_time else None
+    if end:
+        query["start_time_dt"] = {"$lt": end}
+    if exclude_id:
+        query["id"] = {"$ne": exclude_id}
+    conflict = await db.stops.find_one(query, {"_id": 0, **INTERNAL_FIELDS_PROJECTION})
+    if conflict:
+        raise StopOverlapError(conflict)
+
+class StopOverlapError(Exception):
+    """Parada que se solapa con otra de la misma máquina: 409 con `detail` en texto y la parada en `conflicting_stop`"""
+
+    message = "La máquina ya tiene una parada que se solapa con este intervalo"
+
+    def __init__(self, conflicting_stop: dict):
+        super().__init__(self.message)
+        self.conflicting_stop = conflicting_stop
+
+@app.exception_handler(StopOverlapError)
+async def stop_overlap_error_handler(request: Request, exc: StopOverlapError):
+    return JSONResponse(status_code=409, content=jsonable_encoder({"detail": exc.message, "conflicting_stop": exc.conflicting_stop}))
+
+# La comprobación de solapes y la escritura de la parada se serializan por máquina con un lease en la
+# colección locks (válido entre workers): dos operarios que registran a la vez no pueden pasar ambos
+STOP_LOCK_TTL_SECONDS = 30
+STOP_LOCK_WAIT_SECONDS = 10
+
+@asynccontextmanager
+async def machine_stop_lock(machine_id: str):
+    lock_id = f"stops:{machine_id}"
+    token = str(uuid.uuid4())
+    deadline = time.monotonic() + STOP_LOCK_WAIT_SECONDS
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            # Sin lease vigente lo crea o lo renueva; con uno vigente el upsert choca con el índice único
+            await db.locks.update_one(
+                {"id": lock_id, "expires_at": {"$lt": now}},
+                {"$set": {"token": token, "expires_at": now + timedelta(seconds=STOP_LOCK_TTL_SECONDS)}},
+                upsert=True
+            )
+            break
+        except DuplicateKeyError:
+            if time.monotonic() > deadline:
+                raise HTTPException(status_code=409, detail="Se está guardando otra parada de esta máquina, inténtalo de nuevo")
+            await asyncio.sleep(0.05)
+    try:
+        yield
+    finally:
+        await db.locks.delete_one({"id": lock_id, "token": token})
+
+@asynccontextmanager
+async def machine_stop_locks(machine_ids: List[str]):
+    """Varios leases a la vez, tomados en orden para que dos envíos masivos no se bloqueen entre sí"""
+    async with AsyncExitStack() as stack:
+        for machine_id in sorted(set(machine_ids)):
+            await stack.enter_async_context(machine_stop_lock(machine_id))
+        yield
+
+def stop_overlap_entry(stop: dict) -> dict:
+    return {
+        "id": stop["id"],
+        "source": stop.get("source") or STOP_SOURCE_STOPS,
+        "start_time": stop.get("start_time"),
+        "end_time": stop.get("end_time")
+    }
+
+async def scan_stop_overlaps() -> List[dict]:
+    """Paradas solapadas en todo el histórico, en una sola pasada ordenada por (machine_id, start_time_dt).
+
+    Por máquina se recuerda la parada que llega más lejos hasta el momento: cada parada que empieza antes
+    de ese fin se solapa con ella.
+    """
+    projection = {"_id": 0, "id": 1, "machine_id": 1, "source": 1, "start_time": 1, "end_time": 1, "start_time_dt": 1, "end_time_dt": 1}
+    cursor = db.stops.find({}, projection).sort([("machine_id", 1), ("start_time_dt", 1)]).hint([("machine_id", 1), ("start_time_dt", 1)])
+    overlaps = []
+    machine_id, reach, reach_end = None, None, None
+    async for stop in cursor:
+        start = stop.get("start_time_dt")
+        if not start:
+            continue
+        if stop["machine_id"] != machine_id:
+            machine_id, reach, reach_end = stop["machine_id"], None, None
+        # Sin hora de fin la parada sigue abierta; con una hora de fin ilegible no ocupa tiempo
+        end = stop.get("end_time_dt") or (start if stop.get("end_time") else datetime.max)
+        if reach and start < reach_end:
+            overlaps.append({"machine_id": machine_id, "stop": stop_overlap_entry(stop), "overlaps_with": stop_overlap_entry(reach)})
+        if reach is None or end > reach_end:
+            reach, reach_end = stop, end
+    return overlaps
+
+# ============== OPEN STOPS ==============
+# Registro en memoria de las paradas abiertas (sin end_time) de ambas APIs, para /stops/open.
+# Se carga al arrancar (índice parcial stops_open) y lo mantienen los handlers de alta, edición y baja;
+# cada OPEN_STOPS_RELOAD_SECONDS se recarga de Mongo para recoger escrituras de otros procesos.
+
+OPEN_STOPS_QUERY = {"end_time_dt": {"$type": "null"}}
+
+class OpenStopsRegistry:
+    def __init__(self):
+        self.stops = {}  # id -> parada abierta con máquina y departamento
+
+    def track(self, stop: dict, machine: Optional[dict] = None, department_name: str = ""):
+        """Añade la parada si sigue abierta o la quita si ya tiene hora de fin"""
+        started = parse_iso_datetime(stop.get("start_time"))
+        if stop.get("end_time") or not started:
+            self.stops.pop(stop["id"], None)
+            return
+        self.stops[stop["id"]] = {
+            "id": stop["id"],
+            "machine_id": stop["machine_id"],
+            "machine_name": machine.get("name", "") if machine else "",
+            "department_id": machine.get("department_id") if machine else None,
+            "department_name": department_name,
+            "stop_type": stop.get("stop_type", ""),
+            "reason": stop.get("reason", ""),
+            "start_time": stop["start_time"],
+            "source": stop.get("source") or STOP_SOURCE_STOPS,
+            "created_by": stop.get("created_by"),
+            "started": started
+        }
+
+    def discard(self, stop_id: str):
+        self.stops.pop(stop_id, None)
+
+    async def load(self):
+        stops = await db.stops.find(OPEN_STOPS_QUERY, {"_id": 0}).hint("stops_open").to_list(None)
+        machines = {m["id"]: m for m in await db.machines.find({}, {"_id": 0, "id": 1, "name": 1, "department_id": 1}).to_list(None)}
+        departments = {d["id"]: d["name"] for d in await db.departments.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(None)}
+        registry = OpenStopsRegistry()
+        for stop in stops:
+            machine = machines.get(stop["machine_id"])
+            registry.track(stop, machine, departments.get(machine.get("department_id"), "") if machine else "")
+        self.stops = registry.stops
+
+    def list(self, department_id: Optional[str] = None, machine_id: Optional[str] = None) -> List[dict]:
+        """Paradas abiertas con la duración calculada ahora, de la más larga a la más corta"""
+        now = datetime.now(timezone.utc)
+        result = []
+        for entry in list(self.stops.values()):
+            if department_id and entry["department_id"] != department_id:
+                continue
+            if machine_id and entry["machine_id"] != machine_id:
+                continue
+            row = {k: v for k, v in entry.items() if k != "started"}
+            row["duration_minutes"] = max(0, int((now - entry["started"]).total_seconds() // 60))
+            result.append(row)
+        result.sort(key=lambda r: r["duration_minutes"], reverse=True)
+        return result
+
+open_stops = OpenStopsRegistry()
+
+async def reload_open_stops_periodically():
+    while True:
+        await asyncio.sleep(OPEN_STOPS_RELOAD_SECONDS)
+        try:
+            await open_stops.load()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error recargando las paradas abiertas: {e}")
+
 # ============== MACHINE STOPS (PARADAS) ==============
 
 @api_router.post("/machine-stops", response_model=MachineStopResponse)
@@ -845,11 +1389,19 @@ async def create_machine_stop(stop: MachineStopCreate, user: dict = Depends(get_
         "start_time": stop.start_time,
         "end_time": stop.end_time,
         "duration_minutes": duration,
+        "source": STOP_SOURCE_MACHINE_STOPS,
         "created_by": user["id"],
         "created_at": now
     }
     
-    await db.machine_stops.insert_one(stop_doc)
+    stop_doc.update(date_shadow_fields("stops", stop_doc))
+    async with machine_stop_lock(stop.machine_id):
+        await ensure_no_overlapping_stop(stop.machine_id, stop.start_time, stop.end_time)
+        await db.stops.insert_one(stop_doc)
+    await apply_stop_rollup(stop_doc, machine.get("department_id"))
+    invalidate_cache("stops")
+    open_stops.track(stop_doc, machine, dept.get("name", "") if dept else "")
+    await publish_event("machine_stop", "created", stop_doc, machine.get("department_id"))
     
     return MachineStopResponse(
         **stop_doc,
@@ -865,13 +1417,13 @@ async def get_machine_stops(
     user: dict = Depends(get_current_user)
 ):
     """Obtener lista de paradas de máquinas"""
-    query = {}
+    query = {**MACHINE_STOPS_API_SCOPE}
     if machine_id:
         query["machine_id"] = machine_id
     if stop_type:
         query["stop_type"] = stop_type
     
-    stops = await db.machine_stops.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    stops = await db.stops.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
     
     machines = {m["id"]: m for m in await db.machines.find({}, {"_id": 0}).to_list(1000)}
     departments = {d["id"]: d["name"] for d in await db.departments.find({}, {"_id": 0}).to_list(1000)}
@@ -890,7 +1442,7 @@ async def get_machine_stops(
 @api_router.put("/machine-stops/{stop_id}", response_model=MachineStopResponse)
 async def update_machine_stop(stop_id: str, stop: MachineStopCreate, user: dict = Depends(get_current_user)):
     """Actualizar una parada (ej: añadir hora de fin)"""
-    existing = await db.machine_stops.find_one({"id": stop_id}, {"_id": 0})
+    existing = await db.stops.find_one({"id": stop_id, **MACHINE_STOPS_API_SCOPE}, {"_id": 0})
     if not existing:
         raise HTTPException(status_code=404, detail="Parada no encontrada")
     
@@ -904,21 +1456,31 @@ async def update_machine_stop(stop_id: str, stop: MachineStopCreate, user: dict
         except:
             pass
     
-    await db.machine_stops.update_one(
-        {"id": stop_id},
-        {"$set": {
-            "stop_type": stop.stop_type,
-            "reason": stop.reason,
-            "start_time": stop.start_time,
-            "end_time": stop.end_time,
-            "duration_minutes": duration
-        }}
-    )
+    stop_update = {
+        "stop_type": stop.stop_type,
+        "reason": stop.reason,
+        "start_time": stop.start_time,
+        "end_time": stop.end_time,
+        "duration_minutes": duration
+    }
+    stop_update.update(date_shadow_fields("stops", stop_update))
+    async with machine_stop_lock(existing["machine_id"]):
+        # Solo si cambia el intervalo: los solapes históricos (p. ej. calidad durante una avería) siguen editables
+        if existing.get("start_time") != stop.start_time or existing.get("end_time") != stop.end_time:
+            await ensure_no_overlapping_stop(existing["machine_id"], stop.start_time, stop.end_time, stop_id)
+        await db.stops.update_one({"id": stop_id}, {"$set": stop_update, **MODIFIED_AT})
     
-    updated = await db.machine_stops.find_one({"id": stop_id}, {"_id": 0})
+    updated = await db.stops.find_one({"id": stop_id}, {"_id": 0})
     machine = await db.machines.find_one({"id": updated["machine_id"]}, {"_id": 0})
+    if any(existing.get(f) != updated.get(f) for f in ["stop_type", "duration_minutes", "start_time"]):
+        department_id = machine.get("department_id") if machine else None
+        await apply_stop_rollup(existing, department_id, -1)
+        await apply_stop_rollup(updated, department_id)
+    invalidate_cache("stops")
     dept = await db.departments.find_one({"id": machine.get("department_id", "")}, {"_id": 0}) if machine else None
     created_user = await db.users.find_one({"id": updated.get("created_by", "")}, {"_id": 0})
+    open_stops.track(updated, machine, dept.get("name", "") if dept else "")
+    await publish_event("machine_stop", "updated", updated, machine.get("department_id") if machine else None)
     
     return MachineStopResponse(
         **updated,
@@ -930,38 +1492,256 @@ async def update_machine_stop(stop_id: str, stop: MachineStopCreate, user: dict
 @api_router.delete("/machine-stops/{stop_id}")
 async def delete_machine_stop(stop_id: str, user: dict = Depends(require_role(["admin", "supervisor"]))):
     """Eliminar una parada"""
-    result = await db.machine_stops.delete_one({"id": stop_id})
-    if result.deleted_count == 0:
+    deleted = await db.stops.find_one_and_delete({"id": stop_id, **MACHINE_STOPS_API_SCOPE}, {"_id": 0})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Parada no encontrada")
+    await apply_stop_rollup(deleted, await get_machine_department_id(deleted["machine_id"]), -1)
+    invalidate_cache("stops")
+    open_stops.discard(stop_id)
+    await publish_event("machine_stop", "deleted", deleted)
     return {"message": "Parada eliminada"}
 
+# ============== START ROLLUPS ==============
+# Rollups de cumplimiento de arranques, mantenidos con $inc en cada alta/edición/baja:
+# - machine_start_rollups: (date, production_line_id, department_id) -> total, with_actual, on_time, late, delay_total, delay_count
+# - line_start_rollups: (date, line_id, department_id, delay_reason) -> total, on_time, delay_minutes
+# first_created_at conserva el orden de aparición que tenían las agrupaciones calculadas en Python.
+
+def machine_start_rollup_key(start: dict) -> dict:
+    return {
+        "date": start.get("date"),
+        "production_line_id": start.get("production_line_id", ""),
+        "department_id": start.get("department_id")
+    }
+
+def machine_start_rollup_inc(start: dict) -> dict:
+    has_actual = bool(start.get("actual_time"))
+    with_delay = has_actual and not start.get("on_time") and bool(start.get("delay_minutes"))
+    return {
+        "total": 1,
+        "with_actual": 1 if has_actual else 0,
+        "on_time": 1 if has_actual and start.get("on_time") is True else 0,
+        "late": 1 if has_actual and start.get("on_time") is False else 0,
+        "delay_total": start["delay_minutes"] if with_delay else 0,
+        "delay_count": 1 if with_delay else 0
+    }
+
+def line_start_rollup_key(start: dict, department_id: Optional[str]) -> dict:
+    reason = start.get("delay_reason")
+    return {
+        "date": start.get("date"),
+        "line_id": start.get("line_id"),
+        "department_id": department_id,
+        "delay_reason": reason if reason and not start.get("on_time", True) else None
+    }
+
+def line_start_rollup_inc(start: dict) -> dict:
+    on_time = bool(start.get("on_time", False))
+    return {
+        "total": 1,
+        "on_time": 1 if on_time else 0,
+        "delay_minutes": 0 if on_time else (start.get("delay_minutes", 0) or 0)
+    }
+
+async def apply_rollup(collection: str, key: dict, inc: dict, weight: int = 1, created_at: Optional[str] = None):
+    """Suma (weight=1) o resta (weight=-1) la contribución de un documento a su fila de rollup"""
+    update = {"$inc": {k: v * weight for k, v in inc.items()}}
+    if weight > 0 and created_at:
+        update["$min"] = {"first_created_at": created_at}
+    await db[collection].update_one(key, update, upsert=True)
+    if weight < 0:
+        await db[collection].delete_one({**key, "total": {"$lte": 0}})
+
+async def apply_machine_start_rollup(start: dict, weight: int = 1):
+    await apply_rollup("machine_start_rollups", machine_start_rollup_key(start), machine_start_rollup_inc(start), weight, start.get("created_at"))
+
+async def apply_line_start_rollup(start: dict, department_id: Optional[str], weight: int = 1):
+    await apply_rollup("line_start_rollups", line_start_rollup_key(start, department_id), line_start_rollup_inc(start), weight, start.get("created_at"))
+
+async def apply_rollups(collection: str, changes: List[tuple]):
+    """Aplica de una vez muchas contribuciones (key, inc, weight, created_at): una operación por fila del rollup"""
+    totals = {}
+    for key, inc, weight, created_at in changes:
+        row = totals.setdefault(tuple(key.items()), {"inc": {}, "first_created_at": None, "removes": False})
+        for field, value in inc.items():
+            row["inc"][field] = row["inc"].get(field, 0) + value * weight
+        if weight > 0 and created_at and (row["first_created_at"] is None or created_at < row["first_created_at"]):
+            row["first_created_at"] = created_at
+        if weight < 0:
+            row["removes"] = True
+    ops = []
+    for key, row in totals.items():
+        update = {"$inc": row["inc"]}
+        if row["first_created_at"]:
+            update["$min"] = {"first_created_at": row["first_created_at"]}
+        ops.append(UpdateOne(dict(key), update, upsert=True))
+    # Las filas que se quedan sin documentos se borran después de aplicar todos los $inc
+    ops += [DeleteOne({**dict(key), "total": {"$lte": 0}}) for key, row in totals.items() if row["removes"]]
+    if ops:
+        await db[collection].bulk_write(ops)
+
+async def apply_machine_start_rollups(changes: List[tuple]):
+    """Versión masiva de apply_machine_start_rollup: changes es una lista de (arranque, weight)"""
+    await apply_rollups("machine_start_rollups", [
+        (machine_start_rollup_key(start), machine_start_rollup_inc(start), weight, start.get("created_at"))
+        for start, weight in changes
+    ])
+
+async def apply_line_start_rollups(changes: List[tuple]):
+    """Versión masiva de apply_line_start_rollup: changes es una lista de (arranque, department_id, weight)"""
+    await apply_rollups("line_start_rollups", [
+        (line_start_rollup_key(start, department_id), line_start_rollup_inc(start), weight, start.get("created_at"))
+        for start, department_id, weight in changes
+    ])
+
+def agg_not_blank(field: str) -> dict:
+    """Expresión de agregación: el campo existe y no es null ni cadena vacía"""
+    return {"$not": [{"$in": [{"$ifNull": [field, None]}, [None, ""]]}]}
+
+async def rebuild_start_rollups() -> dict:
+    """Regenera machine_start_rollups y line_start_rollups desde los arranques"""
+    has_actual = agg_not_blank("$actual_time")
+    not_on_time = {"$in": [{"$ifNull": ["$on_time", None]}, [None, False]]}
+    with_delay = {"$and": [has_actual, not_on_time, {"$not": [{"$in": [{"$ifNull": ["$delay_minutes", None]}, [None, 0]]}]}]}
+    await db.machine_starts.aggregate([
+        {"$group": {
+            "_id": {
+                "date": "$date",
+                "production_line_id": {"$ifNull": ["$production_line_id", ""]},
+                "department_id": {"$ifNull": ["$department_id", None]}
+            },
+            "total": {"$sum": 1},
+            "with_actual": {"$sum": {"$cond": [has_actual, 1, 0]}},
+            "on_time": {"$sum": {"$cond": [{"$and": [has_actual, {"$eq": ["$on_time", True]}]}, 1, 0]}},
+            "late": {"$sum": {"$cond": [{"$and": [has_actual, {"$eq": ["$on_time", False]}]}, 1, 0]}},
+            "delay_total": {"$sum": {"$cond": [with_delay, "$delay_minutes", 0]}},
+            "delay_count": {"$sum": {"$cond": [with_delay, 1, 0]}},
+            "first_created_at": {"$min": "$created_at"}
+        }},
+        {"$replaceWith": {"$mergeObjects": ["$_id", {
+            "total": "$total", "with_actual": "$with_actual", "on_time": "$on_time", "late": "$late",
+            "delay_total": "$delay_total", "delay_count": "$delay_count", "first_created_at": "$first_created_at"
+        }]}},
+        {"$out": "machine_start_rollups"}
+    ]).to_list(None)
+
+    is_on_time = {"$eq": ["$on_time", True]}
+    await db.line_starts.aggregate([
+        {"$lookup": {"from": "lines", "localField": "line_id", "foreignField": "id", "as": "line"}},
+        {"$group": {
+            "_id": {
+                "date": "$date",
+                "line_id": "$line_id",
+                "department_id": {"$ifNull": [{"$first": "$line.department_id"}, None]},
+                "delay_reason": {"$cond": [
+                    {"$and": [agg_not_blank("$delay_reason"), {"$not": [{"$ifNull": ["$on_time", True]}]}]},
+                    "$delay_reason",
+                    None
+                ]}
+            },
+            "total": {"$sum": 1},
+            "on_time": {"$sum": {"$cond": [is_on_time, 1, 0]}},
+            "delay_minutes": {"$sum": {"$cond": [is_on_time, 0, {"$ifNull": ["$delay_minutes", 0]}]}},
+            "first_created_at": {"$min": "$created_at"}
+        }},
+        {"$replaceWith": {"$mergeObjects": ["$_id", {
+            "total": "$total", "on_time": "$on_time", "delay_minutes": "$delay_minutes", "first_created_at": "$first_created_at"
+        }]}},
+        {"$out": "line_start_rollups"}
+    ]).to_list(None)
+    invalidate_cache("machine_starts", "line_starts")
+    return {
+        "machine_start_rollups": await db.machine_start_rollups.count_documents({}),
+        "line_start_rollups": await db.line_start_rollups.count_documents({})
+    }
+
+async def ensure_start_rollups():
+    """Construye los rollups de arranques una sola vez, marcado como terminado en migrations (como ensure_stop_rollups)"""
+    migration_id = "rollups:starts"
+    state = await db.migrations.find_one({"id": migration_id}) or {}
+    if state.get("done"):
+        return
+    rows = await rebuild_start_rollups()
+    await db.migrations.update_one({"id": migration_id}, {"$set": {"done": True, "finished_at": datetime.now(timezone.utc).isoformat()}}, upsert=True)
+    logger.info(f"Rollups de arranques reconstruidos: {rows}")
+
+def date_string_filter(date_from: Optional[str] = None, date_to: Optional[str] = None) -> Optional[dict]:
+    """Filtro de rango sobre el campo date (texto "YYYY-MM-DD"), igual que los listados de arranques"""
+    if not date_from and not date_to:
+        return None
+    condition = {}
+    if date_from:
+        condition["$gte"] = date_from
+    if date_to:
+        condition["$lte"] = date_to
+    return condition
+
 # ============== MACHINE STARTS (ARRANQUES) ==============
 
+# Adelanto máximo que se considera arranque antes de hora; una diferencia más negativa es un arranque
+# tardío pasada la medianoche (objetivo 22:00, real 00:30 = 150 min tarde) y una mayor de 24 h menos
+# este margen es un arranque anticipado el día anterior (objetivo 00:30, real 23:45 = a tiempo)
+START_EARLY_MAX_MINUTES = 6 * 60
+
+def start_delay(target_time: Optional[str], actual_time: Optional[str]) -> tuple:
+    """(on_time, delay_minutes) de un arranque con horas HH:MM; (None, None) si falta alguna o no es válida"""
+    if not actual_time or not target_time:
+        return None, None
+    try:
+        target = datetime.strptime(target_time, "%H:%M")
+        actual = datetime.strptime(actual_time, "%H:%M")
+    except ValueError:
+        return None, None
+    diff = (actual - target).total_seconds() / 60
+    if diff < -START_EARLY_MAX_MINUTES:
+        diff += 24 * 60
+    elif diff > 24 * 60 - START_EARLY_MAX_MINUTES:
+        diff -= 24 * 60
+    return diff <= 0, max(0, int(diff))
+
 @api_router.post("/machine-starts", response_model=MachineStartResponse)
 async def create_machine_start(start: MachineStartCreate, user: dict = Depends(get_current_user)):
-    """Registrar un arranque de línea de producción"""
+    """Registrar un arranque de línea de producción (completa el arranque pendiente de la hoja si lo hay)"""
     line = await db.production_lines.find_one({"id": start.production_line_id}, {"_id": 0})
     if not line:
         raise HTTPException(status_code=404, detail="Línea de producción no encontrada")
     
     dept = await db.departments.find_one({"id": line.get("department_id", "")}, {"_id": 0})
     
+    on_time, delay_minutes = start_delay(start.target_time, start.actual_time)
+    fields = {
+        "target_time": start.target_time,
+        "actual_time": start.actual_time,
+        "delay_reason": start.delay_reason or "",
+        "on_time": on_time,
+        "delay_minutes": delay_minutes,
+        "created_by": user["id"]
+    }
+    
+    # El arranque pendiente de ese día y línea (hoja de arranques) se completa en lugar de duplicarse.
+    # find_one_and_update lo reclama de forma atómica: dos envíos simultáneos no completan la misma fila
+    pending = await db.machine_starts.find_one_and_update(
+        {"production_line_id": start.production_line_id, "date": start.date, "actual_time": {"$in": [None, ""]}},
+        {"$set": fields, **MODIFIED_AT},
+        projection={"_id": 0},
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.BEFORE
+    )
+    if pending:
+        start_doc = {**pending, **fields}
+        await apply_machine_start_rollups([(pending, -1), (start_doc, 1)])
+        invalidate_cache("machine_starts")
+        await publish_event("machine_start", "updated", start_doc)
+        return MachineStartResponse(
+            **start_doc,
+            production_line_name=line.get("name", ""),
+            department_name=dept.get("name", "") if dept else "",
+            created_by_name=user["name"]
+        )
+    
     start_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc).isoformat()
     
-    # Calculate if on time and delay
-    on_time = None
-    delay_minutes = None
-    if start.actual_time and start.target_time:
-        try:
-            target = datetime.strptime(start.target_time, "%H:%M")
-            actual = datetime.strptime(start.actual_time, "%H:%M")
-            diff = (actual - target).total_seconds() / 60
-            on_time = diff <= 0
-            delay_minutes = max(0, int(diff))
-        except:
-            pass
-    
     start_doc = {
         "id": start_id,
         "production_line_id": start.production_line_id,
@@ -976,7 +1756,11 @@ async def create_machine_start(start: MachineStartCreate, user: dict = Depends(g
         "created_at": now
     }
     
+    start_doc.update(date_shadow_fields("machine_starts", start_doc))
     await db.machine_starts.insert_one(start_doc)
+    await apply_machine_start_rollup(start_doc)
+    invalidate_cache("machine_starts")
+    await publish_event("machine_start", "created", start_doc)
     
     return MachineStartResponse(
         **start_doc,
@@ -1036,18 +1820,7 @@ async def update_machine_start(start_id: str, start: MachineStartCreate, user: d
     if not existing:
         raise HTTPException(status_code=404, detail="Arranque no encontrado")
     
-    # Calculate if on time and delay
-    on_time = None
-    delay_minutes = None
-    if start.actual_time and start.target_time:
-        try:
-            target = datetime.strptime(start.target_time, "%H:%M")
-            actual = datetime.strptime(start.actual_time, "%H:%M")
-            diff = (actual - target).total_seconds() / 60
-            on_time = diff <= 0
-            delay_minutes = max(0, int(diff))
-        except:
-            pass
+    on_time, delay_minutes = start_delay(start.target_time, start.actual_time)
     
     await db.machine_starts.update_one(
         {"id": start_id},
@@ -1058,11 +1831,15 @@ async def update_machine_start(start_id: str, start: MachineStartCreate, user: d
             "delay_reason": start.delay_reason or "",
             "on_time": on_time,
             "delay_minutes": delay_minutes
-        }}
+        }, **MODIFIED_AT}
     )
     
     updated = await db.machine_starts.find_one({"id": start_id}, {"_id": 0})
+    await apply_machine_start_rollup(existing, -1)
+    await apply_machine_start_rollup(updated)
+    invalidate_cache("machine_starts")
     line = await db.production_lines.find_one({"id": updated.get("production_line_id", "")}, {"_id": 0})
+    await publish_event("machine_start", "updated", updated, line.get("department_id") if line else None)
     dept = await db.departments.find_one({"id": line.get("department_id", "") if line else ""}, {"_id": 0})
     created_user = await db.users.find_one({"id": updated.get("created_by", "")}, {"_id": 0})
     
@@ -1076,97 +1853,81 @@ async def update_machine_start(start_id: str, start: MachineStartCreate, user: d
 @api_router.delete("/machine-starts/{start_id}")
 async def delete_machine_start(start_id: str, user: dict = Depends(require_role(["admin", "supervisor"]))):
     """Eliminar un arranque"""
-    result = await db.machine_starts.delete_one({"id": start_id})
-    if result.deleted_count == 0:
+    deleted = await db.machine_starts.find_one_and_delete({"id": start_id}, {"_id": 0})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Arranque no encontrado")
+    await apply_machine_start_rollup(deleted, -1)
+    invalidate_cache("machine_starts")
+    await publish_event("machine_start", "deleted", deleted)
     return {"message": "Arranque eliminado"}
 
-@api_router.get("/machine-starts/compliance-stats")
-async def get_start_compliance_stats(
+async def compute_start_compliance_stats(
     department_id: Optional[str] = None,
     production_line_id: Optional[str] = None,
     date_from: Optional[str] = None,
-    date_to: Optional[str] = None,
-    user: dict = Depends(get_current_user)
+    date_to: Optional[str] = None
 ):
-    """Obtener estadísticas de cumplimiento de hora objetivo vs hora real"""
+    """Obtener estadísticas de cumplimiento de hora objetivo vs hora real (desde machine_start_rollups)"""
     query = {}
     if department_id:
         query["department_id"] = department_id
     if production_line_id:
         query["production_line_id"] = production_line_id
-    if date_from or date_to:
-        query["date"] = {}
-        if date_from:
-            query["date"]["$gte"] = date_from
-        if date_to:
-            query["date"]["$lte"] = date_to
+    dates = date_string_filter(date_from, date_to)
+    if dates:
+        query["date"] = dates
     
-    starts = await db.machine_starts.find(query, {"_id": 0}).to_list(10000)
+    rows = await db.machine_start_rollups.find(query, {"_id": 0}).sort("first_created_at", 1).to_list(None)
     
     lines = {l["id"]: l for l in await db.production_lines.find({}, {"_id": 0}).to_list(1000)}
     departments = {d["id"]: d["name"] for d in await db.departments.find({}, {"_id": 0}).to_list(1000)}
     
     # Overall stats
-    total = len(starts)
-    with_actual = [s for s in starts if s.get("actual_time")]
-    on_time_count = len([s for s in with_actual if s.get("on_time") == True])
-    delayed_count = len([s for s in with_actual if s.get("on_time") == False])
-    pending_count = total - len(with_actual)
+    total = sum(r["total"] for r in rows)
+    with_actual = sum(r["with_actual"] for r in rows)
+    on_time_count = sum(r["on_time"] for r in rows)
+    delayed_count = sum(r["late"] for r in rows)
+    pending_count = total - with_actual
     
-    compliance_rate = (on_time_count / len(with_actual) * 100) if with_actual else 0
+    compliance_rate = (on_time_count / with_actual * 100) if with_actual else 0
     
-    # Stats by department
+    # Stats by department, production line and day (las filas van en orden de primera aparición)
     dept_stats = {}
-    for s in starts:
-        line = lines.get(s.get("production_line_id", ""), {})
-        dept_id = line.get("department_id", s.get("department_id", ""))
+    line_stats = {}
+    daily_data = {}
+    for r in rows:
+        line = lines.get(r["production_line_id"], {})
+        dept_id = line.get("department_id", r.get("department_id", ""))
         dept_name = departments.get(dept_id, "Sin departamento")
         if dept_name not in dept_stats:
             dept_stats[dept_name] = {"total": 0, "on_time": 0, "delayed": 0, "pending": 0}
-        dept_stats[dept_name]["total"] += 1
-        if s.get("actual_time"):
-            if s.get("on_time"):
-                dept_stats[dept_name]["on_time"] += 1
-            else:
-                dept_stats[dept_name]["delayed"] += 1
-        else:
-            dept_stats[dept_name]["pending"] += 1
-    
-    # Stats by production line
-    line_stats = {}
-    for s in starts:
-        line_id = s.get("production_line_id", "")
-        line = lines.get(line_id, {})
+        dept_stats[dept_name]["total"] += r["total"]
+        dept_stats[dept_name]["on_time"] += r["on_time"]
+        dept_stats[dept_name]["delayed"] += r["with_actual"] - r["on_time"]
+        dept_stats[dept_name]["pending"] += r["total"] - r["with_actual"]
+        
         line_name = line.get("name", "Desconocida")
         if line_name not in line_stats:
-            line_stats[line_name] = {"total": 0, "on_time": 0, "delayed": 0, "avg_delay": 0, "delays": []}
-        line_stats[line_name]["total"] += 1
-        if s.get("actual_time"):
-            if s.get("on_time"):
-                line_stats[line_name]["on_time"] += 1
-            else:
-                line_stats[line_name]["delayed"] += 1
-                if s.get("delay_minutes"):
-                    line_stats[line_name]["delays"].append(s["delay_minutes"])
+            line_stats[line_name] = {"total": 0, "on_time": 0, "delayed": 0, "avg_delay": 0, "delay_total": 0, "delay_count": 0}
+        line_stats[line_name]["total"] += r["total"]
+        line_stats[line_name]["on_time"] += r["on_time"]
+        line_stats[line_name]["delayed"] += r["with_actual"] - r["on_time"]
+        line_stats[line_name]["delay_total"] += r["delay_total"]
+        line_stats[line_name]["delay_count"] += r["delay_count"]
+        
+        if r["with_actual"]:
+            date = r["date"] or ""
+            if date not in daily_data:
+                daily_data[date] = {"date": date, "on_time": 0, "delayed": 0, "total": 0}
+            daily_data[date]["total"] += r["with_actual"]
+            daily_data[date]["on_time"] += r["on_time"]
+            daily_data[date]["delayed"] += r["with_actual"] - r["on_time"]
     
     # Calculate average delays
-    for name, stats in line_stats.items():
-        if stats["delays"]:
-            stats["avg_delay"] = sum(stats["delays"]) / len(stats["delays"])
-        del stats["delays"]
-    
-    # Daily compliance for chart
-    daily_data = {}
-    for s in with_actual:
-        date = s.get("date", "")
-        if date not in daily_data:
-            daily_data[date] = {"date": date, "on_time": 0, "delayed": 0, "total": 0}
-        daily_data[date]["total"] += 1
-        if s.get("on_time"):
-            daily_data[date]["on_time"] += 1
-        else:
-            daily_data[date]["delayed"] += 1
+    for stats in line_stats.values():
+        if stats["delay_count"]:
+            stats["avg_delay"] = stats["delay_total"] / stats["delay_count"]
+        del stats["delay_total"], stats["delay_count"]
     
     daily_chart = sorted(daily_data.values(), key=lambda x: x["date"])[-30:]  # Last 30 days
     
@@ -1183,6 +1944,344 @@ async def get_start_compliance_stats(
         "daily_chart": daily_chart
     }
 
+@api_router.get("/machine-starts/compliance-stats")
+async def get_start_compliance_stats(
+    department_id: Optional[str] = None,
+    production_line_id: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Obtener estadísticas de cumplimiento de hora objetivo vs hora real"""
+    params = {"department_id": department_id, "production_line_id": production_line_id, "date_from": date_from, "date_to": date_to}
+    return await response_cache.get_or_compute(
+        "machine-starts/compliance-stats", params, CACHE_TTL_COMPLIANCE,
+        ["machine_starts", "production_lines", "departments"],
+        lambda: compute_start_compliance_stats(**params)
+    )
+
+# ============== START SHEET (HOJA DE ARRANQUES) ==============
+# Cada día se precrean los arranques pendientes (sin hora real) de todas las líneas activas para el día
+# siguiente; los responsables registran después las horas reales de sus líneas en un solo envío.
+
+STARTS_BULK_MAX = 1000
+START_SHEET_CREATED_BY = "sistema"
+
+def seconds_until_utc_hour(hour: int) -> float:
+    """Segundos hasta la próxima vez que el reloj UTC marque hour:00"""
+    now = datetime.now(timezone.utc)
+    next_run = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if next_run <= now:
+        next_run += timedelta(days=1)
+    return (next_run - now).total_seconds()
+
+async def generate_start_sheet(date: Optional[str] = None) -> int:
+    """Crea con un solo insert_many los arranques pendientes de `date` (por defecto mañana, UTC) de cada
+    línea activa que aún no tenga arranque ese día. Devuelve el número de arranques creados."""
+    date = date or (datetime.now(timezone.utc) + timedelta(days=1)).strftime("%Y-%m-%d")
+    lines = await db.production_lines.find(
+        {"status": "activa"}, {"_id": 0, "id": 1, "department_id": 1, "target_start_time": 1}
+    ).to_list(None)
+    existing = set(await db.machine_starts.distinct("production_line_id", {"date": date}))
+
+    now = datetime.now(timezone.utc).isoformat()
+    docs = []
+    for line in lines:
+        if line["id"] in existing:
+            continue
+        doc = {
+            "id": str(uuid.uuid4()),
+            "production_line_id": line["id"],
+            "department_id": line.get("department_id", ""),
+            "target_time": line.get("target_start_time") or "",
+            "actual_time": None,
+            "delay_reason": "",
+            "date": date,
+            "on_time": None,
+            "delay_minutes": None,
+            "created_by": START_SHEET_CREATED_BY,
+            "created_at": now
+        }
+        doc.update(date_shadow_fields("machine_starts", doc))
+        docs.append(doc)
+
+    if docs:
+        await db.machine_starts.insert_many(docs)
+        await apply_machine_start_rollups([(doc, 1) for doc in docs])
+        invalidate_cache("machine_starts")
+        for doc in docs:
+            await publish_event("machine_start", "created", doc)
+    logger.info(f"Hoja de arranques {date}: {len(docs)} arranques pendientes creados")
+    return len(docs)
+
+async def generate_start_sheet_daily():
+    """Genera cada día a START_SHEET_HOUR (UTC) la hoja del día siguiente.
+
+    Con varios workers solo uno la genera: el primero que registra la fecha en migrations.
+    """
+    while True:
+        await asyncio.sleep(seconds_until_utc_hour(START_SHEET_HOUR))
+        date = (datetime.now(timezone.utc) + timedelta(days=1)).strftime("%Y-%m-%d")
+        try:
+            await db.migrations.insert_one({"id": f"start_sheet:{date}", "created_at": datetime.now(timezone.utc).isoformat()})
+            await generate_start_sheet(date)
+        except asyncio.CancelledError:
+            raise
+        except DuplicateKeyError:
+            pass
+        except Exception as e:
+            logger.error(f"Error generando la hoja de arranques: {e}")
+
+@api_router.post("/machine-starts/bulk")
+async def create_machine_starts_bulk(sheet: MachineStartBulkCreate, user: dict = Depends(get_current_user)):
+    """Registrar las horas reales de muchas líneas de un mismo día en un solo envío.
+
+    Completa el arranque pendiente de la hoja de cada línea (o el ya registrado ese día) y crea los que
+    falten. Devuelve cuántos se han actualizado y creado, con los errores por fila.
+    """
+    if len(sheet.starts) > STARTS_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"Máximo {STARTS_BULK_MAX} arranques por envío")
+    line_ids = list({item.production_line_id for item in sheet.starts})
+    lines = {l["id"]: l for l in await db.production_lines.find({"id": {"$in": line_ids}}, {"_id": 0}).to_list(None)}
+    # Arranque a completar por línea: el primero pendiente y, si no hay, el primero registrado
+    current = {}
+    for s in await db.machine_starts.find({"date": sheet.date, "production_line_id": {"$in": line_ids}}, {"_id": 0}).sort("created_at", 1).to_list(None):
+        chosen = current.get(s["production_line_id"])
+        if chosen is None or (chosen.get("actual_time") and not s.get("actual_time")):
+            current[s["production_line_id"]] = s
+
+    now = datetime.now(timezone.utc).isoformat()
+    errors, seen, updates, inserts, rollups, events = [], set(), [], [], [], []
+    for row, item in enumerate(sheet.starts):
+        line = lines.get(item.production_line_id)
+        if not line:
+            errors.append({"row": row, "production_line_id": item.production_line_id, "error": "Línea de producción no encontrada"})
+            continue
+        if item.production_line_id in seen:
+            errors.append({"row": row, "production_line_id": item.production_line_id, "error": "Línea repetida en el envío"})
+            continue
+        existing = current.get(item.production_line_id)
+        target_time = item.target_time or (existing or {}).get("target_time") or line.get("target_start_time") or ""
+        on_time, delay_minutes = start_delay(target_time, item.actual_time)
+        if item.actual_time and on_time is None and target_time:
+            errors.append({"row": row, "production_line_id": item.production_line_id, "error": "Hora no válida (HH:MM)"})
+            continue
+        seen.add(item.production_line_id)
+        fields = {
+            "target_time": target_time,
+            "actual_time": item.actual_time,
+            "delay_reason": item.delay_reason or "",
+            "on_time": on_time,
+            "delay_minutes": delay_minutes
+        }
+        if existing:
+            updated = {**existing, **fields}
+            updates.append(UpdateOne({"id": existing["id"]}, {"$set": fields, **MODIFIED_AT}))
+            rollups += [(existing, -1), (updated, 1)]
+            events.append(("updated", updated, line.get("department_id")))
+        else:
+            doc = {
+                "id": str(uuid.uuid4()),
+                "production_line_id": item.production_line_id,
+                "department_id": line.get("department_id", ""),
+                **fields,
+                "date": sheet.date,
+                "created_by": user["id"],
+                "created_at": now
+            }
+            doc.update(date_shadow_fields("machine_starts", doc))
+            inserts.append(doc)
+            rollups.append((doc, 1))
+            events.append(("created", doc, line.get("department_id")))
+
+    if updates:
+        await db.machine_starts.bulk_write(updates, ordered=False)
+    if inserts:
+        await db.machine_starts.insert_many(inserts)
+    if rollups:
+        await apply_machine_start_rollups(rollups)
+        invalidate_cache("machine_starts")
+    for action, doc, department_id in events:
+        await publish_event("machine_start", action, doc, department_id)
+
+    return {
+        "received": len(sheet.starts),
+        "updated": len(updates),
+        "inserted": len(inserts),
+        "errors": errors
+    }
+
+# ============== START DELAY RECOMPUTE ==============
+# on_time/delay_minutes se guardan al escribir cada arranque. Si se corrige la hora objetivo de una línea
+# de producción, un job en segundo plano reasigna la nueva hora a los arranques que heredaban la anterior
+# y recalcula su retraso por lotes, junto con machine_start_rollups.
+
+START_RECOMPUTE_BATCH_SIZE = 1000
+start_recompute_lock = asyncio.Lock()
+start_recompute_tasks = set()
+
+async def recompute_machine_start_delays(query: dict, target_time: Optional[str] = None, batch_size: int = START_RECOMPUTE_BATCH_SIZE) -> int:
+    """Recalcula on_time/delay_minutes de los arranques de `query` con un bulk_write por lote.
+
+    Con target_time, además se asigna esa hora objetivo a todos ellos. Devuelve cuántos han cambiado.
+    """
+    changed = 0
+    last_id = None
+    async with start_recompute_lock:
+        while True:
+            page = {"$and": [query, {"_id": {"$gt": last_id}}]} if last_id else query
+            docs = await db.machine_starts.find(page).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            last_id = docs[-1]["_id"]
+            ops, rollups = [], []
+            for doc in docs:
+                target = doc.get("target_time") if target_time is None else target_time
+                on_time, delay_minutes = start_delay(target, doc.get("actual_time"))
+                fields = {"target_time": target, "on_time": on_time, "delay_minutes": delay_minutes}
+                if all(doc.get(k) == v for k, v in fields.items()):
+                    continue
+                ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields, **MODIFIED_AT}))
+                rollups += [(doc, -1), ({**doc, **fields}, 1)]
+            if ops:
+                await db.machine_starts.bulk_write(ops, ordered=False)
+                await apply_machine_start_rollups(rollups)
+                changed += len(ops)
+    if changed:
+        invalidate_cache("machine_starts")
+    return changed
+
+async def recompute_line_start_delays(batch_size: int = START_RECOMPUTE_BATCH_SIZE) -> int:
+    """Recalcula on_time/delay_minutes de todos los line_starts con la hora objetivo actual de su línea"""
+    lines = {l["id"]: l for l in await db.lines.find({}, {"_id": 0, "id": 1, "department_id": 1, "target_start_time": 1}).to_list(None)}
+    changed = 0
+    last_id = None
+    async with start_recompute_lock:
+        while True:
+            page = {"_id": {"$gt": last_id}} if last_id else {}
+            docs = await db.line_starts.find(page).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            last_id = docs[-1]["_id"]
+            ops, rollups = [], []
+            for doc in docs:
+                line = lines.get(doc.get("line_id"), {})
+                on_time, delay_minutes = start_delay(line.get("target_start_time"), doc.get("actual_start_time"))
+                if on_time is None:
+                    on_time, delay_minutes = True, 0
+                if doc.get("on_time") == on_time and doc.get("delay_minutes") == delay_minutes:
+                    continue
+                ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"on_time": on_time, "delay_minutes": delay_minutes}, **MODIFIED_AT}))
+                updated = {**doc, "on_time": on_time, "delay_minutes": delay_minutes}
+                rollups += [(doc, line.get("department_id"), -1), (updated, line.get("department_id"), 1)]
+            if ops:
+                await db.line_starts.bulk_write(ops, ordered=False)
+                await apply_line_start_rollups(rollups)
+                changed += len(ops)
+    if changed:
+        invalidate_cache("line_starts")
+    return changed
+
+async def retarget_production_line_starts(line_id: str, old_target: str, new_target: str) -> int:
+    """Pasa a new_target los arranques de la línea que tenían la hora objetivo anterior (o ninguna) y recalcula su retraso"""
+    query = {"production_line_id": line_id, "target_time": {"$in": list({old_target, "", None})}}
+    changed = await recompute_machine_start_delays(query, new_target)
+    logger.info(f"Línea {line_id}: hora objetivo {old_target or '-'} -> {new_target or '-'}, {changed} arranques recalculados")
+    return changed
+
+def schedule_start_retarget(line_id: str, old_target: str, new_target: str):
+    """Lanza retarget_production_line_starts en segundo plano sin retrasar la respuesta"""
+    def done(task: asyncio.Task):
+        start_recompute_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Error recalculando los arranques de la línea {line_id}: {task.exception()}")
+    task = asyncio.create_task(retarget_production_line_starts(line_id, old_target, new_target))
+    start_recompute_tasks.add(task)
+    task.add_done_callback(done)
+
+# ============== ISSUE FINGERPRINTS (CORRECTIVOS RECURRENTES) ==============
+# Huella normalizada de la avería (sin acentos, sin palabras vacías, tokens ordenados) y firma
+# MinHash en bandas LSH, calculadas al escribir para agrupar correctivos casi idénticos
+
+ISSUE_STOPWORDS = {
+    "a", "al", "ante", "con", "contra", "de", "del", "desde", "durante", "e", "el", "en", "entre",
+    "es", "esta", "este", "hay", "la", "las", "le", "les", "lo", "los", "mas", "muy", "no", "o",
+    "para", "pero", "por", "que", "se", "sin", "sobre", "su", "sus", "tras", "u", "un", "una",
+    "uno", "unos", "unas", "y", "ya"
+}
+ISSUE_MINHASH_BANDS = 8
+ISSUE_MINHASH_ROWS = 4
+ISSUE_SIMILARITY_THRESHOLD = 0.5
+# Se incrementa al cambiar la normalización: los correctivos con otra versión se recalculan al arrancar
+ISSUE_FINGERPRINT_VERSION = 2
+
+def issue_stem(token: str) -> str:
+    """Raíz común de singular y plural: se quitan la "s" y la "e" finales y la "z" final pasa a "c".
+
+    "fugas"/"fuga" -> "fuga", "motores"/"motor" -> "motor", "cables"/"cable" -> "cabl",
+    "engranajes"/"engranaje" -> "engranaj", "luces"/"luz" -> "luc"
+    """
+    if len(token) > 3 and token.endswith("s"):
+        token = token[:-1]
+    if len(token) > 3 and token.endswith("e"):
+        token = token[:-1]
+    if len(token) > 2 and token.endswith("z"):
+        token = token[:-1] + "c"
+    return token
+
+def issue_tokens(text: str) -> List[str]:
+    folded = unicodedata.normalize("NFKD", (text or "").lower())
+    folded = "".join(c for c in folded if not unicodedata.combining(c))
+    tokens = set()
+    for token in re.findall(r"[a-z0-9]+", folded):
+        if token in ISSUE_STOPWORDS:
+            continue
+        tokens.add(issue_stem(token))
+    return sorted(tokens)
+
+def issue_minhash_bands(tokens: List[str]) -> List[str]:
+    if not tokens:
+        return []
+    signature = [
+        min(int.from_bytes(hashlib.blake2b(f"{seed}:{t}".encode("utf-8"), digest_size=8).digest(), "big") for t in tokens)
+        for seed in range(ISSUE_MINHASH_BANDS * ISSUE_MINHASH_ROWS)
+    ]
+    bands = []
+    for band in range(ISSUE_MINHASH_BANDS):
+        rows = signature[band * ISSUE_MINHASH_ROWS:(band + 1) * ISSUE_MINHASH_ROWS]
+        bands.append(f"{band}:{hashlib.blake2b(repr(rows).encode('utf-8'), digest_size=6).hexdigest()}")
+    return bands
+
+def issue_fields(title: Optional[str], description: Optional[str]) -> dict:
+    """Campos de huella de un correctivo: se usa la descripción y, si está vacía, el título"""
+    text = (description or "").strip() or (title or "").strip()
+    tokens = issue_tokens(text)
+    return {
+        "issue_fingerprint": " ".join(tokens),
+        "issue_lsh": issue_minhash_bands(tokens),
+        "issue_fingerprint_version": ISSUE_FINGERPRINT_VERSION
+    }
+
+ISSUE_FINGERPRINT_STALE = {"type": "correctivo", "issue_fingerprint_version": {"$ne": ISSUE_FINGERPRINT_VERSION}}
+
+async def backfill_issue_fingerprints(batch_size: int = 1000) -> int:
+    """Calcula la huella de los correctivos que no la tienen o la tienen de una versión anterior, por lotes"""
+    updated = 0
+    while True:
+        orders = await db.work_orders.find(
+            ISSUE_FINGERPRINT_STALE,
+            {"_id": 0, "id": 1, "title": 1, "description": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not orders:
+            if updated:
+                invalidate_cache("work_orders")
+            return updated
+        await db.work_orders.bulk_write([
+            UpdateOne({"id": o["id"]}, {"$set": issue_fields(o.get("title"), o.get("description"))})
+            for o in orders
+        ], ordered=False)
+        updated += len(orders)
+
 # ============== WORK ORDERS ENDPOINTS ==============
 
 async def add_history(work_order_id: str, action: str, user: dict, field: str = None, old_val: str = None, new_val: str = None):
@@ -1197,6 +2296,7 @@ async def add_history(work_order_id: str, action: str, user: dict, field: str =
         "changed_by_name": user["name"],
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
+    entry.update(date_shadow_fields("work_order_history", entry))
     await db.work_order_history.insert_one(entry)
 
 @api_router.post("/work-orders", response_model=WorkOrderResponse)
@@ -1243,8 +2343,14 @@ async def create_work_order(order: WorkOrderCreate, user: dict = Depends(get_cur
         "created_at": now,
         "updated_at": now
     }
+    if order.type == "correctivo":
+        order_doc.update(issue_fields(order.title, order.description))
+    order_doc.update(date_shadow_fields("work_orders", order_doc))
     await db.work_orders.insert_one(order_doc)
+    invalidate_cache("work_orders")
     await add_history(order_id, "creada", user)
+    await apply_counter_delta(machine["department_id"], order_counter_delta(order_doc))
+    await publish_event("work_order", "created", order_doc, machine["department_id"])
     
     return WorkOrderResponse(
         **order_doc,
@@ -1308,8 +2414,113 @@ async def get_work_orders(
     
     return result
 
+@api_router.get("/work-orders/search")
+async def search_work_orders(
+    q: str,
+    type: Optional[str] = None,
+    status: Optional[str] = None,
+    priority: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    department_id: Optional[str] = None,
+    assigned_to: Optional[str] = None,
+    page: int = 1,
+    page_size: int = 20,
+    user: dict = Depends(get_current_user)
+):
+    """Búsqueda de texto completo sobre órdenes (título, descripción, notas, causa de fallo y nº de parte).
+
+    Usa el índice de texto en español: aplica stemming y no distingue acentos,
+    así "averia" encuentra "avería" y "averías". Resultados ordenados por relevancia.
+    """
+    q = q.strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="La búsqueda no puede estar vacía")
+    page = max(1, page)
+    page_size = min(max(1, page_size), 100)
+
+    query = {"$text": {"$search": q}}
+    if type:
+        query["type"] = type
+    if status:
+        query["status"] = status
+    if priority:
+        query["priority"] = priority
+    if assigned_to:
+        query["assigned_to"] = assigned_to
+    if machine_id:
+        query["machine_id"] = machine_id
+
+    if department_id:
+        machine_ids = [m["id"] for m in await db.machines.find({"department_id": department_id}, {"_id": 0, "id": 1}).to_list(1000)]
+        if machine_id:
+            query["machine_id"] = machine_id if machine_id in machine_ids else {"$in": []}
+        else:
+            query["machine_id"] = {"$in": machine_ids}
+
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"score": {"$meta": "textScore"}, "created_at": -1}},
+        {"$facet": {
+            "items": [
+                {"$skip": (page - 1) * page_size},
+                {"$limit": page_size},
+                {"$project": {"_id": 0, "attachments": 0, "technician_signature": 0, **INTERNAL_FIELDS_PROJECTION, "score": {"$meta": "textScore"}}}
+            ],
+            "total": [{"$count": "count"}]
+        }}
+    ]
+    facets = await db.work_orders.aggregate(pipeline).to_list(1)
+    items = facets[0]["items"] if facets else []
+    total = facets[0]["total"][0]["count"] if facets and facets[0]["total"] else 0
+
+    machine_ids = list({o["machine_id"] for o in items})
+    user_ids = list({uid for o in items for uid in (o.get("assigned_to"), o.get("created_by")) if uid})
+    machines = {m["id"]: m for m in await db.machines.find({"id": {"$in": machine_ids}}, {"_id": 0, "id": 1, "name": 1, "department_id": 1}).to_list(len(machine_ids))}
+    departments = {d["id"]: d["name"] for d in await db.departments.find({}, {"_id": 0}).to_list(1000)}
+    users = {u["id"]: u["name"] for u in await db.users.find({"id": {"$in": user_ids}}, {"_id": 0, "id": 1, "name": 1}).to_list(len(user_ids))}
+
+    for o in items:
+        machine = machines.get(o["machine_id"], {})
+        o["machine_name"] = machine.get("name", "")
+        o["department_name"] = departments.get(machine.get("department_id", ""), "")
+        o["assigned_to_name"] = users.get(o.get("assigned_to", ""), "")
+        o["created_by_name"] = users.get(o.get("created_by", ""), "")
+        o["score"] = round(o.get("score", 0), 3)
+
+    return {
+        "items": items,
+        "total": total,
+        "page": page,
+        "page_size": page_size,
+        "pages": (total + page_size - 1) // page_size
+    }
+
+def encode_history_cursor(entry: dict) -> str:
+    return base64.urlsafe_b64encode(f"{entry['timestamp']}|{entry['id']}".encode("utf-8")).decode("utf-8")
+
+def decode_history_cursor(cursor: str):
+    try:
+        timestamp, entry_id = base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8").split("|", 1)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return timestamp, entry_id
+
+async def get_history_page(order_id: str, cursor: Optional[str] = None, limit: int = 50):
+    """Página de historial ordenada de más reciente a más antigua, con cursor (timestamp, id)"""
+    query = {"work_order_id": order_id}
+    if cursor:
+        timestamp, entry_id = decode_history_cursor(cursor)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "id": {"$lt": entry_id}}
+        ]
+    entries = await db.work_order_history.find(query, {"_id": 0, "timestamp_dt": 0}).sort([("timestamp", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    next_cursor = encode_history_cursor(entries[limit - 1]) if len(entries) > limit else None
+    return entries[:limit], next_cursor
+
 @api_router.get("/work-orders/{order_id}", response_model=WorkOrderResponse)
-async def get_work_order(order_id: str, user: dict = Depends(get_current_user)):
+async def get_work_order(order_id: str, include: Optional[str] = None, user: dict = Depends(get_current_user)):
+    """Detalle de una orden. El historial solo se incluye con include=history"""
     order = await db.work_orders.find_one({"id": order_id}, {"_id": 0})
     if not order:
         raise HTTPException(status_code=404, detail="Orden no encontrada")
@@ -1319,7 +2530,9 @@ async def get_work_order(order_id: str, user: dict = Depends(get_current_user)):
     assigned_user = await db.users.find_one({"id": order.get("assigned_to")}, {"_id": 0}) if order.get("assigned_to") else None
     created_user = await db.users.find_one({"id": order["created_by"]}, {"_id": 0})
     
-    history = await db.work_order_history.find({"work_order_id": order_id}, {"_id": 0}).sort("timestamp", -1).to_list(100)
+    history = []
+    if include and "history" in include.split(","):
+        history, _ = await get_history_page(order_id, limit=100)
     
     return WorkOrderResponse(
         **order,
@@ -1330,6 +2543,16 @@ async def get_work_order(order_id: str, user: dict = Depends(get_current_user)):
         history=history
     )
 
+@api_router.get("/work-orders/{order_id}/history")
+async def get_work_order_history(order_id: str, cursor: Optional[str] = None, limit: int = 50, user: dict = Depends(get_current_user)):
+    """Historial paginado de una orden. Usar next_cursor para pedir la siguiente página"""
+    order = await db.work_orders.find_one({"id": order_id}, {"_id": 0, "id": 1})
+    if not order:
+        raise HTTPException(status_code=404, detail="Orden no encontrada")
+    limit = min(max(1, limit), 200)
+    items, next_cursor = await get_history_page(order_id, cursor, limit)
+    return {"items": items, "next_cursor": next_cursor}
+
 @api_router.put("/work-orders/{order_id}", response_model=WorkOrderResponse)
 async def update_work_order(order_id: str, update: WorkOrderUpdate, user: dict = Depends(get_current_user)):
     order = await db.work_orders.find_one({"id": order_id}, {"_id": 0})
@@ -1366,7 +2589,7 @@ async def update_work_order(order_id: str, update: WorkOrderUpdate, user: dict =
                     new_stock = 0  # No permitir stock negativo
                 await db.spare_parts.update_one(
                     {"id": spare_part_id}, 
-                    {"$set": {"stock_current": new_stock}}
+                    {"$set": {"stock_current": new_stock}, **MODIFIED_AT}
                 )
                 # Registrar en historial
                 await add_history(order_id, "repuesto_usado", user, "spare_part", "", f"{spare_part['name']} x{spare_part_quantity}")
@@ -1380,13 +2603,23 @@ async def update_work_order(order_id: str, update: WorkOrderUpdate, user: dict =
         if field != "updated_at" and order.get(field) != new_value:
             await add_history(order_id, "actualizada", user, field, str(order.get(field, "")), str(new_value))
     
-    await db.work_orders.update_one({"id": order_id}, {"$set": update_dict})
+    if order.get("type") == "correctivo" and ("title" in update_dict or "description" in update_dict):
+        update_dict.update(issue_fields(update_dict.get("title", order.get("title")), update_dict.get("description", order.get("description"))))
+    update_dict.update(date_shadow_fields("work_orders", update_dict))
+    
+    await db.work_orders.update_one({"id": order_id}, {"$set": update_dict, **MODIFIED_AT})
+    invalidate_cache("work_orders")
+    updated_order = {**order, **update_dict}
+    department_id = await get_machine_department_id(order["machine_id"])
+    if any(order.get(f) != updated_order.get(f) for f in ["status", "type", "priority"]):
+        await apply_counter_delta(department_id, merge_counter_deltas(order_counter_delta(order, -1), order_counter_delta(updated_order)))
+    await publish_event("work_order", "updated", updated_order, department_id)
     
     # If completed and is preventivo with recurrence, create next order
     if update.status == "completada" and order["type"] == "preventivo" and order.get("recurrence"):
         await create_next_preventive(order, user)
     
-    return await get_work_order(order_id, user)
+    return await get_work_order(order_id, user=user)
 
 async def create_next_preventive(order: dict, user: dict):
     recurrence = order.get("recurrence")
@@ -1445,82 +2678,129 @@ async def create_next_preventive(order: dict, user: dict):
 
 @api_router.delete("/work-orders/{order_id}")
 async def delete_work_order(order_id: str, user: dict = Depends(require_role(["admin", "supervisor"]))):
-    result = await db.work_orders.delete_one({"id": order_id})
-    if result.deleted_count == 0:
+    deleted = await db.work_orders.find_one_and_delete({"id": order_id}, {"_id": 0, "attachments": 0})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Orden no encontrada")
     await db.work_order_history.delete_many({"work_order_id": order_id})
+    department_id = await get_machine_department_id(deleted["machine_id"])
+    await apply_counter_delta(department_id, order_counter_delta(deleted, -1))
+    invalidate_cache("work_orders")
+    await publish_event("work_order", "deleted", deleted, department_id)
     return {"message": "Orden eliminada"}
 
 # ============== MY ORDERS (TECHNICIAN VIEW) ==============
 
+# Campos necesarios para las tarjetas de la vista del técnico (sin adjuntos ni firma)
+MY_ORDERS_LIST_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "title": 1,
+    "type": 1,
+    "priority": 1,
+    "status": 1,
+    "machine_id": 1,
+    "scheduled_date": 1,
+    "recurrence": 1,
+    "completed_date": 1,
+    "closed_date": 1,
+    "created_at": 1,
+    "checklist.checked": 1
+}
+
+async def enrich_my_orders(orders: List[dict]):
+    """Añade nombre de máquina y departamento cargando solo las máquinas referenciadas"""
+    machine_ids = list({o["machine_id"] for o in orders})
+    machines = {m["id"]: m for m in await db.machines.find({"id": {"$in": machine_ids}}, {"_id": 0, "id": 1, "name": 1, "department_id": 1}).to_list(len(machine_ids))}
+    dept_ids = list({m.get("department_id", "") for m in machines.values()})
+    departments = {d["id"]: d["name"] for d in await db.departments.find({"id": {"$in": dept_ids}}, {"_id": 0, "id": 1, "name": 1}).to_list(len(dept_ids))}
+    for o in orders:
+        machine = machines.get(o["machine_id"], {})
+        o["machine_name"] = machine.get("name", "")
+        o["department_name"] = departments.get(machine.get("department_id", ""), "")
+        if "checklist" not in o:
+            o["checklist"] = []
+        if "closed_date" not in o:
+            o["closed_date"] = None
+
 @api_router.get("/my-orders")
-async def get_my_orders(user: dict = Depends(get_current_user)):
-    """Get orders assigned to current user, organized by type and status"""
-    orders = await db.work_orders.find(
-        {"assigned_to": user["id"]},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(1000)
-    
-    machines = {m["id"]: m for m in await db.machines.find({}, {"_id": 0}).to_list(1000)}
-    departments = {d["id"]: d["name"] for d in await db.departments.find({}, {"_id": 0}).to_list(1000)}
-    
+async def get_my_orders(completed_limit: int = 10, user: dict = Depends(get_current_user)):
+    """Get orders assigned to current user, organized by type and status.
+
+    Grouping and counters are computed in a single $facet aggregation. Only the most
+    recent `completed_limit` completed orders per type are returned; older ones are
+    paged through /my-orders/completed.
+    """
+    completed_limit = min(max(1, completed_limit), 100)
+    open_statuses = {"$nin": ["completada", "en_progreso"]}  # pendiente, cancelada
+
+    facets = {"counts": [{"$group": {"_id": {"type": "$type", "status": "$status"}, "count": {"$sum": 1}}}]}
+    for order_type in ["preventivo", "correctivo"]:
+        facets[f"{order_type}_pendientes"] = [{"$match": {"type": order_type, "status": open_statuses}}]
+        facets[f"{order_type}_en_progreso"] = [{"$match": {"type": order_type, "status": "en_progreso"}}]
+        facets[f"{order_type}_completadas"] = [{"$match": {"type": order_type, "status": "completada"}}, {"$limit": completed_limit}]
+
+    pipeline = [
+        {"$match": {"assigned_to": user["id"]}},
+        {"$sort": {"created_at": -1}},
+        {"$project": MY_ORDERS_LIST_PROJECTION},
+        {"$facet": facets}
+    ]
+    grouped = (await db.work_orders.aggregate(pipeline).to_list(1))[0]
+
+    await enrich_my_orders([o for key, bucket in grouped.items() if key != "counts" for o in bucket])
+
     # Organize by type and status
     result = {
         "preventivo": {
-            "pendientes": [],
-            "en_progreso": [],
-            "completadas": []
+            "pendientes": grouped["preventivo_pendientes"],
+            "en_progreso": grouped["preventivo_en_progreso"],
+            "completadas": grouped["preventivo_completadas"],
+            "completadas_total": 0
         },
         "correctivo": {
-            "pendientes": [],
-            "en_progreso": [],
-            "completadas": []
+            "pendientes": grouped["correctivo_pendientes"],
+            "en_progreso": grouped["correctivo_en_progreso"],
+            "completadas": grouped["correctivo_completadas"],
+            "completadas_total": 0
         },
         "summary": {
-            "total": len(orders),
+            "total": 0,
             "preventivo_pendientes": 0,
             "preventivo_completadas": 0,
             "correctivo_pendientes": 0,
             "correctivo_completadas": 0
         }
     }
-    
-    for o in orders:
-        machine = machines.get(o["machine_id"], {})
-        o["machine_name"] = machine.get("name", "")
-        o["department_name"] = departments.get(machine.get("department_id", ""), "")
-        if "checklist" not in o:
-            o["checklist"] = []
-        if "technician_signature" not in o:
-            o["technician_signature"] = ""
-        if "closed_date" not in o:
-            o["closed_date"] = None
-        
-        order_type = o.get("type", "correctivo")
-        status = o.get("status", "pendiente")
-        
-        if order_type in result:
-            if status == "completada":
-                result[order_type]["completadas"].append(o)
-                if order_type == "preventivo":
-                    result["summary"]["preventivo_completadas"] += 1
-                else:
-                    result["summary"]["correctivo_completadas"] += 1
-            elif status == "en_progreso":
-                result[order_type]["en_progreso"].append(o)
-                if order_type == "preventivo":
-                    result["summary"]["preventivo_pendientes"] += 1
-                else:
-                    result["summary"]["correctivo_pendientes"] += 1
-            else:  # pendiente, cancelada
-                result[order_type]["pendientes"].append(o)
-                if order_type == "preventivo":
-                    result["summary"]["preventivo_pendientes"] += 1
-                else:
-                    result["summary"]["correctivo_pendientes"] += 1
-    
+
+    for c in grouped["counts"]:
+        order_type = c["_id"].get("type")
+        status = c["_id"].get("status")
+        result["summary"]["total"] += c["count"]
+        if order_type not in ["preventivo", "correctivo"]:
+            continue
+        if status == "completada":
+            result["summary"][f"{order_type}_completadas"] += c["count"]
+            result[order_type]["completadas_total"] += c["count"]
+        else:
+            result["summary"][f"{order_type}_pendientes"] += c["count"]
+
     return result
 
+@api_router.get("/my-orders/completed")
+async def get_my_completed_orders(type: str, skip: int = 0, limit: int = 10, user: dict = Depends(get_current_user)):
+    """Paginación bajo demanda del histórico de órdenes completadas del técnico"""
+    if type not in ["preventivo", "correctivo"]:
+        raise HTTPException(status_code=400, detail="Tipo inválido")
+    skip = max(0, skip)
+    limit = min(max(1, limit), 100)
+
+    query = {"assigned_to": user["id"], "type": type, "status": "completada"}
+    orders = await db.work_orders.find(query, MY_ORDERS_LIST_PROJECTION).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    total = await db.work_orders.count_documents(query)
+    await enrich_my_orders(orders)
+
+    return {"items": orders, "total": total, "skip": skip, "limit": limit}
+
 # ============== FILE ATTACHMENTS ==============
 
 @api_router.post("/work-orders/{order_id}/attachments")
@@ -1549,7 +2829,7 @@ async def upload_attachment(
     
     await db.work_orders.update_one(
         {"id": order_id},
-        {"$push": {"attachments": attachment}}
+        {"$push": {"attachments": attachment}, **MODIFIED_AT}
     )
     await add_history(order_id, "archivo_adjunto", user, "attachment", None, file.filename)
     
@@ -1559,14 +2839,94 @@ async def upload_attachment(
 async def delete_attachment(order_id: str, attachment_id: str, user: dict = Depends(get_current_user)):
     result = await db.work_orders.update_one(
         {"id": order_id},
-        {"$pull": {"attachments": {"id": attachment_id}}}
+        {"$pull": {"attachments": {"id": attachment_id}}, **MODIFIED_AT}
     )
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Archivo no encontrado")
     await add_history(order_id, "archivo_eliminado", user, "attachment", attachment_id, None)
     return {"message": "Archivo eliminado"}
 
-# ============== PARADAS ENDPOINTS ==============
+# ============== STOP ROLLUPS ==============
+# stop_rollups: una fila por (día UTC de start_time, machine_id, department_id, stop_type) con count y minutes.
+# Se mantiene con $inc en cada alta/edición/baja de parada; rebuild_stop_rollups la regenera desde stops.
+
+def stop_rollup_key(stop: dict, department_id: Optional[str]) -> dict:
+    start = stop.get("start_time_dt") or parse_iso_datetime(stop.get("start_time"))
+    return {
+        "day": start.strftime("%Y-%m-%d") if start else None,
+        "machine_id": stop.get("machine_id"),
+        "department_id": department_id,
+        "stop_type": stop.get("stop_type") or "otros"
+    }
+
+async def apply_stop_rollup(stop: dict, department_id: Optional[str], weight: int = 1):
+    """Suma (weight=1) o resta (weight=-1) la contribución de una parada a su rollup"""
+    key = stop_rollup_key(stop, department_id)
+    minutes = stop.get("duration_minutes") or 0
+    await db.stop_rollups.update_one(key, {"$inc": {"count": weight, "minutes": weight * minutes}}, upsert=True)
+    if weight < 0:
+        await db.stop_rollups.delete_one({**key, "count": {"$lte": 0}})
+
+async def apply_stop_rollups(stops: List[dict], department_ids: dict):
+    """Suma de una vez muchas paradas nuevas: una operación por fila del rollup (department_ids: máquina -> departamento)"""
+    totals = {}
+    for stop in stops:
+        key = tuple(stop_rollup_key(stop, department_ids.get(stop["machine_id"])).items())
+        count, minutes = totals.get(key, (0, 0))
+        totals[key] = (count + 1, minutes + (stop.get("duration_minutes") or 0))
+    if totals:
+        await db.stop_rollups.bulk_write([
+            UpdateOne(dict(key), {"$inc": {"count": count, "minutes": minutes}}, upsert=True)
+            for key, (count, minutes) in totals.items()
+        ], ordered=False)
+
+async def rebuild_stop_rollups() -> int:
+    """Regenera stop_rollups desde stops (el departamento se toma de la máquina actual)"""
+    await db.stops.aggregate([
+        {"$lookup": {"from": "machines", "localField": "machine_id", "foreignField": "id", "as": "machine"}},
+        {"$group": {
+            "_id": {
+                "day": {"$dateToString": {
+                    "format": "%Y-%m-%d",
+                    "date": {"$ifNull": ["$start_time_dt", {"$dateFromString": {"dateString": "$start_time", "onError": None, "onNull": None}}]},
+                    "onNull": None
+                }},
+                "machine_id": "$machine_id",
+                "department_id": {"$first": "$machine.department_id"},
+                "stop_type": {"$ifNull": ["$stop_type", "otros"]}
+            },
+            "count": {"$sum": 1},
+            "minutes": {"$sum": {"$ifNull": ["$duration_minutes", 0]}}
+        }},
+        {"$project": {
+            "_id": 0,
+            "day": "$_id.day",
+            "machine_id": "$_id.machine_id",
+            "department_id": {"$ifNull": ["$_id.department_id", None]},
+            "stop_type": "$_id.stop_type",
+            "count": 1,
+            "minutes": 1
+        }},
+        {"$out": "stop_rollups"}
+    ]).to_list(None)
+    invalidate_cache("stops")
+    return await db.stop_rollups.count_documents({})
+
+async def ensure_stop_rollups():
+    """Construye stop_rollups una sola vez, marcado como terminado en migrations.
+
+    Decide la marca y no el número de filas: una parada escrita antes de la comprobación crea su fila
+    por upsert y la colección parecería construida aunque solo tuviera esa parada.
+    """
+    migration_id = "rollups:stops"
+    state = await db.migrations.find_one({"id": migration_id}) or {}
+    if state.get("done"):
+        return
+    rows = await rebuild_stop_rollups()
+    await db.migrations.update_one({"id": migration_id}, {"$set": {"done": True, "finished_at": datetime.now(timezone.utc).isoformat()}}, upsert=True)
+    logger.info(f"stop_rollups reconstruida: {rows} filas")
+
+# ============== PARADAS ENDPOINTS ==============
 
 @api_router.post("/stops", response_model=StopResponse)
 async def create_stop(stop: StopCreate, user: dict = Depends(get_current_user)):
@@ -1598,10 +2958,18 @@ async def create_stop(stop: StopCreate, user: dict = Depends(get_current_user)):
         "end_time": stop.end_time,
         "duration_minutes": duration,
         "notes": stop.notes or "",
+        "source": STOP_SOURCE_STOPS,
         "created_by": user["id"],
         "created_at": now
     }
-    await db.stops.insert_one(stop_doc)
+    stop_doc.update(date_shadow_fields("stops", stop_doc))
+    async with machine_stop_lock(stop.machine_id):
+        await ensure_no_overlapping_stop(stop.machine_id, stop.start_time, stop.end_time)
+        await db.stops.insert_one(stop_doc)
+    await apply_stop_rollup(stop_doc, machine["department_id"])
+    invalidate_cache("stops")
+    open_stops.track(stop_doc, machine, dept["name"] if dept else "")
+    await publish_event("stop", "created", stop_doc, machine["department_id"])
     
     return StopResponse(
         **stop_doc,
@@ -1616,7 +2984,7 @@ async def get_stops(
     stop_type: Optional[str] = None,
     user: dict = Depends(get_current_user)
 ):
-    query = {}
+    query = {**STOPS_API_SCOPE}
     if machine_id:
         query["machine_id"] = machine_id
     if stop_type:
@@ -1638,9 +3006,18 @@ async def get_stops(
     
     return result
 
+@api_router.get("/stops/open", response_model=List[OpenStopResponse])
+async def get_open_stops(
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Máquinas paradas ahora mismo (paradas de /stops y /machine-stops sin hora de fin), desde memoria"""
+    return open_stops.list(department_id, machine_id)
+
 @api_router.put("/stops/{stop_id}", response_model=StopResponse)
 async def update_stop(stop_id: str, update: StopUpdate, user: dict = Depends(get_current_user)):
-    stop = await db.stops.find_one({"id": stop_id}, {"_id": 0})
+    stop = await db.stops.find_one({"id": stop_id, **STOPS_API_SCOPE}, {"_id": 0})
     if not stop:
         raise HTTPException(status_code=404, detail="Parada no encontrada")
     
@@ -1655,11 +3032,22 @@ async def update_stop(stop_id: str, update: StopUpdate, user: dict = Depends(get
         except:
             pass
     
-    await db.stops.update_one({"id": stop_id}, {"$set": update_dict})
+    update_dict.update(date_shadow_fields("stops", update_dict))
+    async with machine_stop_lock(stop["machine_id"]):
+        if "end_time" in update_dict:
+            await ensure_no_overlapping_stop(stop["machine_id"], stop["start_time"], update_dict["end_time"], stop_id)
+        await db.stops.update_one({"id": stop_id}, {"$set": update_dict, **MODIFIED_AT})
     
     updated = await db.stops.find_one({"id": stop_id}, {"_id": 0})
     machine = await db.machines.find_one({"id": updated["machine_id"]}, {"_id": 0})
+    if stop.get("stop_type") != updated.get("stop_type") or stop.get("duration_minutes") != updated.get("duration_minutes"):
+        department_id = machine["department_id"] if machine else None
+        await apply_stop_rollup(stop, department_id, -1)
+        await apply_stop_rollup(updated, department_id)
+    invalidate_cache("stops")
+    await publish_event("stop", "updated", updated, machine["department_id"] if machine else None)
     dept = await db.departments.find_one({"id": machine["department_id"]}, {"_id": 0}) if machine else None
+    open_stops.track(updated, machine, dept["name"] if dept else "")
     creator = await db.users.find_one({"id": updated["created_by"]}, {"_id": 0})
     
     return StopResponse(
@@ -1671,11 +3059,220 @@ async def update_stop(stop_id: str, update: StopUpdate, user: dict = Depends(get
 
 @api_router.delete("/stops/{stop_id}")
 async def delete_stop(stop_id: str, user: dict = Depends(require_role(["admin", "supervisor"]))):
-    result = await db.stops.delete_one({"id": stop_id})
-    if result.deleted_count == 0:
+    deleted = await db.stops.find_one_and_delete({"id": stop_id, **STOPS_API_SCOPE}, {"_id": 0})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Parada no encontrada")
+    await apply_stop_rollup(deleted, await get_machine_department_id(deleted["machine_id"]), -1)
+    invalidate_cache("stops")
+    open_stops.discard(stop_id)
+    await publish_event("stop", "deleted", deleted)
     return {"message": "Parada eliminada"}
 
+# ============== BULK STOPS ==============
+# Carga masiva de paradas (exportaciones de PLC o CSV): una sola lectura de máquinas, fechas y duraciones
+# vectorizadas con pandas, comprobación de solapes en memoria e insert_many(ordered=False).
+# external_id identifica el evento de origen: reenviar el mismo evento no duplica la parada.
+
+STOPS_BULK_MAX = 10000
+STOP_BULK_FIELDS = ["external_id", "machine_id", "stop_type", "reason", "start_time", "end_time", "notes"]
+
+def csv_rows(content: bytes) -> List[dict]:
+    try:
+        frame = pd.read_csv(io.BytesIO(content), dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="CSV no válido")
+    frame.columns = [c.strip() for c in frame.columns]
+    return frame.to_dict("records")
+
+async def read_bulk_rows(request: Request) -> List[dict]:
+    """Filas de una carga masiva: array JSON, CSV en el cuerpo (text/csv) o fichero CSV (multipart, campo file)"""
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        upload = (await request.form()).get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Falta el fichero CSV (campo file)")
+        return csv_rows(await upload.read())
+    if content_type.startswith("text/csv"):
+        return csv_rows(await request.body())
+    try:
+        rows = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="El cuerpo debe ser un array JSON o un CSV")
+    if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+        raise HTTPException(status_code=400, detail="El cuerpo debe ser un array JSON de paradas")
+    return rows
+
+def bulk_text(value) -> Optional[str]:
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+def validate_bulk_stops(rows: List[dict], machine_ids: set) -> pd.DataFrame:
+    """Una fila por parada con sus fechas tipadas, la duración y el primer error encontrado (o None)"""
+    frame = pd.DataFrame([{f: bulk_text(row.get(f)) for f in STOP_BULK_FIELDS} for row in rows], columns=STOP_BULK_FIELDS, dtype=object)
+    start = pd.to_datetime(frame["start_time"], utc=True, errors="coerce", format="ISO8601")
+    end = pd.to_datetime(frame["end_time"], utc=True, errors="coerce", format="ISO8601")
+    error = pd.Series(None, index=frame.index, dtype=object)
+    checks = [
+        (frame["machine_id"].isna(), "Falta machine_id"),
+        (~frame["machine_id"].isin(machine_ids), "Máquina no encontrada"),
+        (frame["stop_type"].isna(), "Falta stop_type"),
+        (start.isna(), "start_time no es una fecha válida"),
+        (frame["end_time"].notna() & end.isna(), "end_time no es una fecha válida"),
+        (end < start, "end_time es anterior a start_time"),
+        (frame["external_id"].notna() & frame["external_id"].duplicated(), "external_id repetido en el envío")
+    ]
+    for mask, message in checks:
+        error[mask & error.isna()] = message
+    frame["start_dt"] = start
+    frame["end_dt"] = end
+    frame["duration_minutes"] = (end - start).dt.total_seconds() // 60
+    frame["error"] = error
+    return frame
+
+def bulk_stop_overlaps(candidates: List[tuple], existing: List[dict]) -> dict:
+    """Fila -> parada con la que se solapa, ya guardada o de una fila anterior del mismo envío.
+
+    candidates: (fila, machine_id, inicio, fin o None si sigue abierta), con datetimes UTC.
+    Las paradas guardadas se ordenan por inicio con el fin más lejano acumulado, de modo que cada fila
+    se comprueba con una búsqueda binaria; las filas del envío se barren en orden de inicio por máquina.
+    """
+    far = datetime.max.replace(tzinfo=timezone.utc)
+    by_machine = {}
+    for stop in existing:
+        if not stop.get("start_time_dt"):
+            continue
+        end = stop["end_time_dt"].replace(tzinfo=timezone.utc) if stop.get("end_time_dt") else far
+        by_machine.setdefault(stop["machine_id"], []).append((stop["start_time_dt"].replace(tzinfo=timezone.utc), end, stop))
+    saved = {}
+    for machine_id, intervals in by_machine.items():
+        intervals.sort(key=lambda i: i[0])
+        reach = []  # posición del intervalo que llega más lejos entre los primeros k
+        for k, interval in enumerate(intervals):
+            reach.append(k if not reach or interval[1] > intervals[reach[-1]][1] else reach[-1])
+        saved[machine_id] = ([i[0] for i in intervals], intervals, reach)
+    
+    conflicts = {}
+    accepted = {}  # machine_id -> (fin más lejano, fila)
+    for row, machine_id, start, end in sorted(candidates, key=lambda c: (c[1], c[2])):
+        end = end or far
+        if machine_id in saved:
+            starts, intervals, reach = saved[machine_id]
+            k = bisect.bisect_left(starts, end)
+            if k and intervals[reach[k - 1]][1] > start:
+                conflicts[row] = intervals[reach[k - 1]][2]
+                continue
+        last = accepted.get(machine_id)
+        if last and start < last[0]:
+            conflicts[row] = {"row": last[1]}
+            continue
+        if not last or end > last[0]:
+            accepted[machine_id] = (end, row)
+    return conflicts
+
+@api_router.post("/stops/bulk")
+async def create_stops_bulk(request: Request, user: dict = Depends(get_current_user)):
+    """Alta masiva de paradas (array JSON o CSV, hasta STOPS_BULK_MAX) con informe de errores por fila.
+
+    Columnas: external_id, machine_id, stop_type, reason, start_time, end_time, notes. Las filas cuyo
+    external_id ya existe se devuelven como duplicadas sin volver a insertarse.
+    """
+    rows = await read_bulk_rows(request)
+    if len(rows) > STOPS_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"Máximo {STOPS_BULK_MAX} paradas por envío")
+    machines = {m["id"]: m for m in await db.machines.find({}, {"_id": 0, "id": 1, "name": 1, "department_id": 1}).to_list(None)}
+    frame = validate_bulk_stops(rows, set(machines))
+    
+    external_ids = frame.loc[frame["error"].isna() & frame["external_id"].notna(), "external_id"].tolist()
+    known = {s["external_id"] for s in await db.stops.find({"external_id": {"$in": external_ids}}, {"_id": 0, "external_id": 1}).to_list(None)}
+    duplicate = frame["external_id"].isin(known) & frame["error"].isna()
+    pending = frame[frame["error"].isna() & ~duplicate]
+    
+    # Los leases de las máquinas del envío cubren la comprobación de solapes y la inserción
+    async with machine_stop_locks(pending["machine_id"].tolist()):
+        # Solapes con las paradas guardadas de esas máquinas en la ventana del envío (una consulta) y entre filas
+        conflicts = {}
+        if len(pending):
+            window_start = pending["start_dt"].min().to_pydatetime()
+            overlap_query = {
+                "machine_id": {"$in": pending["machine_id"].unique().tolist()},
+                "$or": [{"end_time_dt": {"$gt": window_start}}, {"end_time_dt": None, "end_time": None}]
+            }
+            if pending["end_dt"].notna().all():
+                overlap_query["start_time_dt"] = {"$lt": pending["end_dt"].max().to_pydatetime()}
+            existing = await db.stops.find(overlap_query, {"_id": 0}).to_list(None)
+            candidates = [
+                (row, machine_id, start.to_pydatetime(), None if pd.isna(end) else end.to_pydatetime())
+                for row, machine_id, start, end in zip(pending.index, pending["machine_id"], pending["start_dt"], pending["end_dt"])
+            ]
+            conflicts = bulk_stop_overlaps(candidates, existing)
+        
+        errors = [{"row": int(row), "external_id": frame.at[row, "external_id"], "error": message} for row, message in frame["error"].dropna().items()]
+        for row, conflict in conflicts.items():
+            if "row" in conflict:
+                conflict = {"row": int(conflict["row"]), "external_id": frame.at[conflict["row"], "external_id"]}
+            else:
+                conflict = {k: v for k, v in conflict.items() if not k.endswith("_dt")}
+            errors.append({"row": int(row), "external_id": frame.at[row, "external_id"], "error": "Se solapa con otra parada de la máquina", "conflicting_stop": conflict})
+        
+        now = datetime.now(timezone.utc).isoformat()
+        docs, doc_rows = [], []
+        for row, r in pending.drop(index=list(conflicts)).iterrows():
+            doc = {
+                "id": str(uuid.uuid4()),
+                "machine_id": r["machine_id"],
+                "stop_type": r["stop_type"],
+                "reason": r["reason"] or "",
+                "start_time": r["start_time"],
+                "end_time": r["end_time"],
+                "duration_minutes": None if pd.isna(r["duration_minutes"]) else int(r["duration_minutes"]),
+                "notes": r["notes"] or "",
+                "source": STOP_SOURCE_STOPS,
+                "created_by": user["id"],
+                "created_at": now,
+                "start_time_dt": r["start_dt"].to_pydatetime(),
+                "end_time_dt": None if pd.isna(r["end_dt"]) else r["end_dt"].to_pydatetime(),
+                "created_at_dt": parse_iso_datetime(now)
+            }
+            if r["external_id"]:
+                doc["external_id"] = r["external_id"]
+            docs.append(doc)
+            doc_rows.append(row)
+        
+        # ordered=False: una fila rechazada por Mongo no detiene las demás. Un external_id insertado por
+        # otro envío concurrente (índice único) cuenta como duplicado
+        failed = {}
+        if docs:
+            try:
+                await db.stops.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                failed = {err["index"]: err for err in e.details.get("writeErrors", [])}
+    duplicate_rows = list(frame.index[duplicate])
+    for index, err in failed.items():
+        row = doc_rows[index]
+        if err.get("code") == 11000:
+            duplicate_rows.append(row)
+        else:
+            errors.append({"row": int(row), "external_id": frame.at[row, "external_id"], "error": err.get("errmsg", "Error al guardar")})
+    inserted = [doc for index, doc in enumerate(docs) if index not in failed]
+    
+    if inserted:
+        await apply_stop_rollups(inserted, {m["id"]: m.get("department_id") for m in machines.values()})
+        invalidate_cache("stops")
+        departments = {d["id"]: d["name"] for d in await db.departments.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(None)}
+        for doc in inserted:
+            machine = machines[doc["machine_id"]]
+            open_stops.track(doc, machine, departments.get(machine.get("department_id"), ""))
+            await publish_event("stop", "created", doc, machine.get("department_id"))
+    
+    errors.sort(key=lambda e: e["row"])
+    return {
+        "received": len(rows),
+        "inserted": len(inserted),
+        "duplicates": [{"row": int(row), "external_id": frame.at[row, "external_id"]} for row in sorted(duplicate_rows)],
+        "errors": errors
+    }
+
 # ============== LINEAS ENDPOINTS ==============
 
 @api_router.post("/lines", response_model=LineResponse)
@@ -1696,6 +3293,7 @@ async def create_line(line: LineCreate, user: dict = Depends(require_role(["admi
         "created_at": now
     }
     await db.lines.insert_one(line_doc)
+    invalidate_cache("lines")
     
     return LineResponse(**line_doc, department_name=dept["name"])
 
@@ -1714,6 +3312,7 @@ async def delete_line(line_id: str, user: dict = Depends(require_role(["admin"])
     result = await db.lines.delete_one({"id": line_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Línea no encontrada")
+    invalidate_cache("lines")
     return {"message": "Línea eliminada"}
 
 # ============== ARRANQUE DE LINEAS ENDPOINTS ==============
@@ -1729,17 +3328,10 @@ async def create_line_start(start: LineStartCreate, user: dict = Depends(get_cur
     start_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc).isoformat()
     
-    # Calcular retraso
-    delay_minutes = 0
-    on_time = True
-    try:
-        target = datetime.strptime(line["target_start_time"], "%H:%M")
-        actual = datetime.strptime(start.actual_start_time, "%H:%M")
-        diff = (actual - target).total_seconds() / 60
-        delay_minutes = int(diff) if diff > 0 else 0
-        on_time = delay_minutes <= 0
-    except:
-        pass
+    # Calcular retraso (sin hora objetivo válida cuenta como a tiempo)
+    on_time, delay_minutes = start_delay(line["target_start_time"], start.actual_start_time)
+    if on_time is None:
+        on_time, delay_minutes = True, 0
     
     start_doc = {
         "id": start_id,
@@ -1753,7 +3345,11 @@ async def create_line_start(start: LineStartCreate, user: dict = Depends(get_cur
         "created_by": user["id"],
         "created_at": now
     }
+    start_doc.update(date_shadow_fields("line_starts", start_doc))
     await db.line_starts.insert_one(start_doc)
+    await apply_line_start_rollup(start_doc, line["department_id"])
+    invalidate_cache("line_starts")
+    await publish_event("line_start", "created", start_doc, line["department_id"])
     
     return LineStartResponse(
         **start_doc,
@@ -1800,61 +3396,268 @@ async def get_line_starts(
 
 @api_router.delete("/line-starts/{start_id}")
 async def delete_line_start(start_id: str, user: dict = Depends(require_role(["admin", "supervisor"]))):
-    result = await db.line_starts.delete_one({"id": start_id})
-    if result.deleted_count == 0:
+    deleted = await db.line_starts.find_one_and_delete({"id": start_id}, {"_id": 0})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Registro no encontrado")
+    line = await db.lines.find_one({"id": deleted.get("line_id")}, {"_id": 0, "department_id": 1})
+    await apply_line_start_rollup(deleted, line.get("department_id") if line else None, -1)
+    invalidate_cache("line_starts")
+    await publish_event("line_start", "deleted", deleted, line.get("department_id") if line else None)
     return {"message": "Registro eliminado"}
 
 # ============== DASHBOARD STATS ==============
 
-@api_router.get("/dashboard/stats")
-async def get_dashboard_stats(user: dict = Depends(get_current_user)):
-    total_machines = await db.machines.count_documents({})
-    operational = await db.machines.count_documents({"status": "operativa"})
-    in_maintenance = await db.machines.count_documents({"status": "en_mantenimiento"})
-    out_of_service = await db.machines.count_documents({"status": "fuera_de_servicio"})
-    
-    total_orders = await db.work_orders.count_documents({})
-    pending = await db.work_orders.count_documents({"status": "pendiente"})
-    in_progress = await db.work_orders.count_documents({"status": "en_progreso"})
-    completed = await db.work_orders.count_documents({"status": "completada"})
-    
-    preventive = await db.work_orders.count_documents({"type": "preventivo"})
-    corrective = await db.work_orders.count_documents({"type": "correctivo"})
-    
-    # Orders by priority
-    critical = await db.work_orders.count_documents({"priority": "critica", "status": {"$ne": "completada"}})
-    high = await db.work_orders.count_documents({"priority": "alta", "status": {"$ne": "completada"}})
-    
+async def compute_machine_counts() -> dict:
+    """Conteo de máquinas por estado en un único $group"""
+    rows = await db.machines.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    by_status = {r["_id"]: r["count"] for r in rows}
+    return {
+        "total": sum(by_status.values()),
+        "operational": by_status.get("operativa", 0),
+        "in_maintenance": by_status.get("en_mantenimiento", 0),
+        "out_of_service": by_status.get("fuera_de_servicio", 0)
+    }
+
+async def compute_order_counts() -> dict:
+    """Conteo de órdenes por estado, tipo y prioridad abierta en un único $facet"""
+    rows = await db.work_orders.aggregate([
+        {"$project": {"_id": 0, "status": 1, "type": 1, "priority": 1}},
+        {"$facet": {
+            "by_status": [{"$group": {"_id": "$status", "count": {"$sum": 1}}}],
+            "by_type": [{"$group": {"_id": "$type", "count": {"$sum": 1}}}],
+            "open_by_priority": [
+                {"$match": {"status": {"$ne": "completada"}, "priority": {"$in": ["critica", "alta"]}}},
+                {"$group": {"_id": "$priority", "count": {"$sum": 1}}}
+            ]
+        }}
+    ]).to_list(1)
+    facets = rows[0] if rows else {"by_status": [], "by_type": [], "open_by_priority": []}
+    by_status = {r["_id"]: r["count"] for r in facets["by_status"]}
+    by_type = {r["_id"]: r["count"] for r in facets["by_type"]}
+    open_by_priority = {r["_id"]: r["count"] for r in facets["open_by_priority"]}
+    return {
+        "total": sum(by_status.values()),
+        "pending": by_status.get("pendiente", 0),
+        "in_progress": by_status.get("en_progreso", 0),
+        "completed": by_status.get("completada", 0),
+        "preventive": by_type.get("preventivo", 0),
+        "corrective": by_type.get("correctivo", 0),
+        "critical": open_by_priority.get("critica", 0),
+        "high_priority": open_by_priority.get("alta", 0)
+    }
+
+async def compute_dashboard_stats() -> dict:
+    machines, orders = await asyncio.gather(compute_machine_counts(), compute_order_counts())
+    return {"machines": machines, "orders": orders}
+
+# ============== DASHBOARD COUNTERS ==============
+# Contadores materializados en dashboard_counters: un documento "global" y uno por departamento,
+# actualizados con $inc desde las escrituras y corregidos periódicamente por reconcile_dashboard_counters
+
+def machine_counter_delta(machine: dict, weight: int = 1) -> dict:
+    """Contribución de una máquina a los contadores (weight=-1 para restarla)"""
+    return {
+        "machines.total": weight,
+        f"machines.status.{machine.get('status') or 'sin_estado'}": weight
+    }
+
+def order_counter_delta(order: dict, weight: int = 1) -> dict:
+    """Contribución de una orden a los contadores (weight=-1 para restarla)"""
+    status = order.get("status") or "sin_estado"
+    delta = {
+        "orders.total": weight,
+        f"orders.status.{status}": weight,
+        f"orders.type.{order.get('type') or 'sin_tipo'}": weight
+    }
+    if status != "completada":
+        delta[f"orders.open_priority.{order.get('priority') or 'sin_prioridad'}"] = weight
+    return delta
+
+def merge_counter_deltas(*deltas: dict) -> dict:
+    merged = {}
+    for delta in deltas:
+        for key, value in delta.items():
+            merged[key] = merged.get(key, 0) + value
+    return {k: v for k, v in merged.items() if v != 0}
+
+def negate_counter_delta(delta: dict) -> dict:
+    return {k: -v for k, v in delta.items()}
+
+async def apply_counter_delta(department_id: Optional[str], delta: dict):
+    """Aplica el mismo $inc al contador global y al del departamento"""
+    if not delta:
+        return
+    scopes = ["global"] + ([department_id] if department_id else [])
+    await db.dashboard_counters.bulk_write([
+        UpdateOne({"id": scope}, {"$inc": delta, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}, upsert=True)
+        for scope in scopes
+    ], ordered=False)
+
+async def machine_orders_counter_delta(machine_id: str) -> dict:
+    """Contribución de todas las órdenes de una máquina (al cambiarla de departamento)"""
+    rows = await db.work_orders.aggregate([
+        {"$match": {"machine_id": machine_id}},
+        {"$group": {"_id": {"status": "$status", "type": "$type", "priority": "$priority"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+    return merge_counter_deltas(*[order_counter_delta(r["_id"], r["count"]) for r in rows])
+
+async def reconcile_dashboard_counters():
+    """Recalcula todos los contadores desde las colecciones y corrige cualquier desviación"""
+    machines = await db.machines.find({}, {"_id": 0, "id": 1, "department_id": 1, "status": 1}).to_list(None)
+    machine_depts = {m["id"]: m.get("department_id") for m in machines}
+    order_rows = await db.work_orders.aggregate([
+        {"$group": {"_id": {"machine_id": "$machine_id", "status": "$status", "type": "$type", "priority": "$priority"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+
+    deltas = {"global": []}
+    for m in machines:
+        delta = machine_counter_delta(m)
+        deltas["global"].append(delta)
+        if m.get("department_id"):
+            deltas.setdefault(m["department_id"], []).append(delta)
+    for r in order_rows:
+        delta = order_counter_delta(r["_id"], r["count"])
+        deltas["global"].append(delta)
+        dept_id = machine_depts.get(r["_id"].get("machine_id"))
+        if dept_id:
+            deltas.setdefault(dept_id, []).append(delta)
+
+    now = datetime.now(timezone.utc).isoformat()
+    docs = {}
+    for scope, scope_deltas in deltas.items():
+        doc = {"id": scope, "machines": {}, "orders": {}, "updated_at": now, "reconciled_at": now}
+        for key, value in merge_counter_deltas(*scope_deltas).items():
+            target = doc
+            *parents, leaf = key.split(".")
+            for part in parents:
+                target = target.setdefault(part, {})
+            target[leaf] = value
+        docs[scope] = doc
+
+    await db.dashboard_counters.bulk_write([ReplaceOne({"id": scope}, doc, upsert=True) for scope, doc in docs.items()], ordered=False)
+    await db.dashboard_counters.delete_many({"id": {"$nin": list(docs.keys())}})
+    return docs["global"]
+
+async def reconcile_dashboard_counters_periodically():
+    while True:
+        try:
+            await reconcile_dashboard_counters()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error reconciliando contadores del dashboard: {e}")
+        await asyncio.sleep(DASHBOARD_RECONCILE_MINUTES * 60)
+
+def dashboard_stats_from_counters(doc: dict) -> dict:
+    machines = doc.get("machines", {})
+    machine_status = machines.get("status", {})
+    orders = doc.get("orders", {})
+    order_status = orders.get("status", {})
+    order_type = orders.get("type", {})
+    open_priority = orders.get("open_priority", {})
     return {
         "machines": {
-            "total": total_machines,
-            "operational": operational,
-            "in_maintenance": in_maintenance,
-            "out_of_service": out_of_service
+            "total": machines.get("total", 0),
+            "operational": machine_status.get("operativa", 0),
+            "in_maintenance": machine_status.get("en_mantenimiento", 0),
+            "out_of_service": machine_status.get("fuera_de_servicio", 0)
         },
         "orders": {
-            "total": total_orders,
-            "pending": pending,
-            "in_progress": in_progress,
-            "completed": completed,
-            "preventive": preventive,
-            "corrective": corrective,
-            "critical": critical,
-            "high_priority": high
+            "total": orders.get("total", 0),
+            "pending": order_status.get("pendiente", 0),
+            "in_progress": order_status.get("en_progreso", 0),
+            "completed": order_status.get("completada", 0),
+            "preventive": order_type.get("preventivo", 0),
+            "corrective": order_type.get("correctivo", 0),
+            "critical": open_priority.get("critica", 0),
+            "high_priority": open_priority.get("alta", 0)
         }
     }
 
-@api_router.get("/dashboard/recent-orders")
-async def get_recent_orders(limit: int = 5, user: dict = Depends(get_current_user)):
-    orders = await db.work_orders.find({}, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
-    machines = {m["id"]: m["name"] for m in await db.machines.find({}, {"_id": 0}).to_list(1000)}
-    
+async def read_dashboard_stats(department_id: Optional[str] = None) -> dict:
+    scope = department_id or "global"
+    doc = await db.dashboard_counters.find_one({"id": scope}, {"_id": 0})
+    if not doc and not department_id:
+        # Primera ejecución: aún no hay contadores materializados
+        await reconcile_dashboard_counters()
+        doc = await db.dashboard_counters.find_one({"id": scope}, {"_id": 0})
+    return dashboard_stats_from_counters(doc or {})
+
+async def cached_dashboard_stats(department_id: Optional[str] = None) -> dict:
+    return await response_cache.get_or_compute(
+        "dashboard/stats", {"department_id": department_id}, CACHE_TTL_DASHBOARD,
+        ["machines", "work_orders"],
+        lambda: read_dashboard_stats(department_id)
+    )
+
+@api_router.get("/dashboard/stats")
+async def get_dashboard_stats(department_id: Optional[str] = None, user: dict = Depends(get_current_user)):
+    """Estadísticas del dashboard leídas de los contadores materializados (global o por departamento)"""
+    return await cached_dashboard_stats(department_id)
+
+# Las tarjetas del dashboard y el calendario no necesitan adjuntos ni firma
+RECENT_ORDERS_PROJECTION = {"_id": 0, "attachments": 0, "technician_signature": 0, **INTERNAL_FIELDS_PROJECTION}
+CALENDAR_PROJECTION = {"_id": 0, "id": 1, "title": 1, "scheduled_date": 1, "type": 1, "status": 1, "priority": 1, "machine_id": 1}
+
+async def load_machine_names() -> dict:
+    return {m["id"]: m["name"] for m in await db.machines.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(1000)}
+
+async def find_recent_orders(limit: int) -> List[dict]:
+    return await db.work_orders.find({}, RECENT_ORDERS_PROJECTION).sort("created_at", -1).limit(limit).to_list(limit)
+
+async def find_calendar_orders() -> List[dict]:
+    return await db.work_orders.find({"scheduled_date": {"$ne": None}}, CALENDAR_PROJECTION).to_list(1000)
+
+def recent_orders_with_machines(orders: List[dict], machines: dict) -> List[dict]:
     for o in orders:
         o["machine_name"] = machines.get(o["machine_id"], "")
-    
     return orders
 
+def calendar_events_from_orders(orders: List[dict], machines: dict) -> List[dict]:
+    return [{
+        "id": o["id"],
+        "title": o["title"],
+        "date": o["scheduled_date"],
+        "type": o["type"],
+        "status": o["status"],
+        "priority": o["priority"],
+        "machine_name": machines.get(o["machine_id"], "")
+    } for o in orders]
+
+@api_router.get("/dashboard/recent-orders")
+async def get_recent_orders(limit: int = 5, user: dict = Depends(get_current_user)):
+    orders, machines = await asyncio.gather(find_recent_orders(limit), load_machine_names())
+    return recent_orders_with_machines(orders, machines)
+
+@api_router.get("/dashboard/bootstrap")
+async def get_dashboard_bootstrap(request: Request, recent_limit: int = 5, include: str = "", user: dict = Depends(get_current_user)):
+    """Stats y órdenes recientes en una sola petición, con ETag.
+
+    El calendario (hasta 1000 órdenes) solo se carga si se pide con `include=calendar`; en ese caso
+    se lee a la vez que el resto y comparte el mapa de máquinas con las órdenes recientes.
+    """
+    extras = {part.strip() for part in include.split(",") if part.strip()}
+    reads = [cached_dashboard_stats(), load_machine_names(), find_recent_orders(recent_limit)]
+    if "calendar" in extras:
+        reads.append(find_calendar_orders())
+    stats, machines, recent, *calendar_orders = await asyncio.gather(*reads)
+    payload = {
+        "stats": stats,
+        "recent_orders": recent_orders_with_machines(recent, machines)
+    }
+    if calendar_orders:
+        payload["calendar"] = calendar_events_from_orders(calendar_orders[0], machines)
+
+    # El ETag se calcula sobre el cuerpo devuelto: solo cubre las partes incluidas
+    body = json.dumps(payload, default=str, ensure_ascii=False, separators=(",", ":"))
+    etag = f'"{hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # ============== CHECKLIST TEMPLATES ENDPOINTS ==============
 
 @api_router.get("/checklist-templates", response_model=List[ChecklistTemplateResponse])
@@ -1958,154 +3761,243 @@ async def get_default_checklist(user: dict = Depends(get_current_user)):
 
 @api_router.get("/dashboard/calendar")
 async def get_calendar_events(user: dict = Depends(get_current_user)):
-    orders = await db.work_orders.find(
-        {"scheduled_date": {"$ne": None}},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    machines = {m["id"]: m["name"] for m in await db.machines.find({}, {"_id": 0}).to_list(1000)}
-    
-    events = []
-    for o in orders:
-        events.append({
-            "id": o["id"],
-            "title": o["title"],
-            "date": o["scheduled_date"],
-            "type": o["type"],
-            "status": o["status"],
-            "priority": o["priority"],
-            "machine_name": machines.get(o["machine_id"], "")
-        })
-    
-    return events
+    orders, machines = await asyncio.gather(find_calendar_orders(), load_machine_names())
+    return calendar_events_from_orders(orders, machines)
 
 # ============== ANALYTICS ==============
 
-@api_router.get("/analytics/preventive-vs-corrective")
-async def get_preventive_vs_corrective(user: dict = Depends(get_current_user)):
-    """Comparativa mensual de órdenes preventivas vs correctivas"""
-    orders = await db.work_orders.find({}, {"_id": 0, "type": 1, "created_at": 1}).to_list(10000)
-    
-    # Agrupar por mes
-    monthly_data = {}
-    for order in orders:
-        try:
-            date = datetime.fromisoformat(order["created_at"].replace("Z", "+00:00"))
-            month_key = date.strftime("%Y-%m")
-            month_label = date.strftime("%b %Y")
-        except:
-            continue
-        
-        if month_key not in monthly_data:
-            monthly_data[month_key] = {"month": month_label, "preventivo": 0, "correctivo": 0}
-        
-        if order["type"] == "preventivo":
-            monthly_data[month_key]["preventivo"] += 1
+def date_range_filter(date_from: Optional[str] = None, date_to: Optional[str] = None) -> Optional[dict]:
+    """Filtro de rango sobre los campos <campo>_dt (datetime BSON).
+
+    Un date_to con solo fecha ("2024-05-31") incluye el día completo.
+    """
+    if not date_from and not date_to:
+        return None
+    condition = {}
+    if date_from:
+        start = parse_iso_datetime(date_from)
+        if not start:
+            raise HTTPException(status_code=400, detail="date_from no es una fecha válida")
+        condition["$gte"] = start
+    if date_to:
+        end = parse_iso_datetime(date_to)
+        if not end:
+            raise HTTPException(status_code=400, detail="date_to no es una fecha válida")
+        if len(date_to.strip()) == 10:
+            condition["$lt"] = end + timedelta(days=1)
         else:
-            monthly_data[month_key]["correctivo"] += 1
+            condition["$lte"] = end
+    return condition
+
+async def department_machine_ids(department_id: str) -> List[str]:
+    return [m["id"] for m in await db.machines.find({"department_id": department_id}, {"_id": 0, "id": 1}).to_list(None)]
+
+async def machine_scope_filter(department_id: Optional[str] = None, machine_id: Optional[str] = None):
+    """Condición sobre machine_id para los filtros department_id/machine_id de las analíticas (None si no hay filtro)"""
+    if department_id:
+        machine_ids = await department_machine_ids(department_id)
+        if machine_id:
+            return machine_id if machine_id in machine_ids else {"$in": []}
+        return {"$in": machine_ids}
+    return machine_id
+
+async def compute_preventive_vs_corrective(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None
+):
+    """Comparativa mensual de órdenes preventivas vs correctivas (agrupada en Mongo, sin límite de documentos)"""
+    match = {"created_at_dt": {"$type": "date"}}
+    created_range = date_range_filter(date_from, date_to)
+    if created_range:
+        match["created_at_dt"].update(created_range)
+    machine_scope = await machine_scope_filter(department_id, machine_id)
+    if machine_scope:
+        match["machine_id"] = machine_scope
+    
+    # Agrupar por mes (YYYY-MM del created_at, en UTC) y devolver los últimos 12 meses
+    rows = await db.work_orders.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"$dateToString": {"format": "%Y-%m", "date": "$created_at_dt"}},
+            "preventivo": {"$sum": {"$cond": [{"$eq": ["$type", "preventivo"]}, 1, 0]}},
+            "correctivo": {"$sum": {"$cond": [{"$eq": ["$type", "preventivo"]}, 0, 1]}}
+        }},
+        {"$sort": {"_id": -1}},
+        {"$limit": 12}
+    ]).to_list(12)
     
-    # Ordenar por fecha y devolver últimos 12 meses
-    sorted_data = sorted(monthly_data.items(), key=lambda x: x[0])[-12:]
-    return [v for k, v in sorted_data]
+    return [{
+        "month": datetime.strptime(r["_id"], "%Y-%m").strftime("%b %Y"),
+        "preventivo": r["preventivo"],
+        "correctivo": r["correctivo"]
+    } for r in reversed(rows)]
 
-@api_router.get("/analytics/failure-causes")
-async def get_failure_causes(user: dict = Depends(get_current_user)):
-    """Causas de fallo más frecuentes en correctivos"""
-    orders = await db.work_orders.find(
-        {"type": "correctivo", "failure_cause": {"$ne": "", "$exists": True}},
-        {"_id": 0, "failure_cause": 1}
-    ).to_list(10000)
-    
-    # Contar causas
+@api_router.get("/analytics/preventive-vs-corrective")
+async def get_preventive_vs_corrective(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Comparativa mensual de órdenes preventivas vs correctivas"""
+    params = {"date_from": date_from, "date_to": date_to, "department_id": department_id, "machine_id": machine_id}
+    return await response_cache.get_or_compute(
+        "analytics/preventive-vs-corrective", params, CACHE_TTL_ANALYTICS, ["work_orders", "machines"],
+        lambda: compute_preventive_vs_corrective(**params)
+    )
+
+FAILURE_CAUSE_LABELS = {
+    "accidente": "Accidente",
+    "mala_utilizacion": "Mala utilización",
+    "instruccion_no_respetada": "Instrucción no respetada",
+    "mala_intervencion_anterior": "Mala intervención anterior",
+    "fatiga_acumulada": "Fatiga acumulada",
+    "golpe": "Golpe",
+    "diseno_inadecuado": "Diseño inadecuado",
+    "desgaste": "Desgaste",
+    "mal_montaje": "Mal montaje",
+    "corrosion": "Corrosión",
+    "otros": "Otros"
+}
+
+async def compute_failure_causes(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None
+):
+    """Pareto de causas de fallo en correctivos, con porcentaje y porcentaje acumulado"""
+    match = {"type": "correctivo", "failure_cause": {"$nin": ["", None]}}
+    created_range = date_range_filter(date_from, date_to)
+    if created_range:
+        match["created_at_dt"] = created_range
+    machine_scope = await machine_scope_filter(department_id, machine_id)
+    if machine_scope:
+        match["machine_id"] = machine_scope
+    
+    rows = await db.work_orders.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$failure_cause", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}}
+    ]).to_list(None)
+    
+    # Varias claves pueden compartir etiqueta: se agregan tras traducirlas
     cause_counts = {}
-    cause_labels = {
-        "accidente": "Accidente",
-        "mala_utilizacion": "Mala utilización",
-        "instruccion_no_respetada": "Instrucción no respetada",
-        "mala_intervencion_anterior": "Mala intervención anterior",
-        "fatiga_acumulada": "Fatiga acumulada",
-        "golpe": "Golpe",
-        "diseno_inadecuado": "Diseño inadecuado",
-        "desgaste": "Desgaste",
-        "mal_montaje": "Mal montaje",
-        "corrosion": "Corrosión",
-        "otros": "Otros"
-    }
-    
-    for order in orders:
-        cause = order.get("failure_cause", "")
-        if cause:
-            label = cause_labels.get(cause, cause)
-            cause_counts[label] = cause_counts.get(label, 0) + 1
+    for r in rows:
+        label = FAILURE_CAUSE_LABELS.get(r["_id"], r["_id"])
+        cause_counts[label] = cause_counts.get(label, 0) + r["count"]
     
-    # Convertir a lista ordenada
-    result = [{"causa": k, "cantidad": v} for k, v in cause_counts.items()]
-    result.sort(key=lambda x: x["cantidad"], reverse=True)
+    total = sum(cause_counts.values())
+    result = []
+    cumulative = 0
+    for label, count in sorted(cause_counts.items(), key=lambda x: (-x[1], x[0])):
+        cumulative += count
+        result.append({
+            "causa": label,
+            "cantidad": count,
+            "porcentaje": round(count / total * 100, 1),
+            "porcentaje_acumulado": round(cumulative / total * 100, 1)
+        })
     return result
 
-@api_router.get("/analytics/recurring-correctives")
-async def get_recurring_correctives(user: dict = Depends(get_current_user)):
-    """Correctivos más repetidos por máquina basándose en la descripción de la avería"""
-    # Get all corrective orders with description
-    orders = await db.work_orders.find(
-        {"type": "correctivo"},
-        {"_id": 0, "machine_id": 1, "title": 1, "description": 1, "failure_cause": 1, "created_at": 1}
-    ).to_list(10000)
+@api_router.get("/analytics/failure-causes")
+async def get_failure_causes(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Causas de fallo más frecuentes en correctivos (Pareto)"""
+    params = {"date_from": date_from, "date_to": date_to, "department_id": department_id, "machine_id": machine_id}
+    return await response_cache.get_or_compute(
+        "analytics/failure-causes", params, CACHE_TTL_ANALYTICS, ["work_orders", "machines"],
+        lambda: compute_failure_causes(**params)
+    )
+
+def cluster_issue_groups(groups: List[dict]) -> List[List[dict]]:
+    """Agrupa huellas casi idénticas de una máquina: candidatos por banda LSH, confirmados por Jaccard"""
+    parent = list(range(len(groups)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    token_sets = [set(g["_id"]["fingerprint"].split()) for g in groups]
+    buckets = {}
+    for i, g in enumerate(groups):
+        for band in g.get("lsh") or []:
+            buckets.setdefault(band, []).append(i)
+    for members in buckets.values():
+        for x, i in enumerate(members):
+            for j in members[x + 1:]:
+                a, b = find(i), find(j)
+                if a == b:
+                    continue
+                union = token_sets[i] | token_sets[j]
+                if union and len(token_sets[i] & token_sets[j]) / len(union) >= ISSUE_SIMILARITY_THRESHOLD:
+                    parent[b] = a
+
+    clusters = {}
+    for i, g in enumerate(groups):
+        clusters.setdefault(find(i), []).append(g)
+    return list(clusters.values())
+
+async def compute_recurring_correctives(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None
+):
+    """Correctivos más repetidos por máquina basándose en la huella de la avería"""
+    if await db.work_orders.find_one(ISSUE_FINGERPRINT_STALE, {"_id": 0, "id": 1}):
+        await backfill_issue_fingerprints()
+    
+    match = {"type": "correctivo", "machine_id": {"$nin": ["", None]}}
+    created_range = date_range_filter(date_from, date_to)
+    if created_range:
+        match["created_at_dt"] = created_range
+    machine_scope = await machine_scope_filter(department_id, machine_id)
+    if machine_scope:
+        match["machine_id"] = machine_scope
+    
+    # Agrupación por (máquina, huella) servida por el índice (type, machine_id, issue_fingerprint)
+    # o, con ventana de fechas, por (type, machine_id, created_at_dt) / (type, created_at_dt)
+    groups = await db.work_orders.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"machine_id": "$machine_id", "fingerprint": "$issue_fingerprint"},
+            "count": {"$sum": 1},
+            "title": {"$first": "$title"},
+            "description": {"$first": "$description"},
+            "failure_cause": {"$first": "$failure_cause"},
+            "lsh": {"$first": "$issue_lsh"},
+            "first_occurrence": {"$min": "$created_at"},
+            "last_occurrence": {"$max": "$created_at"}
+        }}
+    ]).to_list(None)
     
     # Get machines and departments
-    machines = {m["id"]: m for m in await db.machines.find({}, {"_id": 0}).to_list(1000)}
+    machines = {m["id"]: m for m in await db.machines.find({}, {"_id": 0, "id": 1, "name": 1, "department_id": 1}).to_list(None)}
     departments = {d["id"]: d["name"] for d in await db.departments.find({}, {"_id": 0}).to_list(1000)}
     
-    # Group by machine and analyze descriptions
-    machine_issues = {}  # {machine_id: {issue_key: {count, descriptions, titles}}}
-    
-    for order in orders:
-        machine_id = order.get("machine_id")
-        if not machine_id:
-            continue
-            
-        machine = machines.get(machine_id, {})
-        machine_name = machine.get("name", "Desconocida")
-        dept_name = departments.get(machine.get("department_id", ""), "")
-        
-        if machine_id not in machine_issues:
-            machine_issues[machine_id] = {
-                "machine_name": machine_name,
-                "department_name": dept_name,
-                "issues": {}
-            }
-        
-        # Create issue key from description (simplified - first 50 chars lowercase)
-        description = order.get("description", "").strip()
-        title = order.get("title", "").strip()
-        
-        # Use title as primary grouping if description is empty
-        issue_text = description if description else title
-        if not issue_text:
-            continue
-            
-        # Normalize for grouping (lowercase, remove extra spaces)
-        issue_key = " ".join(issue_text.lower().split())[:100]
-        
-        if issue_key not in machine_issues[machine_id]["issues"]:
-            machine_issues[machine_id]["issues"][issue_key] = {
-                "count": 0,
-                "sample_title": title,
-                "sample_description": description[:200] if description else "",
-                "failure_cause": order.get("failure_cause", ""),
-                "dates": []
-            }
-        
-        machine_issues[machine_id]["issues"][issue_key]["count"] += 1
-        if order.get("created_at"):
-            machine_issues[machine_id]["issues"][issue_key]["dates"].append(order["created_at"])
+    machine_groups = {}
+    for g in groups:
+        machine_groups.setdefault(g["_id"]["machine_id"], [])
+        if g["_id"]["fingerprint"]:
+            machine_groups[g["_id"]["machine_id"]].append(g)
     
     # Build result - only include machines with recurring issues (count > 1)
     result = {
         "machines_with_recurring": [],
         "top_recurring_issues": [],
         "summary": {
-            "total_machines_analyzed": len(machine_issues),
+            "total_machines_analyzed": len(machine_groups),
             "machines_with_recurring_issues": 0,
             "total_recurring_issues": 0
         }
@@ -2113,31 +4005,43 @@ async def get_recurring_correctives(user: dict = Depends(get_current_user)):
     
     all_issues = []
     
-    for machine_id, data in machine_issues.items():
+    for machine_id, fingerprint_groups in machine_groups.items():
+        machine = machines.get(machine_id, {})
+        machine_name = machine.get("name", "Desconocida")
+        dept_name = departments.get(machine.get("department_id", ""), "")
+        
         recurring = []
-        for issue_key, issue_data in data["issues"].items():
-            if issue_data["count"] > 1:  # Only recurring (more than once)
-                recurring.append({
-                    "description": issue_data["sample_description"] or issue_data["sample_title"],
-                    "title": issue_data["sample_title"],
-                    "count": issue_data["count"],
-                    "failure_cause": issue_data["failure_cause"],
-                    "first_occurrence": min(issue_data["dates"]) if issue_data["dates"] else None,
-                    "last_occurrence": max(issue_data["dates"]) if issue_data["dates"] else None
-                })
-                all_issues.append({
-                    "machine_name": data["machine_name"],
-                    "department_name": data["department_name"],
-                    "description": issue_data["sample_description"] or issue_data["sample_title"],
-                    "count": issue_data["count"]
-                })
+        for cluster in cluster_issue_groups(fingerprint_groups):
+            count = sum(g["count"] for g in cluster)
+            if count <= 1:  # Only recurring (more than once)
+                continue
+            main = max(cluster, key=lambda g: g["count"])
+            title = (main.get("title") or "").strip()
+            description = (main.get("description") or "").strip()[:200]
+            first_dates = [g["first_occurrence"] for g in cluster if g.get("first_occurrence")]
+            last_dates = [g["last_occurrence"] for g in cluster if g.get("last_occurrence")]
+            recurring.append({
+                "description": description or title,
+                "title": title,
+                "count": count,
+                "variants": len(cluster),
+                "failure_cause": main.get("failure_cause", ""),
+                "first_occurrence": min(first_dates) if first_dates else None,
+                "last_occurrence": max(last_dates) if last_dates else None
+            })
+            all_issues.append({
+                "machine_name": machine_name,
+                "department_name": dept_name,
+                "description": description or title,
+                "count": count
+            })
         
         if recurring:
             recurring.sort(key=lambda x: x["count"], reverse=True)
             result["machines_with_recurring"].append({
                 "machine_id": machine_id,
-                "machine_name": data["machine_name"],
-                "department_name": data["department_name"],
+                "machine_name": machine_name,
+                "department_name": dept_name,
                 "recurring_issues": recurring[:5],  # Top 5 per machine
                 "total_recurring": len(recurring)
             })
@@ -2153,81 +4057,85 @@ async def get_recurring_correctives(user: dict = Depends(get_current_user)):
     
     return result
 
-@api_router.get("/analytics/preventive-compliance")
-async def get_preventive_compliance(user: dict = Depends(get_current_user)):
-    """Cumplimiento de preventivos: a tiempo vs atrasados"""
-    orders = await db.work_orders.find(
-        {"type": "preventivo"},
-        {"_id": 0, "status": 1, "scheduled_date": 1, "completed_date": 1, "created_at": 1}
-    ).to_list(10000)
-    
+@api_router.get("/analytics/recurring-correctives")
+async def get_recurring_correctives(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    fresh: bool = False,
+    user: dict = Depends(get_current_user)
+):
+    """Correctivos más repetidos por máquina basándose en la huella de la avería (fresh=true ignora el precálculo)"""
+    params = {"date_from": date_from, "date_to": date_to, "department_id": department_id, "machine_id": machine_id}
+    if not fresh:
+        snapshot = await read_analytics_snapshot("analytics/recurring-correctives", params)
+        if snapshot is not None:
+            return snapshot
+    return await response_cache.get_or_compute(
+        "analytics/recurring-correctives", params, CACHE_TTL_ANALYTICS, ["work_orders", "machines", "departments"],
+        lambda: compute_recurring_correctives(**params)
+    )
+
+async def compute_preventive_compliance(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None
+):
+    """Cumplimiento de preventivos: a tiempo vs atrasados (clasificado y agrupado en Mongo).
+
+    La ventana de fechas se aplica sobre la fecha programada: con ventana, las órdenes sin fecha quedan fuera.
+    """
     now = datetime.now(timezone.utc)
+    match = {"type": "preventivo"}
+    scheduled_range = date_range_filter(date_from, date_to)
+    if scheduled_range:
+        match["scheduled_date_dt"] = scheduled_range
+    machine_scope = await machine_scope_filter(department_id, machine_id)
+    if machine_scope:
+        match["machine_id"] = machine_scope
+    has_scheduled = {"$eq": [{"$type": "$scheduled_date_dt"}, "date"]}
+    completed_late = {"$and": [
+        {"$eq": [{"$type": "$completed_date_dt"}, "date"]},
+        {"$gt": ["$completed_date_dt", "$scheduled_date_dt"]}
+    ]}
+    
+    # Una fila por (mes programado, estado de cumplimiento)
+    rows = await db.work_orders.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {
+                "month": {"$cond": [has_scheduled, {"$dateToString": {"format": "%Y-%m", "date": "$scheduled_date_dt"}}, None]},
+                "bucket": {"$switch": {
+                    "branches": [
+                        {"case": {"$not": [has_scheduled]}, "then": "no_date"},
+                        {"case": {"$eq": ["$status", "completada"]}, "then": {"$cond": [completed_late, "completed_late", "completed_on_time"]}},
+                        {"case": {"$lt": ["$scheduled_date_dt", now]}, "then": "pending_late"}
+                    ],
+                    "default": "pending_on_time"
+                }}
+            },
+            "count": {"$sum": 1}
+        }}
+    ]).to_list(None)
     
-    # Contadores generales
-    total = len(orders)
-    completed_on_time = 0
-    completed_late = 0
-    pending_on_time = 0
-    pending_late = 0
-    no_date = 0
-    
-    # Datos mensuales para gráfica de tendencia
+    counts = {"completed_on_time": 0, "completed_late": 0, "pending_on_time": 0, "pending_late": 0, "no_date": 0}
     monthly_data = {}
-    
-    for order in orders:
-        scheduled = order.get("scheduled_date")
-        completed = order.get("completed_date")
-        status = order.get("status", "pendiente")
-        
-        if not scheduled:
-            no_date += 1
-            continue
-        
-        try:
-            scheduled_str = scheduled.replace("Z", "+00:00")
-            if "+" not in scheduled_str and "T" in scheduled_str:
-                scheduled_str = scheduled_str + "+00:00"
-            elif "T" not in scheduled_str:
-                scheduled_str = scheduled_str + "T00:00:00+00:00"
-            scheduled_dt = datetime.fromisoformat(scheduled_str)
-            if scheduled_dt.tzinfo is None:
-                scheduled_dt = scheduled_dt.replace(tzinfo=timezone.utc)
-            month_key = scheduled_dt.strftime("%Y-%m")
-            month_label = scheduled_dt.strftime("%b %Y")
-        except:
-            no_date += 1
+    for r in rows:
+        bucket = r["_id"]["bucket"]
+        counts[bucket] += r["count"]
+        month_key = r["_id"]["month"]
+        if not month_key:
             continue
-        
         if month_key not in monthly_data:
-            monthly_data[month_key] = {"month": month_label, "a_tiempo": 0, "atrasado": 0}
-        
-        if status == "completada":
-            if completed:
-                try:
-                    completed_dt = datetime.fromisoformat(completed.replace("Z", "+00:00"))
-                    if completed_dt <= scheduled_dt:
-                        completed_on_time += 1
-                        monthly_data[month_key]["a_tiempo"] += 1
-                    else:
-                        completed_late += 1
-                        monthly_data[month_key]["atrasado"] += 1
-                except:
-                    completed_on_time += 1
-                    monthly_data[month_key]["a_tiempo"] += 1
-            else:
-                completed_on_time += 1
-                monthly_data[month_key]["a_tiempo"] += 1
-        else:
-            if scheduled_dt < now:
-                pending_late += 1
-                monthly_data[month_key]["atrasado"] += 1
-            else:
-                pending_on_time += 1
-                monthly_data[month_key]["a_tiempo"] += 1
+            monthly_data[month_key] = {"month": datetime.strptime(month_key, "%Y-%m").strftime("%b %Y"), "a_tiempo": 0, "atrasado": 0}
+        monthly_data[month_key]["atrasado" if bucket.endswith("_late") else "a_tiempo"] += r["count"]
     
     # Calcular porcentaje de cumplimiento
-    total_with_date = total - no_date
-    on_time_total = completed_on_time + pending_on_time
+    total = sum(counts.values())
+    total_with_date = total - counts["no_date"]
+    on_time_total = counts["completed_on_time"] + counts["pending_on_time"]
     compliance_rate = round((on_time_total / total_with_date * 100), 1) if total_with_date > 0 else 0
     
     # Ordenar datos mensuales
@@ -2236,105 +4144,177 @@ async def get_preventive_compliance(user: dict = Depends(get_current_user)):
     return {
         "summary": {
             "total": total,
-            "completed_on_time": completed_on_time,
-            "completed_late": completed_late,
-            "pending_on_time": pending_on_time,
-            "pending_late": pending_late,
+            "completed_on_time": counts["completed_on_time"],
+            "completed_late": counts["completed_late"],
+            "pending_on_time": counts["pending_on_time"],
+            "pending_late": counts["pending_late"],
             "compliance_rate": compliance_rate
         },
         "pie_data": [
             {"name": "A tiempo", "value": on_time_total, "color": "#22c55e"},
-            {"name": "Atrasado", "value": completed_late + pending_late, "color": "#ef4444"}
+            {"name": "Atrasado", "value": counts["completed_late"] + counts["pending_late"], "color": "#ef4444"}
         ],
         "monthly": [v for k, v in sorted_monthly]
     }
 
-@api_router.get("/analytics/stops")
-async def get_stops_analytics(user: dict = Depends(get_current_user)):
-    """Análisis de paradas por tipo"""
-    stops = await db.stops.find({}, {"_id": 0}).to_list(10000)
-    
-    type_labels = {
-        "averia": "Avería",
-        "calidad": "Calidad",
-        "falta_medios": "Falta de medios",
-        "mantenimiento": "Mantenimiento",
-        "cambio_formato": "Cambio de formato",
-        "otros": "Otros"
-    }
+@api_router.get("/analytics/preventive-compliance")
+async def get_preventive_compliance(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    fresh: bool = False,
+    user: dict = Depends(get_current_user)
+):
+    """Cumplimiento de preventivos: a tiempo vs atrasados (fresh=true ignora el precálculo)"""
+    params = {"date_from": date_from, "date_to": date_to, "department_id": department_id, "machine_id": machine_id}
+    if not fresh:
+        snapshot = await read_analytics_snapshot("analytics/preventive-compliance", params)
+        if snapshot is not None:
+            return snapshot
+    return await response_cache.get_or_compute(
+        "analytics/preventive-compliance", params, CACHE_TTL_ANALYTICS, ["work_orders", "machines"],
+        lambda: compute_preventive_compliance(**params)
+    )
+
+STOP_TYPE_LABELS = {
+    "averia": "Avería",
+    "calidad": "Calidad",
+    "falta_medios": "Falta de medios",
+    "mantenimiento": "Mantenimiento",
+    "cambio_formato": "Cambio de formato",
+    "produccion": "Producción",
+    "otros": "Otros"
+}
+
+def day_range_filter(date_from: Optional[str] = None, date_to: Optional[str] = None) -> Optional[dict]:
+    """Filtro de rango sobre campos de día "YYYY-MM-DD" (UTC); ambos extremos incluidos"""
+    condition = date_range_filter(date_from, date_to)
+    if not condition:
+        return None
+    days = {}
+    if "$gte" in condition:
+        days["$gte"] = condition["$gte"].strftime("%Y-%m-%d")
+    if "$lt" in condition:
+        days["$lt"] = condition["$lt"].strftime("%Y-%m-%d")
+    if "$lte" in condition:
+        days["$lte"] = condition["$lte"].strftime("%Y-%m-%d")
+    return days
+
+async def compute_stops_analytics(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None
+):
+    """Análisis de paradas por tipo, leído de stop_rollups"""
+    match = {}
+    days = day_range_filter(date_from, date_to)
+    if days:
+        match["day"] = days
+    if department_id:
+        match["department_id"] = department_id
+    if machine_id:
+        match["machine_id"] = machine_id
     
-    # Contar por tipo
+    facets = await db.stop_rollups.aggregate([
+        {"$match": match},
+        {"$facet": {
+            "by_type": [
+                {"$group": {"_id": "$stop_type", "count": {"$sum": "$count"}, "duration": {"$sum": "$minutes"}}}
+            ],
+            # $isoDayOfWeek: 1 = lunes ... 7 = domingo
+            "by_day": [
+                {"$match": {"day": {"$ne": None}}},
+                {"$group": {"_id": {"$isoDayOfWeek": {"$dateFromString": {"dateString": "$day", "format": "%Y-%m-%d"}}}, "count": {"$sum": "$count"}}}
+            ]
+        }}
+    ]).to_list(1)
+    facets = facets[0] if facets else {"by_type": [], "by_day": []}
+    
+    # Por tipo (cantidad) y por duración
     type_counts = {}
-    total_duration = 0
     type_duration = {}
+    for r in facets["by_type"]:
+        if r["count"] <= 0:
+            continue
+        label = STOP_TYPE_LABELS.get(r["_id"], r["_id"])
+        type_counts[label] = type_counts.get(label, 0) + r["count"]
+        type_duration[label] = type_duration.get(label, 0) + r["duration"]
+    total = sum(type_counts.values())
+    total_duration = sum(type_duration.values())
     
-    for stop in stops:
-        stop_type = stop.get("stop_type", "otros")
-        label = type_labels.get(stop_type, stop_type)
-        type_counts[label] = type_counts.get(label, 0) + 1
-        
-        duration = stop.get("duration_minutes", 0) or 0
-        total_duration += duration
-        type_duration[label] = type_duration.get(label, 0) + duration
-    
-    # Por tipo (cantidad)
     by_type = [{"tipo": k, "cantidad": v} for k, v in type_counts.items()]
     by_type.sort(key=lambda x: x["cantidad"], reverse=True)
     
-    # Por duración
     by_duration = [{"tipo": k, "minutos": v, "horas": round(v/60, 1)} for k, v in type_duration.items()]
     by_duration.sort(key=lambda x: x["minutos"], reverse=True)
     
     # Por día de la semana
-    daily_data = {i: 0 for i in range(7)}
     day_names = ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"]
-    
-    for stop in stops:
-        try:
-            start_str = stop.get("start_time", "")
-            if start_str:
-                start_dt = datetime.fromisoformat(start_str.replace("Z", "+00:00"))
-                daily_data[start_dt.weekday()] += 1
-        except:
-            pass
-    
-    by_day = [{"dia": day_names[i], "cantidad": daily_data[i]} for i in range(7)]
+    daily_data = {r["_id"] - 1: r["count"] for r in facets["by_day"]}
+    by_day = [{"dia": day_names[i], "cantidad": daily_data.get(i, 0)} for i in range(7)]
     
     return {
-        "total": len(stops),
+        "total": total,
         "total_duration_hours": round(total_duration / 60, 1),
         "by_type": by_type,
         "by_duration": by_duration,
         "by_day": by_day
     }
 
-@api_router.get("/analytics/line-starts")
-async def get_line_starts_analytics(user: dict = Depends(get_current_user)):
-    """Análisis de cumplimiento de arranque de líneas"""
-    starts = await db.line_starts.find({}, {"_id": 0}).to_list(10000)
+@api_router.get("/analytics/stops")
+async def get_stops_analytics(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Análisis de paradas por tipo"""
+    params = {"date_from": date_from, "date_to": date_to, "department_id": department_id, "machine_id": machine_id}
+    return await response_cache.get_or_compute(
+        "analytics/stops", params, CACHE_TTL_ANALYTICS, ["stops"],
+        lambda: compute_stops_analytics(**params)
+    )
+
+async def compute_line_starts_analytics(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    line_id: Optional[str] = None
+):
+    """Análisis de cumplimiento de arranque de líneas (desde line_start_rollups)"""
+    query = {}
+    dates = date_string_filter(date_from, date_to)
+    if dates:
+        query["date"] = dates
+    if department_id:
+        query["department_id"] = department_id
+    if line_id:
+        query["line_id"] = line_id
+    rows = await db.line_start_rollups.find(query, {"_id": 0}).sort("first_created_at", 1).to_list(None)
     lines = {l["id"]: l for l in await db.lines.find({}, {"_id": 0}).to_list(1000)}
     
-    total = len(starts)
-    on_time_count = sum(1 for s in starts if s.get("on_time", False))
+    total = sum(r["total"] for r in rows)
+    on_time_count = sum(r["on_time"] for r in rows)
     late_count = total - on_time_count
     compliance_rate = round((on_time_count / total * 100), 1) if total > 0 else 0
     
-    # Por línea
+    # Por línea y por motivo de retraso
     line_stats = {}
-    for s in starts:
-        line_id = s.get("line_id")
-        line = lines.get(line_id, {})
-        line_name = line.get("name", "Desconocida")
-        
+    delay_reasons = {}
+    for r in rows:
+        line_name = lines.get(r["line_id"], {}).get("name", "Desconocida")
         if line_name not in line_stats:
             line_stats[line_name] = {"total": 0, "on_time": 0, "late": 0, "total_delay": 0}
+        line_stats[line_name]["total"] += r["total"]
+        line_stats[line_name]["on_time"] += r["on_time"]
+        line_stats[line_name]["late"] += r["total"] - r["on_time"]
+        line_stats[line_name]["total_delay"] += r["delay_minutes"]
         
-        line_stats[line_name]["total"] += 1
-        if s.get("on_time", False):
-            line_stats[line_name]["on_time"] += 1
-        else:
-            line_stats[line_name]["late"] += 1
-            line_stats[line_name]["total_delay"] += s.get("delay_minutes", 0) or 0
+        if r["delay_reason"]:
+            delay_reasons[r["delay_reason"]] = delay_reasons.get(r["delay_reason"], 0) + r["total"]
     
     by_line = []
     for name, stats in line_stats.items():
@@ -2350,24 +4330,25 @@ async def get_line_starts_analytics(user: dict = Depends(get_current_user)):
     
     by_line.sort(key=lambda x: x["cumplimiento"], reverse=True)
     
-    # Por motivo de retraso
-    delay_reasons = {}
-    for s in starts:
-        reason = s.get("delay_reason")
-        if reason and not s.get("on_time", True):
-            delay_reasons[reason] = delay_reasons.get(reason, 0) + 1
-    
     by_reason = [{"motivo": k, "cantidad": v} for k, v in delay_reasons.items()]
     by_reason.sort(key=lambda x: x["cantidad"], reverse=True)
     
-    # Tendencia diaria (últimos 30 registros)
-    daily_trend = []
-    for s in sorted(starts, key=lambda x: x.get("date", ""))[-30:]:
-        daily_trend.append({
-            "fecha": s.get("date", ""),
-            "retraso": s.get("delay_minutes", 0) or 0,
-            "a_tiempo": 1 if s.get("on_time", False) else 0
-        })
+    # Tendencia diaria (últimos 30 registros): se leen directamente de line_starts
+    trend_query = {}
+    if dates:
+        trend_query["date"] = dates
+    if department_id:
+        trend_query["line_id"] = {"$in": [l["id"] for l in lines.values() if l.get("department_id") == department_id and (not line_id or l["id"] == line_id)]}
+    elif line_id:
+        trend_query["line_id"] = line_id
+    latest = await db.line_starts.find(
+        trend_query, {"_id": 0, "date": 1, "delay_minutes": 1, "on_time": 1}
+    ).sort([("date", -1), ("_id", -1)]).limit(30).to_list(30)
+    daily_trend = [{
+        "fecha": s.get("date", ""),
+        "retraso": s.get("delay_minutes", 0) or 0,
+        "a_tiempo": 1 if s.get("on_time", False) else 0
+    } for s in reversed(latest)]
     
     return {
         "summary": {
@@ -2385,6 +4366,679 @@ async def get_line_starts_analytics(user: dict = Depends(get_current_user)):
         "daily_trend": daily_trend
     }
 
+@api_router.get("/analytics/line-starts")
+async def get_line_starts_analytics(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    line_id: Optional[str] = None,
+    fresh: bool = False,
+    user: dict = Depends(get_current_user)
+):
+    """Análisis de cumplimiento de arranque de líneas (los arranques son por línea: line_id en lugar de machine_id).
+
+    fresh=true ignora el precálculo nocturno.
+    """
+    params = {"date_from": date_from, "date_to": date_to, "department_id": department_id, "line_id": line_id}
+    if not fresh:
+        snapshot = await read_analytics_snapshot("analytics/line-starts", params)
+        if snapshot is not None:
+            return snapshot
+    return await response_cache.get_or_compute(
+        "analytics/line-starts", params, CACHE_TTL_ANALYTICS, ["line_starts", "lines"],
+        lambda: compute_line_starts_analytics(**params)
+    )
+
+# ============== ANALYTICS SNAPSHOTS ==============
+# Precálculo nocturno de las analíticas que solo cambian de forma apreciable una vez al día. Se guarda un
+# payload por endpoint, departamento (o todos) y periodo: "all" (sin ventana) o un mes completo ("YYYY-MM").
+# Los endpoints sirven el precálculo cuando la petición coincide exactamente con uno de esos periodos.
+
+def month_window(month: str):
+    """(date_from, date_to) del mes "YYYY-MM", con los días primero y último incluidos"""
+    start = datetime.strptime(month, "%Y-%m")
+    end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+def analytics_snapshot_period(date_from: Optional[str] = None, date_to: Optional[str] = None) -> Optional[str]:
+    """Periodo precalculado que corresponde a la ventana pedida, o None si no hay ninguno"""
+    if not date_from and not date_to:
+        return "all"
+    if not date_from or not date_to:
+        return None
+    try:
+        return date_from[:7] if month_window(date_from[:7]) == (date_from, date_to) else None
+    except ValueError:
+        return None
+
+def recent_months(count: int) -> List[str]:
+    month = datetime.now(timezone.utc).replace(day=1)
+    months = []
+    for _ in range(count):
+        months.append(month.strftime("%Y-%m"))
+        month = (month - timedelta(days=1)).replace(day=1)
+    return months
+
+async def read_analytics_snapshot(endpoint: str, params: dict) -> Optional[dict]:
+    """Último precálculo para la petición (sin filtro de máquina o línea), o None para calcular en vivo"""
+    if params.get("machine_id") or params.get("line_id"):
+        return None
+    period = analytics_snapshot_period(params.get("date_from"), params.get("date_to"))
+    if not period:
+        return None
+    doc = await db.analytics_snapshots.find_one(
+        {"endpoint": endpoint, "department_id": params.get("department_id"), "period": period},
+        {"_id": 0, "payload": 1}
+    )
+    return doc["payload"] if doc else None
+
+async def precompute_analytics_snapshots(months: int = ANALYTICS_SNAPSHOT_MONTHS, endpoints: Optional[List[str]] = None) -> int:
+    """Calcula y guarda los payloads de cada endpoint (o solo de `endpoints`) por departamento y por mes
+    (más el histórico completo)"""
+    jobs = {
+        "analytics/preventive-compliance": compute_preventive_compliance,
+        "analytics/recurring-correctives": compute_recurring_correctives,
+        "analytics/line-starts": compute_line_starts_analytics
+    }
+    if endpoints:
+        jobs = {endpoint: compute for endpoint, compute in jobs.items() if endpoint in endpoints}
+    departments = [None] + [d["id"] for d in await db.departments.find({}, {"_id": 0, "id": 1}).to_list(None)]
+    periods = ["all"] + recent_months(months)
+    stored = 0
+    for endpoint, compute in jobs.items():
+        ops = []
+        for department_id in departments:
+            for period in periods:
+                date_from, date_to = month_window(period) if period != "all" else (None, None)
+                payload = await compute(date_from=date_from, date_to=date_to, department_id=department_id)
+                key = {"endpoint": endpoint, "department_id": department_id, "period": period}
+                ops.append(ReplaceOne(key, {**key, "payload": payload, "computed_at": datetime.now(timezone.utc).isoformat()}, upsert=True))
+        await db.analytics_snapshots.bulk_write(ops, ordered=False)
+        stored += len(ops)
+    logger.info(f"Analíticas precalculadas: {stored} payloads ({len(departments)} ámbitos x {len(periods)} periodos)")
+    return stored
+
+async def precompute_analytics_snapshots_nightly():
+    """Lanza el precálculo cada día a ANALYTICS_SNAPSHOT_HOUR (UTC).
+
+    Con varios workers solo uno lo ejecuta: el primero que registra la fecha en migrations.
+    """
+    while True:
+        await asyncio.sleep(seconds_until_utc_hour(ANALYTICS_SNAPSHOT_HOUR))
+        date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        try:
+            await db.migrations.insert_one({"id": f"analytics_snapshots:{date}", "created_at": datetime.now(timezone.utc).isoformat()})
+            await precompute_analytics_snapshots()
+        except asyncio.CancelledError:
+            raise
+        except DuplicateKeyError:
+            pass
+        except Exception as e:
+            logger.error(f"Error precalculando analíticas: {e}")
+
+# ============== RELIABILITY (MTBF / MTTR) ==============
+# Fallos = paradas de tipo "averia" que empiezan dentro de la ventana. Por máquina:
+#   MTBF = (horas de la ventana - horas paradas por avería) / nº de fallos
+#   MTTR = media de (end_time - start_time) de las averías cerradas
+# Para correctivos se da además el tiempo medio de resolución (closed_date - created_at).
+
+RELIABILITY_DEFAULT_DAYS = 365
+
+def analytics_window(date_from: Optional[str] = None, date_to: Optional[str] = None, default_days: int = RELIABILITY_DEFAULT_DAYS):
+    """Ventana [inicio, fin) en UTC; por defecto los últimos default_days días"""
+    condition = date_range_filter(date_from, date_to) or {}
+    end = condition.get("$lt") or condition.get("$lte") or datetime.now(timezone.utc)
+    start = condition.get("$gte") or end - timedelta(days=default_days)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="date_from debe ser anterior a date_to")
+    return start, end
+
+def hours_or_none(value) -> Optional[float]:
+    return None if value is None or pd.isna(value) or np.isinf(value) else round(float(value), 2)
+
+def reliability_ratios(frame: pd.DataFrame, window_hours: float) -> pd.DataFrame:
+    """Añade MTBF, MTTR, tasa de fallos y tiempo medio de resolución a un frame de sumas"""
+    operating = (frame["machines"] * window_hours - frame["downtime_h"]).clip(lower=0)
+    failures = frame["failures"].replace(0, np.nan)
+    return frame.assign(
+        operating_h=operating,
+        mtbf_h=operating / failures,
+        mttr_h=frame["repair_sum_h"] / frame["repair_n"].replace(0, np.nan),
+        failure_rate=frame["failures"] / operating.replace(0, np.nan) * 1000,
+        order_ttr_h=frame["order_ttr_sum_h"] / frame["order_ttr_n"].replace(0, np.nan)
+    )
+
+def reliability_row(row) -> dict:
+    return {
+        "fallos": int(row.failures),
+        "horas_parada": hours_or_none(row.downtime_h),
+        "mtbf_horas": hours_or_none(row.mtbf_h),
+        "mttr_horas": hours_or_none(row.mttr_h),
+        "fallos_por_1000h": hours_or_none(row.failure_rate),
+        "correctivos": int(row.orders),
+        "tiempo_resolucion_correctivos_horas": hours_or_none(row.order_ttr_h)
+    }
+
+def reliability_stats(machines: List[dict], departments: dict, stops: List[dict], orders: List[dict], start: datetime, end: datetime) -> dict:
+    """Cálculo vectorizado (pandas) de MTBF/MTTR por máquina, departamento y mes"""
+    start_ts, end_ts = pd.Timestamp(start), pd.Timestamp(end)
+    window_hours = (end_ts - start_ts).total_seconds() / 3600
+    machine_df = pd.DataFrame(machines, columns=["id", "name", "department_id"]).set_index("id")
+    
+    stop_df = pd.DataFrame(stops, columns=["machine_id", "start_time_dt", "end_time_dt"])
+    stop_df = stop_df[stop_df["machine_id"].isin(machine_df.index)]
+    stop_start = pd.to_datetime(stop_df["start_time_dt"], utc=True)
+    stop_end = pd.to_datetime(stop_df["end_time_dt"], utc=True)
+    repair_h = (stop_end - stop_start).dt.total_seconds() / 3600
+    # Las averías abiertas cuentan como parada hasta el final de la ventana
+    downtime_h = (stop_end.fillna(end_ts).clip(upper=end_ts) - stop_start).dt.total_seconds().clip(lower=0) / 3600
+    stop_df = stop_df.assign(repair_h=repair_h.where(repair_h >= 0), downtime_h=downtime_h, month=stop_start.values.astype("datetime64[M]"))
+    
+    order_df = pd.DataFrame(orders, columns=["machine_id", "created_at_dt", "closed_date_dt"])
+    order_df = order_df[order_df["machine_id"].isin(machine_df.index)]
+    order_created = pd.to_datetime(order_df["created_at_dt"], utc=True)
+    ttr_h = (pd.to_datetime(order_df["closed_date_dt"], utc=True) - order_created).dt.total_seconds() / 3600
+    order_df = order_df.assign(ttr_h=ttr_h.where(ttr_h >= 0), month=order_created.values.astype("datetime64[M]"))
+    
+    stop_sums = stop_df.groupby("machine_id").agg(
+        failures=("downtime_h", "size"), downtime_h=("downtime_h", "sum"),
+        repair_sum_h=("repair_h", "sum"), repair_n=("repair_h", "count")
+    )
+    order_sums = order_df.groupby("machine_id").agg(orders=("ttr_h", "size"), order_ttr_sum_h=("ttr_h", "sum"), order_ttr_n=("ttr_h", "count"))
+    per_machine = machine_df.join(stop_sums).join(order_sums)
+    sum_columns = ["failures", "downtime_h", "repair_sum_h", "repair_n", "orders", "order_ttr_sum_h", "order_ttr_n"]
+    per_machine[sum_columns] = per_machine[sum_columns].fillna(0)
+    per_machine["machines"] = 1
+    
+    by_machine_df = reliability_ratios(per_machine, window_hours).sort_values(["failures", "downtime_h"], ascending=False)
+    by_department_df = reliability_ratios(per_machine.groupby("department_id")[sum_columns + ["machines"]].sum(), window_hours)
+    total_df = reliability_ratios(per_machine[sum_columns + ["machines"]].sum().to_frame().T, window_hours)
+    
+    # Tendencia mensual: fallos, MTTR y correctivos por mes
+    stop_months = stop_df.groupby("month").agg(failures=("repair_h", "size"), mttr_h=("repair_h", "mean"))
+    order_months = order_df.groupby("month").agg(orders=("ttr_h", "size"))
+    trend_df = stop_months.join(order_months, how="outer").sort_index()
+    
+    return {
+        "window": {"from": start.isoformat(), "to": end.isoformat(), "hours": round(window_hours, 2)},
+        "summary": {"maquinas": int(total_df["machines"].iloc[0]), **reliability_row(next(total_df.itertuples()))},
+        "by_machine": [{
+            "machine_id": row.Index,
+            "machine": row.name,
+            "department_id": row.department_id,
+            "department": departments.get(row.department_id, ""),
+            **reliability_row(row)
+        } for row in by_machine_df.itertuples()],
+        "by_department": [{
+            "department_id": row.Index,
+            "department": departments.get(row.Index, "Sin departamento"),
+            "maquinas": int(row.machines),
+            **reliability_row(row)
+        } for row in by_department_df.sort_values("failures", ascending=False).itertuples()],
+        "trend": [{
+            "month": pd.Timestamp(month).strftime("%b %Y"),
+            "fallos": int(0 if pd.isna(row.failures) else row.failures),
+            "mttr_horas": hours_or_none(row.mttr_h),
+            "correctivos": int(0 if pd.isna(row.orders) else row.orders)
+        } for month, row in zip(trend_df.index, trend_df.itertuples())]
+    }
+
+async def compute_reliability(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None
+):
+    """MTBF, MTTR y tendencia de fallos por máquina y departamento"""
+    start, end = analytics_window(date_from, date_to)
+    machine_query = {}
+    if department_id:
+        machine_query["department_id"] = department_id
+    if machine_id:
+        machine_query["id"] = machine_id
+    machines = await db.machines.find(machine_query, {"_id": 0, "id": 1, "name": 1, "department_id": 1}).to_list(None)
+    departments = {d["id"]: d["name"] for d in await db.departments.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(1000)}
+    
+    stop_query = {"stop_type": "averia", "start_time_dt": {"$gte": start, "$lt": end}}
+    order_query = {"type": "correctivo", "created_at_dt": {"$gte": start, "$lt": end}}
+    if machine_query:
+        stop_query["machine_id"] = order_query["machine_id"] = {"$in": [m["id"] for m in machines]}
+    stops = await db.stops.find(stop_query, {"_id": 0, "machine_id": 1, "start_time_dt": 1, "end_time_dt": 1}).to_list(None)
+    orders = await db.work_orders.find(order_query, {"_id": 0, "machine_id": 1, "created_at_dt": 1, "closed_date_dt": 1}).to_list(None)
+    
+    # El cálculo con pandas es CPU: fuera del event loop
+    return await asyncio.to_thread(reliability_stats, machines, departments, stops, orders, start, end)
+
+@api_router.get("/analytics/reliability")
+async def get_reliability(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """MTBF, MTTR y tasa de fallos por máquina y departamento (por defecto, últimos 12 meses)"""
+    params = {"date_from": date_from, "date_to": date_to, "department_id": department_id, "machine_id": machine_id}
+    return await response_cache.get_or_compute(
+        "analytics/reliability", params, CACHE_TTL_ANALYTICS, ["stops", "work_orders", "machines", "departments"],
+        lambda: compute_reliability(**params)
+    )
+
+# ============== AVAILABILITY ==============
+# Disponibilidad por día de producción = (tiempo planificado - tiempo parado) / tiempo planificado.
+# Las paradas (de /stops y de /machine-stops) se fusionan por máquina (ordenar y barrer), de modo que dos paradas
+# solapadas (p. ej. calidad durante una avería) no cuentan dos veces, y se recortan a la ventana del turno.
+# Las máquinas no tienen línea asignada: el departamento hace de línea y se considera parado cuando
+# lo está cualquiera de sus máquinas (unión de los intervalos de todas ellas).
+
+DAY_SECONDS = 86400
+AVAILABILITY_DEFAULT_DAYS = 30
+
+def parse_shift(shift_start: str, shift_end: str):
+    """Devuelve (inicio del turno en segundos desde medianoche UTC, duración en segundos).
+
+    Si shift_end <= shift_start el turno cruza la medianoche; si son iguales cubre 24 h.
+    """
+    try:
+        start = datetime.strptime(shift_start, "%H:%M")
+        end = datetime.strptime(shift_end, "%H:%M")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="El turno debe indicarse como HH:MM")
+    offset = start.hour * 3600 + start.minute * 60
+    length = (end.hour * 3600 + end.minute * 60 - offset) % DAY_SECONDS
+    return offset, length or DAY_SECONDS
+
+def merge_intervals(group: np.ndarray, start: np.ndarray, end: np.ndarray):
+    """Fusiona los intervalos solapados o contiguos de cada grupo con un barrido vectorizado.
+
+    Tiempos en segundos (int64). Devuelve (group, start, end) con intervalos disjuntos por grupo.
+    """
+    if len(start) == 0:
+        return group, start, end
+    # Cada grupo se desplaza a su propio tramo: una sola clave ordena por (grupo, inicio)
+    # y el máximo acumulado de los finales no pasa de un grupo al siguiente
+    base = start.min()
+    offset = group.astype(np.int64) * (int(end.max() - base) + 1)
+    key = start - base + offset
+    order = np.argsort(key)
+    group, start, end, key, offset = group[order], start[order], end[order], key[order], offset[order]
+    running_end = np.maximum.accumulate(end - base + offset)
+    new_block = np.ones(len(start), dtype=bool)
+    new_block[1:] = (group[1:] != group[:-1]) | (key[1:] > running_end[:-1])
+    first = np.flatnonzero(new_block)
+    return group[first], start[first], np.maximum.reduceat(end, first)
+
+def daily_downtime(group: np.ndarray, start: np.ndarray, end: np.ndarray, n_groups: int, n_days: int, shift_seconds: int) -> np.ndarray:
+    """Segundos parados dentro del turno, matriz [n_groups, n_days].
+
+    Los tiempos son relativos al inicio del primer día de producción: el día k planifica
+    [k * DAY_SECONDS, k * DAY_SECONDS + shift_seconds). Los intervalos deben ser disjuntos por grupo.
+    """
+    first_day = start // DAY_SECONDS
+    pieces = ((end - 1) // DAY_SECONDS - first_day + 1).clip(min=0)
+    idx = np.repeat(np.arange(len(start)), pieces)
+    day = first_day[idx] + np.arange(len(idx)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    day_start = day * DAY_SECONDS
+    seconds = (np.minimum(end[idx], day_start + shift_seconds) - np.maximum(start[idx], day_start)).clip(min=0)
+    valid = (day >= 0) & (day < n_days)
+    flat = group[idx][valid] * n_days + day[valid]
+    return np.bincount(flat, weights=seconds[valid], minlength=n_groups * n_days).reshape(n_groups, n_days)
+
+def availability_pct(planned: float, downtime: float) -> Optional[float]:
+    return round((1 - downtime / planned) * 100, 1) if planned > 0 else None
+
+def availability_stats(
+    machines: List[dict],
+    departments: dict,
+    intervals: List[dict],
+    start: datetime,
+    end: datetime,
+    shift_offset: int,
+    shift_seconds: int
+) -> dict:
+    """Disponibilidad por máquina, departamento y día a partir de los intervalos de parada"""
+    window_start, window_end = int(start.timestamp()), int(end.timestamp())
+    # Día de producción 0: el último inicio de turno anterior o igual al inicio de la ventana
+    origin = window_start - window_start % DAY_SECONDS + shift_offset
+    if origin > window_start:
+        origin -= DAY_SECONDS
+    ws, we = window_start - origin, window_end - origin
+    n_days = max(1, -(-we // DAY_SECONDS))
+    day_starts = np.arange(n_days, dtype=np.int64) * DAY_SECONDS
+    planned = (np.minimum(we, day_starts + shift_seconds) - np.maximum(ws, day_starts)).clip(min=0)
+    
+    machine_index = pd.Index([m["id"] for m in machines])
+    dept_codes, dept_ids = pd.factorize(pd.Series([m.get("department_id") or "" for m in machines], dtype=object))
+    machine_code = machine_index.get_indexer([i["m"] for i in intervals])
+    # Epoch en ms (o None) -> segundos relativos al día 0; las paradas abiertas duran hasta el final de la ventana
+    to_seconds = lambda field: np.nan_to_num(
+        np.array([i.get(field) for i in intervals], dtype=float) / 1000, nan=window_end
+    ).astype(np.int64) - origin
+    s = to_seconds("s").clip(ws, we)
+    e = to_seconds("e").clip(ws, we)
+    keep = (machine_code >= 0) & (e > s)
+    machine_code, s, e = machine_code[keep], s[keep], e[keep]
+    
+    raw = np.bincount(machine_code, weights=e - s, minlength=len(machines))
+    machine_down = daily_downtime(*merge_intervals(machine_code, s, e), len(machines), n_days, shift_seconds)
+    dept_down = daily_downtime(*merge_intervals(dept_codes[machine_code] if len(machines) else machine_code, s, e), len(dept_ids), n_days, shift_seconds)
+    
+    planned_total = float(planned.sum())
+    days = [k for k in range(n_days) if planned[k] > 0]
+    machine_totals = machine_down.sum(axis=1)
+    fleet_daily = machine_down.sum(axis=0)
+    dates = pd.to_datetime(origin + day_starts, unit="s", utc=True).strftime("%Y-%m-%d")
+    
+    return {
+        "window": {"from": start.isoformat(), "to": end.isoformat()},
+        "shift": {"planned_hours_per_day": round(shift_seconds / 3600, 2)},
+        "summary": {
+            "maquinas": len(machines),
+            "horas_planificadas": round(planned_total * len(machines) / 3600, 2),
+            "horas_parada": round(float(machine_totals.sum()) / 3600, 2),
+            "disponibilidad": availability_pct(planned_total * len(machines), float(machine_totals.sum()))
+        },
+        "by_machine": sorted([{
+            "machine_id": m["id"],
+            "machine": m.get("name", ""),
+            "department": departments.get(m.get("department_id"), ""),
+            "horas_parada": round(float(machine_totals[i]) / 3600, 2),
+            # Suma sin fusionar solapes ni recortar al turno (lo que contaban las analíticas de paradas)
+            "horas_parada_brutas": round(float(raw[i]) / 3600, 2),
+            "disponibilidad": availability_pct(planned_total, float(machine_totals[i]))
+        } for i, m in enumerate(machines)], key=lambda x: (x["disponibilidad"] is None, x["disponibilidad"])),
+        "by_department": [{
+            "department_id": dept_id,
+            "department": departments.get(dept_id, "Sin departamento"),
+            "horas_parada": round(float(dept_down[i].sum()) / 3600, 2),
+            "disponibilidad": availability_pct(planned_total, float(dept_down[i].sum())),
+            "daily": [{"date": dates[k], "disponibilidad": availability_pct(float(planned[k]), float(dept_down[i, k]))} for k in days]
+        } for i, dept_id in enumerate(dept_ids)],
+        "daily": [{
+            "date": dates[k],
+            "horas_parada": round(float(fleet_daily[k]) / 3600, 2),
+            "disponibilidad": availability_pct(float(planned[k]) * len(machines), float(fleet_daily[k]))
+        } for k in days]
+    }
+
+async def compute_availability(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    shift_start: str = "00:00",
+    shift_end: str = "00:00"
+):
+    """Disponibilidad diaria con las paradas fusionadas por máquina y por departamento"""
+    start, end = analytics_window(date_from, date_to, AVAILABILITY_DEFAULT_DAYS)
+    end = min(end, datetime.now(timezone.utc))
+    if start >= end:
+        raise HTTPException(status_code=400, detail="La ventana no puede empezar en el futuro")
+    shift_offset, shift_seconds = parse_shift(shift_start, shift_end)
+    machine_query = {}
+    if department_id:
+        machine_query["department_id"] = department_id
+    if machine_id:
+        machine_query["id"] = machine_id
+    machines = await db.machines.find(machine_query, {"_id": 0, "id": 1, "name": 1, "department_id": 1}).to_list(None)
+    departments = {d["id"]: d["name"] for d in await db.departments.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(1000)}
+    
+    # Dos consultas acotadas por índice: paradas que empiezan en la ventana y paradas anteriores que
+    # siguen abiertas o terminan dentro (por (end_time_dt, start_time_dt), para no recorrer el histórico)
+    scope = {"machine_id": {"$in": [m["id"] for m in machines]}} if machine_query else {}
+    queries = [
+        ({**scope, "start_time_dt": {"$gte": start, "$lt": end}}, None),
+        ({**scope, "start_time_dt": {"$lt": start}, "$or": [{"end_time_dt": {"$gt": start}}, {"end_time_dt": None}]},
+         [("end_time_dt", 1), ("start_time_dt", 1)])
+    ]
+    # Solo máquina e instantes como epoch en ms: evita decodificar un datetime por intervalo
+    projection = {"$project": {"_id": 0, "m": "$machine_id", "s": {"$toLong": "$start_time_dt"}, "e": {"$toLong": "$end_time_dt"}}}
+    intervals = []
+    for query, hint in queries:
+        options = {"hint": hint} if hint else {}
+        intervals += await db.stops.aggregate([{"$match": query}, projection], **options).to_list(None)
+    
+    return await asyncio.to_thread(availability_stats, machines, departments, intervals, start, end, shift_offset, shift_seconds)
+
+@api_router.get("/analytics/availability")
+async def get_availability(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    department_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    shift_start: str = "00:00",
+    shift_end: str = "00:00",
+    user: dict = Depends(get_current_user)
+):
+    """Disponibilidad diaria por máquina y departamento (turno en UTC, por defecto 24 h y últimos 30 días)"""
+    params = {
+        "date_from": date_from, "date_to": date_to, "department_id": department_id, "machine_id": machine_id,
+        "shift_start": shift_start, "shift_end": shift_end
+    }
+    return await response_cache.get_or_compute(
+        "analytics/availability", params, CACHE_TTL_ANALYTICS, ["stops", "machines", "departments"],
+        lambda: compute_availability(**params)
+    )
+
+# ============== COLUMNAR SNAPSHOTS ==============
+# Exportación de las colecciones de mantenimiento a ficheros columnares para los notebooks de fiabilidad.
+# Cada ejecución escribe un fichero por lote en SNAPSHOT_DIR/<colección>/<run_id>-<lote>.<formato> con las altas
+# (por el _id) y las modificaciones (modified_at_dt) desde la ejecución anterior. Todos los ficheros de una
+# colección comparten el esquema de SNAPSHOT_SCHEMAS, así que se leen como un único dataset:
+#   pyarrow.dataset.dataset(folder, format="parquet").to_table().to_pandas().drop_duplicates("id", keep="last")
+# Los borrados solo se reflejan con una exportación completa (full), que sustituye los ficheros anteriores.
+
+SNAPSHOT_COLLECTIONS = ["work_orders", "stops", "line_starts", "machine_starts", "spare_parts", "spare_part_requests"]
+SNAPSHOT_FORMATS = ["parquet", "feather"]
+SNAPSHOT_BATCH_SIZE = 50000
+# Fechas sin campo <campo>_dt que también se exportan tipadas
+SNAPSHOT_EXTRA_DATE_FIELDS = {
+    "work_orders": ["updated_at"],
+    "line_starts": ["date"],
+    "machine_starts": ["date"],
+    "spare_parts": ["created_at"]
+}
+# Sin campos internos ni binarios (adjuntos y firmas en base64)
+SNAPSHOT_PROJECTION = {"_id": 0, "issue_fingerprint": 0, "issue_lsh": 0, "issue_fingerprint_version": 0, "technician_signature": 0, "attachments.data": 0}
+
+SNAPSHOT_ID_TYPE = pa.dictionary(pa.int32(), pa.string())
+SNAPSHOT_DATE_TYPE = pa.timestamp("us", tz="UTC")
+
+def snapshot_date_fields(collection: str) -> List[str]:
+    return DATE_SHADOW_FIELDS.get(collection, []) + SNAPSHOT_EXTRA_DATE_FIELDS.get(collection, []) + ["modified_at"]
+
+def snapshot_schema(collection: str, ids: List[str], values: dict) -> pa.Schema:
+    """Esquema fijo de una colección: ids y referencias a usuarios como diccionario, valores y fechas UTC"""
+    return pa.schema(
+        [(field, SNAPSHOT_ID_TYPE) for field in ids]
+        + list(values.items())
+        + [(field, SNAPSHOT_DATE_TYPE) for field in snapshot_date_fields(collection)]
+    )
+
+# Los campos no declarados aquí no se exportan; los anidados (checklist, adjuntos) van como texto JSON
+SNAPSHOT_SCHEMAS = {
+    "work_orders": snapshot_schema("work_orders", ["id", "machine_id", "assigned_to", "created_by"], {
+        "title": pa.string(), "description": pa.string(), "type": pa.string(), "priority": pa.string(),
+        "status": pa.string(), "recurrence": pa.string(), "estimated_hours": pa.float64(),
+        "part_number": pa.string(), "failure_cause": pa.string(), "spare_part_used": pa.string(),
+        "spare_part_reference": pa.string(), "checklist": pa.string(), "notes": pa.string(),
+        "attachments": pa.string(), "postpone_reason": pa.string(), "partial_close_notes": pa.string()
+    }),
+    "stops": snapshot_schema("stops", ["id", "machine_id", "external_id", "created_by"], {
+        "stop_type": pa.string(), "reason": pa.string(), "duration_minutes": pa.int64(), "notes": pa.string(),
+        "source": pa.string(), "created_by_name": pa.string()
+    }),
+    "line_starts": snapshot_schema("line_starts", ["id", "line_id", "created_by"], {
+        "actual_start_time": pa.string(), "delay_minutes": pa.int64(), "delay_reason": pa.string(),
+        "on_time": pa.bool_(), "notes": pa.string()
+    }),
+    "machine_starts": snapshot_schema("machine_starts", ["id", "production_line_id", "department_id", "created_by"], {
+        "target_time": pa.string(), "actual_time": pa.string(), "delay_reason": pa.string(),
+        "on_time": pa.bool_(), "delay_minutes": pa.int64()
+    }),
+    "spare_parts": snapshot_schema("spare_parts", ["id", "machine_id", "created_by"], {
+        "name": pa.string(), "internal_reference": pa.string(), "external_reference": pa.string(),
+        "description": pa.string(), "location": pa.string(), "stock_current": pa.int64(),
+        "stock_min": pa.int64(), "stock_max": pa.int64(), "unit": pa.string(), "supplier": pa.string(),
+        "price": pa.float64()
+    }),
+    "spare_part_requests": snapshot_schema("spare_part_requests", ["id", "spare_part_id", "requested_by", "resolved_by"], {
+        "spare_part_name": pa.string(), "internal_reference": pa.string(), "quantity": pa.int64(),
+        "reason": pa.string(), "urgency": pa.string(), "status": pa.string(), "requested_by_name": pa.string(),
+        "resolved_by_name": pa.string(), "notes": pa.string()
+    })
+}
+
+snapshot_lock = asyncio.Lock()
+snapshot_task: Optional[asyncio.Task] = None
+
+def snapshot_dates(frame: pd.DataFrame, field: str) -> pd.Series:
+    """Columna timestamp UTC a partir de <campo>_dt, interpretando el texto ISO donde falte"""
+    shadow = frame.pop(f"{field}_dt") if f"{field}_dt" in frame else pd.Series(None, index=frame.index, dtype=object)
+    # Siempre en microsegundos: pandas infiere la unidad por lote y los ficheros no coincidirían
+    typed = pd.to_datetime(shadow, utc=True).astype("datetime64[us, UTC]")
+    if field in frame:
+        missing = typed.isna() & frame[field].notna()
+        if missing.any():
+            typed[missing] = pd.to_datetime(frame.loc[missing, field].map(parse_iso_datetime), utc=True).astype("datetime64[us, UTC]")
+    return typed
+
+def snapshot_value(value):
+    """Texto de una celda: listas y objetos anidados (adjuntos, checklist) como JSON, nulos como None"""
+    if value is None or value != value:
+        return None
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    return str(value)
+
+def snapshot_array(values: pd.Series, type: pa.DataType) -> pa.Array:
+    """Columna convertida al tipo del esquema (un valor que no encaja queda nulo)"""
+    if type == SNAPSHOT_DATE_TYPE:
+        return pa.array(values, type=type, from_pandas=True)
+    if pa.types.is_integer(type):
+        return pa.array(pd.to_numeric(values, errors="coerce").round().astype("Int64"), type=type, from_pandas=True)
+    if pa.types.is_floating(type):
+        return pa.array(pd.to_numeric(values, errors="coerce"), type=type, from_pandas=True)
+    if pa.types.is_boolean(type):
+        return pa.array(values.map(lambda v: None if v is None or v != v else bool(v)), type=type)
+    strings = pa.array(values.map(snapshot_value), type=pa.string())
+    return strings.dictionary_encode().cast(type) if pa.types.is_dictionary(type) else strings
+
+def snapshot_table(collection: str, docs: List[dict]) -> pa.Table:
+    """Tabla de un lote con el esquema fijo de la colección, igual en todos los lotes y ejecuciones"""
+    schema = SNAPSHOT_SCHEMAS[collection]
+    frame = pd.DataFrame(docs)
+    for field in snapshot_date_fields(collection):
+        frame[field] = snapshot_dates(frame, field)
+    empty = pd.Series(None, index=frame.index, dtype=object)
+    return pa.Table.from_arrays(
+        [snapshot_array(frame[f.name] if f.name in frame else empty, f.type) for f in schema],
+        schema=schema
+    )
+
+def write_snapshot_batch(collection: str, docs: List[dict], path: Path, fmt: str):
+    table = snapshot_table(collection, docs)
+    if fmt == "feather":
+        feather.write_feather(table, path)
+    else:
+        pq.write_table(table, path)
+
+async def export_collection_snapshot(collection: str, run_id: str, since: Optional[datetime], fmt: str, batch_size: int) -> dict:
+    """Vuelca una colección por lotes desde un cursor de Motor; con since, solo altas y modificaciones posteriores"""
+    folder = SNAPSHOT_DIR / collection
+    folder.mkdir(parents=True, exist_ok=True)
+    query = {}
+    if since:
+        query = {"$or": [{"_id": {"$gte": ObjectId.from_datetime(since)}}, {"modified_at_dt": {"$gte": since}}]}
+    cursor = db[collection].find(query, SNAPSHOT_PROJECTION).batch_size(batch_size)
+    files, exported = [], 0
+    while True:
+        docs = await cursor.to_list(batch_size)
+        if not docs:
+            break
+        path = folder / f"{run_id}-{len(files):05d}.{fmt}"
+        await asyncio.to_thread(write_snapshot_batch, collection, docs, path, fmt)
+        files.append(f"{collection}/{path.name}")
+        exported += len(docs)
+    return {"docs": exported, "files": files}
+
+def check_snapshot_options(collections: List[str], fmt: str):
+    unknown = [c for c in collections if c not in SNAPSHOT_COLLECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Colecciones no exportables: {', '.join(unknown)}")
+    if fmt not in SNAPSHOT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato no soportado. Use {' o '.join(SNAPSHOT_FORMATS)}")
+
+async def export_snapshots(
+    collections: Optional[List[str]] = None,
+    fmt: str = "parquet",
+    full: bool = False,
+    batch_size: int = SNAPSHOT_BATCH_SIZE
+) -> dict:
+    """Exporta las colecciones a SNAPSHOT_DIR, de forma incremental desde la última exportación de cada una.
+
+    El inicio de cada ejecución se guarda en migrations (id "snapshot:<colección>") y es el punto de partida
+    de la siguiente; lo escrito durante la exportación se vuelve a exportar la próxima vez. Con full se exporta
+    todo y se eliminan los ficheros de ejecuciones anteriores.
+    """
+    collections = collections or SNAPSHOT_COLLECTIONS
+    check_snapshot_options(collections, fmt)
+    
+    async with snapshot_lock:
+        started = datetime.now(timezone.utc)
+        run_id = started.strftime("%Y%m%dT%H%M%S%fZ")
+        result = {"run_id": run_id, "format": fmt, "full": full, "directory": str(SNAPSHOT_DIR), "collections": {}}
+        for collection in collections:
+            state_id = f"snapshot:{collection}"
+            state = {} if full else (await db.migrations.find_one({"id": state_id}) or {})
+            exported = await export_collection_snapshot(collection, run_id, parse_iso_datetime(state.get("since")), fmt, batch_size)
+            if full:
+                for old in (SNAPSHOT_DIR / collection).iterdir():
+                    if old.suffix.lstrip(".") in SNAPSHOT_FORMATS and not old.name.startswith(run_id):
+                        old.unlink()
+            await db.migrations.update_one(
+                {"id": state_id},
+                {"$set": {"since": started.isoformat(), "run_id": run_id, "format": fmt, "docs": exported["docs"]}},
+                upsert=True
+            )
+            result["collections"][collection] = exported
+            logger.info(f"Snapshot {run_id}: {exported['docs']} documentos de {collection} en {len(exported['files'])} ficheros")
+    return result
+
+@api_router.post("/admin/snapshots", status_code=202)
+async def create_snapshots(
+    format: str = "parquet",
+    full: bool = False,
+    collections: Optional[str] = None,
+    user: dict = Depends(require_role(["admin"]))
+):
+    """Lanza en segundo plano la exportación a Parquet/Feather (colecciones separadas por comas, por defecto todas).
+
+    El resultado de cada colección queda en GET /admin/snapshots.
+    """
+    global snapshot_task
+    if snapshot_lock.locked() or (snapshot_task and not snapshot_task.done()):
+        raise HTTPException(status_code=409, detail="Ya hay una exportación en curso")
+    selected = [c.strip() for c in collections.split(",") if c.strip()] if collections else None
+    check_snapshot_options(selected or SNAPSHOT_COLLECTIONS, format)
+
+    def done(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"Error exportando snapshots: {task.exception()}")
+    snapshot_task = asyncio.create_task(export_snapshots(selected, format, full))
+    snapshot_task.add_done_callback(done)
+    return {"message": "Exportación iniciada", "collections": selected or SNAPSHOT_COLLECTIONS, "format": format, "full": full}
+
+@api_router.get("/admin/snapshots")
+async def get_snapshots(user: dict = Depends(require_role(["admin"]))):
+    """Estado de la última exportación de cada colección y si hay una en curso"""
+    states = await db.migrations.find({"id": {"$in": [f"snapshot:{c}" for c in SNAPSHOT_COLLECTIONS]}}, {"_id": 0}).to_list(None)
+    return {
+        "running": snapshot_lock.locked() or bool(snapshot_task and not snapshot_task.done()),
+        "directory": str(SNAPSHOT_DIR),
+        "collections": {s["id"].split(":", 1)[1]: {k: v for k, v in s.items() if k != "id"} for s in states}
+    }
+
 # ============== SPARE PARTS (ALMACÉN) ENDPOINTS ==============
 
 @api_router.get("/spare-parts", response_model=List[SparePartResponse])
@@ -2468,7 +5122,7 @@ async def update_spare_part(part_id: str, part: SparePartCreate, user: dict = De
         machine = await db.machines.find_one({"id": part.machine_id}, {"_id": 0, "name": 1})
         machine_name = machine["name"] if machine else ""
     
-    await db.spare_parts.update_one({"id": part_id}, {"$set": part.model_dump()})
+    await db.spare_parts.update_one({"id": part_id}, {"$set": part.model_dump(), **MODIFIED_AT})
     
     updated = await db.spare_parts.find_one({"id": part_id}, {"_id": 0})
     
@@ -2505,7 +5159,7 @@ async def update_spare_part_stock(part_id: str, quantity: int, operation: str, u
     else:
         raise HTTPException(status_code=400, detail="Operación inválida. Use 'add' o 'subtract'")
     
-    await db.spare_parts.update_one({"id": part_id}, {"$set": {"stock_current": new_stock}})
+    await db.spare_parts.update_one({"id": part_id}, {"$set": {"stock_current": new_stock}, **MODIFIED_AT})
     return {"message": "Stock actualizado", "new_stock": new_stock}
 
 # ============== SPARE PART REQUESTS ENDPOINTS ==============
@@ -2553,7 +5207,7 @@ async def create_spare_part_request(request: SparePartRequestCreate, user: dict
         "notes": None
     }
     
-    await db.spare_part_requests.insert_one(new_request)
+    await db.spare_part_requests.insert_one({**new_request, **date_shadow_fields("spare_part_requests", new_request)})
     return new_request
 
 @api_router.put("/spare-part-requests/{request_id}/resolve")
@@ -2588,9 +5242,10 @@ async def resolve_spare_part_request(
             new_stock = part["stock_current"] - request["quantity"]
             if new_stock < 0:
                 raise HTTPException(status_code=400, detail="Stock insuficiente para entregar")
-            await db.spare_parts.update_one({"id": request["spare_part_id"]}, {"$set": {"stock_current": new_stock}})
+            await db.spare_parts.update_one({"id": request["spare_part_id"]}, {"$set": {"stock_current": new_stock}, **MODIFIED_AT})
     
-    await db.spare_part_requests.update_one({"id": request_id}, {"$set": update_data})
+    update_data.update(date_shadow_fields("spare_part_requests", update_data))
+    await db.spare_part_requests.update_one({"id": request_id}, {"$set": update_data, **MODIFIED_AT})
     return {"message": f"Solicitud {status}"}
 
 @api_router.delete("/spare-part-requests/{request_id}")
@@ -2611,6 +5266,135 @@ async def delete_spare_part_request(request_id: str, user: dict = Depends(get_cu
     await db.spare_part_requests.delete_one({"id": request_id})
     return {"message": "Solicitud eliminada"}
 
+# ============== LIVE EVENTS ENDPOINTS ==============
+
+EVENTS_HEARTBEAT_SECONDS = 15
+
+@api_router.get("/events/stream")
+async def stream_events(
+    request: Request,
+    token: Optional[str] = None,
+    department_id: Optional[str] = None,
+    assigned_to: Optional[str] = None
+):
+    """Server-Sent Events con los cambios de órdenes, paradas y arranques.
+
+    EventSource no permite cabeceras, así que el token se acepta también como query param.
+    """
+    auth_header = request.headers.get("authorization", "")
+    if not token and auth_header.lower().startswith("bearer "):
+        token = auth_header[7:]
+    if not token:
+        raise HTTPException(status_code=401, detail="Token requerido")
+    await get_user_from_token(token)
+
+    queue = event_broker.subscribe(department_id, assigned_to)
+
+    async def event_generator():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                if await request.is_disconnected():
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {event['entity']}\ndata: {json.dumps(event, default=str)}\n\n"
+        finally:
+            event_broker.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.websocket("/events/ws")
+async def websocket_events(
+    websocket: WebSocket,
+    token: str,
+    department_id: Optional[str] = None,
+    assigned_to: Optional[str] = None
+):
+    """Mismo flujo de eventos que /events/stream sobre WebSocket"""
+    try:
+        await get_user_from_token(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    queue = event_broker.subscribe(department_id, assigned_to)
+    try:
+        while True:
+            event = await queue.get()
+            await websocket.send_json(event)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        event_broker.unsubscribe(queue)
+
+# Colecciones vigiladas por el change stream y entidad de evento correspondiente
+CHANGE_STREAM_ENTITIES = {
+    "work_orders": "work_order",
+    "stops": "stop",
+    "machine_starts": "machine_start",
+    "line_starts": "line_start"
+}
+
+async def enable_change_stream_pre_images():
+    """Activa las pre-images en las colecciones observadas para que los borrados lleguen con el documento.
+
+    Requiere MongoDB 6.0; en versiones anteriores los borrados se publican como aviso de recarga (refetch).
+    """
+    for collection in CHANGE_STREAM_ENTITIES:
+        try:
+            await db.command("collMod", collection, changeStreamPreAndPostImages={"enabled": True})
+        except Exception as e:
+            logger.warning(f"Sin pre-images en {collection}, los borrados se publican como aviso de recarga: {e}")
+
+async def watch_change_stream():
+    """Alimenta el broker desde un change stream (requiere replica set, aunque sea de un nodo)"""
+    actions = {"insert": "created", "update": "updated", "replace": "updated", "delete": "deleted"}
+    pipeline = [{"$match": {
+        "ns.coll": {"$in": list(CHANGE_STREAM_ENTITIES.keys())},
+        "operationType": {"$in": list(actions.keys())}
+    }}]
+    await enable_change_stream_pre_images()
+    while True:
+        try:
+            async with db.watch(pipeline, full_document="updateLookup", full_document_before_change="whenAvailable") as stream:
+                async for change in stream:
+                    entity = CHANGE_STREAM_ENTITIES[change["ns"]["coll"]]
+                    if change["operationType"] == "delete":
+                        # El documento borrado sale de la pre-image
+                        doc = change.get("fullDocumentBeforeChange")
+                        if not doc:
+                            # Sin pre-image solo llega el _id de Mongo, que no es el id de la app (ni se sabe
+                            # si era una parada de máquina): aviso de recarga en lugar de un id que no casa
+                            logger.warning(f"Borrado en {change['ns']['coll']} sin pre-image, se pide recargar")
+                            event_broker.publish({**build_event(entity, "deleted", {}), "refetch": True})
+                            continue
+                    else:
+                        doc = change.get("fullDocument") or {}
+                    doc.pop("_id", None)
+                    department_id = await get_event_department_id(doc)
+                    if doc.get("source") == STOP_SOURCE_MACHINE_STOPS:
+                        entity = "machine_stop"
+                    event_broker.publish(build_event(
+                        entity,
+                        actions[change["operationType"]],
+                        doc,
+                        department_id
+                    ))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Change stream interrumpido, reintentando: {e}")
+            await asyncio.sleep(5)
+
 # ============== HEALTH CHECK ==============
 
 @api_router.get("/health")
@@ -2628,6 +5412,110 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def create_indexes():
+    # Índice de texto para /work-orders/search: stemming en español y sin distinción de acentos
+    await db.work_orders.create_index(
+        [("title", "text"), ("part_number", "text"), ("failure_cause", "text"), ("description", "text"), ("notes", "text")],
+        name="work_orders_text",
+        default_language="spanish",
+        language_override="text_language",
+        weights={"title": 10, "part_number": 8, "failure_cause": 5, "description": 3, "notes": 1}
+    )
+    # Vista del técnico (/my-orders y paginación de completadas)
+    await db.work_orders.create_index([("assigned_to", 1), ("created_at", -1)])
+    await db.work_orders.create_index([("assigned_to", 1), ("type", 1), ("status", 1), ("created_at", -1)])
+    # Contadores materializados del dashboard
+    await db.dashboard_counters.create_index("id", unique=True)
+    # Analíticas de órdenes por fecha (campos datetime BSON), con y sin filtro de máquina/departamento
+    await db.work_orders.create_index([("created_at_dt", 1)])
+    await db.work_orders.create_index([("machine_id", 1), ("created_at_dt", 1)])
+    await db.work_orders.create_index([("type", 1), ("created_at_dt", 1)])
+    await db.work_orders.create_index([("type", 1), ("machine_id", 1), ("created_at_dt", 1)])
+    await db.work_orders.create_index([("type", 1), ("scheduled_date_dt", 1)])
+    await db.work_orders.create_index([("type", 1), ("machine_id", 1), ("scheduled_date_dt", 1)])
+    await db.work_orders.create_index([("type", 1), ("failure_cause", 1)])
+    # Huella de averías para correctivos recurrentes
+    await db.work_orders.create_index([("type", 1), ("machine_id", 1), ("issue_fingerprint", 1)])
+    await db.work_orders.create_index([("type", 1), ("issue_fingerprint_version", 1)])
+    # Intervalos de parada por ventana de fechas (y por máquina): fiabilidad y disponibilidad
+    await db.stops.create_index([("start_time_dt", 1)])
+    await db.stops.create_index([("end_time_dt", 1), ("start_time_dt", 1)])
+    await db.stops.create_index([("machine_id", 1), ("start_time_dt", 1)])
+    # Comprobación de solapes al escribir: paradas de la máquina que terminan después de un instante
+    await db.stops.create_index([("machine_id", 1), ("end_time_dt", 1), ("start_time_dt", 1)])
+    await db.stops.create_index([("stop_type", 1), ("start_time_dt", 1)])
+    # Almacén único de paradas: acceso por id y listados de cada API (/stops y /machine-stops)
+    await db.stops.create_index("id")
+    await db.stops.create_index([("source", 1), ("created_at", -1)])
+    # Idempotencia de la carga masiva por evento de origen
+    await db.stops.create_index("external_id", unique=True, partialFilterExpression={"external_id": {"$type": "string"}})
+    # Paradas abiertas (registro en memoria de /stops/open)
+    await db.stops.create_index([("machine_id", 1)], name="stops_open", partialFilterExpression=OPEN_STOPS_QUERY)
+    # Rollups diarios de paradas
+    await db.stop_rollups.create_index([("day", 1), ("machine_id", 1), ("department_id", 1), ("stop_type", 1)], unique=True)
+    await db.stop_rollups.create_index([("department_id", 1), ("day", 1)])
+    await db.stop_rollups.create_index([("machine_id", 1), ("day", 1)])
+    # Rollups de arranques y tendencia diaria de arranques de línea
+    await db.machine_start_rollups.create_index([("date", 1), ("production_line_id", 1), ("department_id", 1)], unique=True)
+    await db.machine_start_rollups.create_index([("department_id", 1), ("date", 1)])
+    await db.line_start_rollups.create_index([("date", 1), ("line_id", 1), ("department_id", 1), ("delay_reason", 1)], unique=True)
+    await db.line_start_rollups.create_index([("department_id", 1), ("date", 1)])
+    await db.line_starts.create_index([("date", -1)])
+    # Hoja de arranques: arranques de un día por línea
+    await db.machine_starts.create_index([("date", 1), ("production_line_id", 1)])
+    # Recálculo de retrasos al cambiar la hora objetivo de una línea
+    await db.machine_starts.create_index([("production_line_id", 1)])
+    await db.line_starts.create_index([("line_id", 1), ("date", -1)])
+    # Analíticas precalculadas por endpoint, departamento y periodo
+    await db.analytics_snapshots.create_index([("endpoint", 1), ("department_id", 1), ("period", 1)], unique=True)
+    # Migraciones de datos reanudables (y punto de partida de las exportaciones columnares)
+    await db.migrations.create_index("id", unique=True)
+    # Leases por máquina de la comprobación de solapes de paradas (los caducados los borra el TTL)
+    await db.locks.create_index("id", unique=True)
+    await db.locks.create_index("expires_at", expireAfterSeconds=0)
+    # Modificaciones desde la última exportación columnar
+    for name in SNAPSHOT_COLLECTIONS:
+        await db[name].create_index([("modified_at_dt", 1)], sparse=True)
+    # Historial paginado por orden
+    await db.work_order_history.create_index([("work_order_id", 1), ("timestamp", -1), ("id", -1)])
+
+@app.on_event("startup")
+async def prepare_date_fields():
+    # Antes de atender peticiones: las analíticas, la caché, el precálculo y el registro de paradas abiertas
+    # filtran por los campos <campo>_dt; con el backfill a medias dejarían fuera los documentos antiguos.
+    # Reanudable y sin coste una vez marcado como terminado en migrations
+    await backfill_date_fields()
+
+@app.on_event("startup")
+async def prepare_stop_store():
+    # Antes de atender peticiones: /machine-stops ya lee y escribe solo en stops, y /stops/open lee de memoria
+    await migrate_machine_stops()
+    await open_stops.load()
+
+@app.on_event("startup")
+async def prepare_rollups():
+    # Antes de atender peticiones y después de copiar machine_stops: si se construyeran en segundo plano,
+    # las altas concurrentes se sumarían a una colección que la reconstrucción reemplaza con $out
+    await ensure_stop_rollups()
+    await ensure_start_rollups()
+
+@app.on_event("startup")
+async def start_background_tasks():
+    app.state.background_tasks = [
+        asyncio.create_task(reconcile_dashboard_counters_periodically()),
+        asyncio.create_task(backfill_issue_fingerprints()),
+        asyncio.create_task(reload_open_stops_periodically())
+    ]
+    if ANALYTICS_SNAPSHOT_HOUR is not None:
+        app.state.background_tasks.append(asyncio.create_task(precompute_analytics_snapshots_nightly()))
+    if START_SHEET_HOUR is not None:
+        app.state.background_tasks.append(asyncio.create_task(generate_start_sheet_daily()))
+    if EVENTS_SOURCE == "change_stream":
+        app.state.background_tasks.append(asyncio.create_task(watch_change_stream()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
     client.close()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Benchmark + equivalence test for Bonchef Mantenimiento - Analytics
+Each check seeds generated data, runs the previous in-Python implementation and the
+current Mongo aggregation, verifies both return the same payload and prints timings.
+
+Seeds a dedicated database (BENCH_DB_NAME, default "bonchef_bench") and drops it at the end.
+Usage: MONGO_URL=mongodb://localhost:27017 python backend_bench_analytics.py [num_orders]
+"""
+
+import os
+import sys
+import time
+import uuid
+import random
+import asyncio
+from pathlib import Path
+from datetime import datetime, timezone, timedelta
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", "bonchef_bench")
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import server  # noqa: E402
+
+NUM_MACHINES = 200
+RUNS = 10
+
+# ============== LEGACY IMPLEMENTATIONS ==============
+
+async def legacy_preventive_vs_corrective(db):
+    """Implementación anterior de /analytics/preventive-vs-corrective (limitada a 10.000 órdenes)"""
+    orders = await db.work_orders.find({}, {"_id": 0, "type": 1, "created_at": 1}).to_list(10000)
+    monthly_data = {}
+    for order in orders:
+        try:
+            date = datetime.fromisoformat(order["created_at"].replace("Z", "+00:00"))
+            month_key = date.strftime("%Y-%m")
+            month_label = date.strftime("%b %Y")
+        except Exception:
+            continue
+        if month_key not in monthly_data:
+            monthly_data[month_key] = {"month": month_label, "preventivo": 0, "correctivo": 0}
+        if order["type"] == "preventivo":
+            monthly_data[month_key]["preventivo"] += 1
+        else:
+            monthly_data[month_key]["correctivo"] += 1
+    sorted_data = sorted(monthly_data.items(), key=lambda x: x[0])[-12:]
+    return [v for k, v in sorted_data]
+
+async def legacy_failure_causes(db):
+    """Implementación anterior de /analytics/failure-causes (limitada a 10.000 órdenes)"""
+    orders = await db.work_orders.find(
+        {"type": "correctivo", "failure_cause": {"$ne": "", "$exists": True}},
+        {"_id": 0, "failure_cause": 1}
+    ).to_list(10000)
+    cause_counts = {}
+    for order in orders:
+        cause = order.get("failure_cause", "")
+        if cause:
+            label = server.FAILURE_CAUSE_LABELS.get(cause, cause)
+            cause_counts[label] = cause_counts.get(label, 0) + 1
+    result = [{"causa": k, "cantidad": v} for k, v in cause_counts.items()]
+    result.sort(key=lambda x: x["cantidad"], reverse=True)
+    return result
+
+async def current_failure_causes_counts():
+    """Solo causa y cantidad, ordenadas como la implementación anterior (los empates no tienen orden fijo)"""
+    result = await server.compute_failure_causes()
+    return sorted([{"causa": r["causa"], "cantidad": r["cantidad"]} for r in result], key=lambda x: (-x["cantidad"], x["causa"]))
+
+async def legacy_failure_causes_sorted(db):
+    result = await legacy_failure_causes(db)
+    return sorted(result, key=lambda x: (-x["cantidad"], x["causa"]))
+
+async def legacy_start_compliance_stats(db):
+    """Implementación anterior de /machine-starts/compliance-stats sin filtros (limitada a 10.000 arranques)"""
+    starts = await db.machine_starts.find({}, {"_id": 0}).to_list(10000)
+    lines = {l["id"]: l for l in await db.production_lines.find({}, {"_id": 0}).to_list(1000)}
+    departments = {d["id"]: d["name"] for d in await db.departments.find({}, {"_id": 0}).to_list(1000)}
+    total = len(starts)
+    with_actual = [s for s in starts if s.get("actual_time")]
+    on_time_count = len([s for s in with_actual if s.get("on_time") == True])
+    delayed_count = len([s for s in with_actual if s.get("on_time") == False])
+    compliance_rate = (on_time_count / len(with_actual) * 100) if with_actual else 0
+    dept_stats = {}
+    line_stats = {}
+    daily_data = {}
+    for s in starts:
+        line = lines.get(s.get("production_line_id", ""), {})
+        dept_name = departments.get(line.get("department_id", s.get("department_id", "")), "Sin departamento")
+        dept = dept_stats.setdefault(dept_name, {"total": 0, "on_time": 0, "delayed": 0, "pending": 0})
+        stats = line_stats.setdefault(line.get("name", "Desconocida"), {"total": 0, "on_time": 0, "delayed": 0, "avg_delay": 0, "delays": []})
+        dept["total"] += 1
+        stats["total"] += 1
+        if s.get("actual_time"):
+            if s.get("on_time"):
+                dept["on_time"] += 1
+                stats["on_time"] += 1
+            else:
+                dept["delayed"] += 1
+                stats["delayed"] += 1
+                if s.get("delay_minutes"):
+                    stats["delays"].append(s["delay_minutes"])
+        else:
+            dept["pending"] += 1
+    for stats in line_stats.values():
+        if stats["delays"]:
+            stats["avg_delay"] = sum(stats["delays"]) / len(stats["delays"])
+        del stats["delays"]
+    for s in with_actual:
+        day = daily_data.setdefault(s.get("date", ""), {"date": s.get("date", ""), "on_time": 0, "delayed": 0, "total": 0})
+        day["total"] += 1
+        day["on_time" if s.get("on_time") else "delayed"] += 1
+    return {
+        "summary": {
+            "total": total,
+            "on_time": on_time_count,
+            "delayed": delayed_count,
+            "pending": total - len(with_actual),
+            "compliance_rate": round(compliance_rate, 1)
+        },
+        "by_department": [{"department": k, **v} for k, v in dept_stats.items()],
+        "by_machine": [{"machine": k, **v} for k, v in line_stats.items()],
+        "daily_chart": sorted(daily_data.values(), key=lambda x: x["date"])[-30:]
+    }
+
+async def legacy_line_starts_analytics(db):
+    """Implementación anterior de /analytics/line-starts (limitada a 10.000 arranques)"""
+    starts = await db.line_starts.find({}, {"_id": 0}).to_list(10000)
+    lines = {l["id"]: l for l in await db.lines.find({}, {"_id": 0}).to_list(1000)}
+    total = len(starts)
+    on_time_count = sum(1 for s in starts if s.get("on_time", False))
+    line_stats = {}
+    delay_reasons = {}
+    for s in starts:
+        stats = line_stats.setdefault(lines.get(s.get("line_id"), {}).get("name", "Desconocida"), {"total": 0, "on_time": 0, "late": 0, "total_delay": 0})
+        stats["total"] += 1
+        if s.get("on_time", False):
+            stats["on_time"] += 1
+        else:
+            stats["late"] += 1
+            stats["total_delay"] += s.get("delay_minutes", 0) or 0
+        reason = s.get("delay_reason")
+        if reason and not s.get("on_time", True):
+            delay_reasons[reason] = delay_reasons.get(reason, 0) + 1
+    by_line = [{
+        "linea": name,
+        "total": st["total"],
+        "a_tiempo": st["on_time"],
+        "tarde": st["late"],
+        "cumplimiento": round((st["on_time"] / st["total"] * 100), 1) if st["total"] > 0 else 0,
+        "retraso_total_min": st["total_delay"]
+    } for name, st in line_stats.items()]
+    by_line.sort(key=lambda x: x["cumplimiento"], reverse=True)
+    by_reason = [{"motivo": k, "cantidad": v} for k, v in delay_reasons.items()]
+    by_reason.sort(key=lambda x: x["cantidad"], reverse=True)
+    daily_trend = [{
+        "fecha": s.get("date", ""),
+        "retraso": s.get("delay_minutes", 0) or 0,
+        "a_tiempo": 1 if s.get("on_time", False) else 0
+    } for s in sorted(starts, key=lambda x: x.get("date", ""))[-30:]]
+    return {
+        "summary": {
+            "total": total,
+            "on_time": on_time_count,
+            "late": total - on_time_count,
+            "compliance_rate": round((on_time_count / total * 100), 1) if total > 0 else 0
+        },
+        "pie_data": [
+            {"name": "A tiempo", "value": on_time_count, "color": "#22c55e"},
+            {"name": "Con retraso", "value": total - on_time_count, "color": "#ef4444"}
+        ],
+        "by_line": by_line,
+        "by_reason": by_reason,
+        "daily_trend": daily_trend
+    }
+
+# ============== DATA GENERATION ==============
+
+def random_timestamp(base, minutes):
+    """Mezcla los formatos que conviven en la base de datos: con 'Z', con offset y sin zona"""
+    dt = base + timedelta(minutes=minutes)
+    fmt = random.choice(["offset", "z", "naive"])
+    if fmt == "offset":
+        return dt.isoformat()
+    if fmt == "z":
+        return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return dt.replace(tzinfo=None).isoformat()
+
+async def seed(db, num_orders):
+    for name in ["machines", "work_orders"]:
+        await db[name].delete_many({})
+    machine_ids = [str(uuid.uuid4()) for _ in range(NUM_MACHINES)]
+    await db.machines.insert_many([{
+        "id": mid,
+        "name": f"Máquina {i}",
+        "department_id": f"dept-{i % 8}",
+        "status": "operativa"
+    } for i, mid in enumerate(machine_ids)])
+
+    base = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    span_minutes = 3 * 365 * 24 * 60
+    batch = []
+    for i in range(num_orders):
+        order_type = random.choice(["preventivo", "correctivo"])
+        order = {
+            "id": str(uuid.uuid4()),
+            "title": f"Orden {i}",
+            "description": "",
+            "type": order_type,
+            "priority": random.choice(["baja", "media", "alta", "critica"]),
+            "status": random.choice(["pendiente", "en_progreso", "completada"]),
+            "machine_id": random.choice(machine_ids),
+            "failure_cause": random.choice(["desgaste", "golpe", "corrosion", ""]) if order_type == "correctivo" else "",
+            "created_at": random_timestamp(base, random.randint(0, span_minutes))
+        }
+        order.update(server.date_shadow_fields("work_orders", order))
+        batch.append(order)
+        if len(batch) == 10000:
+            await db.work_orders.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await db.work_orders.insert_many(batch, ordered=False)
+
+async def seed_starts(db, num_starts):
+    """Arranques de línea y de máquina; created_at creciente para conservar el orden de inserción"""
+    for name in ["departments", "production_lines", "lines", "machine_starts", "line_starts"]:
+        await db[name].delete_many({})
+    await db.departments.insert_many([{"id": f"dept-{i}", "name": f"Departamento {i}"} for i in range(4)])
+    await db.production_lines.insert_many([{"id": f"pl-{i}", "name": f"Línea {i}", "department_id": f"dept-{i % 4}"} for i in range(12)])
+    await db.lines.insert_many([{"id": f"line-{i}", "name": f"Línea {i}", "department_id": f"dept-{i % 4}", "target_start_time": "06:00"} for i in range(12)])
+
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    machine_starts, line_starts = [], []
+    for i in range(num_starts):
+        created_at = (base + timedelta(seconds=i)).isoformat()
+        date = (base + timedelta(days=random.randint(0, 400))).strftime("%Y-%m-%d")
+        actual = random.choice([None, "05:50", "06:00", "06:10", "06:45", "xx"])
+        on_time = None if actual in (None, "xx") else actual <= "06:00"
+        delay = None if on_time is None else max(0, (int(actual[:2]) - 6) * 60 + int(actual[3:]))
+        machine_starts.append({
+            "id": str(uuid.uuid4()),
+            "production_line_id": random.choice([f"pl-{k}" for k in range(13)]),  # pl-12 no existe
+            "department_id": f"dept-{random.randint(0, 3)}",
+            "target_time": "06:00",
+            "actual_time": actual,
+            "delay_reason": random.choice(["", "Falta de personal"]),
+            "date": date,
+            "on_time": on_time,
+            "delay_minutes": delay,
+            "created_at": created_at
+        })
+        line_delay = random.choice([0, 0, 5, 20, 90])
+        line_starts.append({
+            "id": str(uuid.uuid4()),
+            "line_id": random.choice([f"line-{k}" for k in range(13)]),
+            "date": date,
+            "actual_start_time": "06:00",
+            "delay_minutes": line_delay,
+            "delay_reason": random.choice(["Avería", "Falta de material", "Limpieza"]) if line_delay else None,
+            "on_time": line_delay == 0,
+            "created_at": created_at
+        })
+    await db.machine_starts.insert_many(machine_starts, ordered=False)
+    await db.line_starts.insert_many(line_starts, ordered=False)
+    await server.rebuild_start_rollups()
+
+# ============== RUNNER ==============
+
+class AnalyticsBenchmark:
+    def __init__(self, db):
+        self.db = db
+        self.tests_run = 0
+        self.tests_passed = 0
+
+    async def timed(self, label, fn):
+        timings = []
+        result = None
+        for _ in range(RUNS):
+            start = time.perf_counter()
+            result = await fn()
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        print(f"   {label:<24} median {timings[len(timings) // 2]:8.1f} ms")
+        return result
+
+    async def compare(self, name, legacy_fn, current_fn):
+        self.tests_run += 1
+        print(f"\n🔍 {name}")
+        legacy = await self.timed("legacy (Python)", legacy_fn)
+        current = await self.timed("current (Mongo)", current_fn)
+        if legacy == current:
+            self.tests_passed += 1
+            print("✅ Same payload")
+        else:
+            print(f"❌ Payload mismatch\n   legacy:  {legacy}\n   current: {current}")
+
+    async def run(self, num_orders):
+        # La implementación anterior solo veía 10.000 órdenes: la equivalencia se comprueba dentro de ese límite
+        equivalence_orders = min(num_orders, 10000)
+        print(f"🔧 Seeding {equivalence_orders} work orders in '{self.db.name}' (equivalence)...")
+        await seed(self.db, equivalence_orders)
+        await self.compare(
+            "preventive-vs-corrective",
+            lambda: legacy_preventive_vs_corrective(self.db),
+            server.compute_preventive_vs_corrective
+        )
+        await self.compare(
+            "failure-causes",
+            lambda: legacy_failure_causes_sorted(self.db),
+            current_failure_causes_counts
+        )
+
+        equivalence_starts = min(num_orders, 10000)
+        print(f"\n🔧 Seeding {equivalence_starts} machine and line starts (equivalence)...")
+        await seed_starts(self.db, equivalence_starts)
+        await self.compare(
+            "start-compliance-stats",
+            lambda: legacy_start_compliance_stats(self.db),
+            server.compute_start_compliance_stats
+        )
+        await self.compare(
+            "line-starts",
+            lambda: legacy_line_starts_analytics(self.db),
+            server.compute_line_starts_analytics
+        )
+
+        if num_orders > equivalence_orders:
+            print(f"\n🔧 Seeding {num_orders} work orders (scale, legacy truncates at 10.000)...")
+            await seed(self.db, num_orders)
+            print("\n🔍 preventive-vs-corrective at scale")
+            await self.timed("legacy (Python)", lambda: legacy_preventive_vs_corrective(self.db))
+            await self.timed("current (aggregation)", server.compute_preventive_vs_corrective)
+            print("\n🔍 failure-causes at scale")
+            await self.timed("legacy (Python)", lambda: legacy_failure_causes(self.db))
+            await self.timed("current (aggregation)", server.compute_failure_causes)
+
+        print(f"\n📊 Equivalence checks passed: {self.tests_passed}/{self.tests_run}")
+        return self.tests_passed == self.tests_run
+
+async def main():
+    num_orders = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    db = server.db
+    try:
+        ok = await AnalyticsBenchmark(db).run(num_orders)
+    finally:
+        await server.client.drop_database(db.name)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
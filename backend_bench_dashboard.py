@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Benchmark for Bonchef Mantenimiento - Dashboard stats
+Compares the legacy ten sequential count_documents calls against the
+$group/$facet aggregations used by /api/dashboard/stats.
+
+Seeds a dedicated database (BENCH_DB_NAME, default "bonchef_bench") and drops it at the end.
+Usage: MONGO_URL=mongodb://localhost:27017 python backend_bench_dashboard.py [num_orders]
+"""
+
+import os
+import sys
+import time
+import uuid
+import random
+import asyncio
+from pathlib import Path
+from datetime import datetime, timezone, timedelta
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", "bonchef_bench")
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import server  # noqa: E402
+
+NUM_MACHINES = 300
+RUNS = 20
+
+async def legacy_dashboard_stats(db):
+    """Implementación anterior: diez count_documents secuenciales"""
+    return {
+        "machines": {
+            "total": await db.machines.count_documents({}),
+            "operational": await db.machines.count_documents({"status": "operativa"}),
+            "in_maintenance": await db.machines.count_documents({"status": "en_mantenimiento"}),
+            "out_of_service": await db.machines.count_documents({"status": "fuera_de_servicio"})
+        },
+        "orders": {
+            "total": await db.work_orders.count_documents({}),
+            "pending": await db.work_orders.count_documents({"status": "pendiente"}),
+            "in_progress": await db.work_orders.count_documents({"status": "en_progreso"}),
+            "completed": await db.work_orders.count_documents({"status": "completada"}),
+            "preventive": await db.work_orders.count_documents({"type": "preventivo"}),
+            "corrective": await db.work_orders.count_documents({"type": "correctivo"}),
+            "critical": await db.work_orders.count_documents({"priority": "critica", "status": {"$ne": "completada"}}),
+            "high_priority": await db.work_orders.count_documents({"priority": "alta", "status": {"$ne": "completada"}})
+        }
+    }
+
+async def seed(db, num_orders):
+    await db.machines.delete_many({})
+    await db.work_orders.delete_many({})
+    machine_ids = [str(uuid.uuid4()) for _ in range(NUM_MACHINES)]
+    await db.machines.insert_many([{
+        "id": mid,
+        "name": f"Máquina {i}",
+        "department_id": f"dept-{i % 10}",
+        "status": random.choice(["operativa", "operativa", "en_mantenimiento", "fuera_de_servicio"])
+    } for i, mid in enumerate(machine_ids)])
+
+    base = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    batch = []
+    for i in range(num_orders):
+        batch.append({
+            "id": str(uuid.uuid4()),
+            "title": f"Orden {i}",
+            "description": "Revisión general de la máquina",
+            "type": random.choice(["preventivo", "correctivo"]),
+            "priority": random.choice(["baja", "media", "alta", "critica"]),
+            "status": random.choice(["pendiente", "en_progreso", "completada", "completada"]),
+            "machine_id": random.choice(machine_ids),
+            "created_at": (base + timedelta(minutes=i * 15)).isoformat()
+        })
+        if len(batch) == 10000:
+            await db.work_orders.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await db.work_orders.insert_many(batch, ordered=False)
+
+async def timed(label, fn):
+    timings = []
+    result = None
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        result = await fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f"{label:<28} median {timings[len(timings) // 2]:8.1f} ms   p95 {timings[int(len(timings) * 0.95) - 1]:8.1f} ms")
+    return result
+
+async def main():
+    num_orders = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    db = server.db
+    print(f"🔧 Seeding {num_orders} work orders and {NUM_MACHINES} machines in '{db.name}'...")
+    await seed(db, num_orders)
+
+    try:
+        legacy = await timed("legacy (10 count_documents)", lambda: legacy_dashboard_stats(db))
+        current = await timed("aggregation ($group+$facet)", server.compute_dashboard_stats)
+        if legacy == current:
+            print("✅ Both implementations return the same payload")
+        else:
+            print(f"❌ Payload mismatch:\n   legacy:  {legacy}\n   current: {current}")
+            return 1
+    finally:
+        await server.client.drop_database(db.name)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
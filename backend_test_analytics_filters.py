@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Pushdown test for Bonchef Mantenimiento - Analytics filters
+Seeds work orders, stops and line starts over several years, runs every analytics computation with a
+one-month window and a department filter under the Mongo profiler, and checks that the documents examined
+stay within the window: they must not grow when out-of-window history is added to the collection.
+
+Seeds a dedicated database (BENCH_DB_NAME, default "bonchef_bench") and drops it at the end.
+Needs a standalone mongod (the profiler is not available through mongos).
+Usage: MONGO_URL=mongodb://localhost:27017 python backend_test_analytics_filters.py
+"""
+
+import os
+import sys
+import uuid
+import random
+import asyncio
+from pathlib import Path
+from datetime import datetime, timezone, timedelta
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", "bonchef_bench")
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import server  # noqa: E402
+
+NUM_MACHINES = 40
+NUM_DEPARTMENTS = 4
+DOCS_PER_DAY = 20
+WINDOW = ("2024-06-01", "2024-06-30")
+DEPARTMENT = "dept-1"
+# Margen para lecturas que no dependen de la ventana (bordes de índice, paradas que cruzan el inicio)
+SLACK = 50
+
+def machine_ids():
+    return [f"machine-{i}" for i in range(NUM_MACHINES)]
+
+async def seed_days(db, first_day, days):
+    """Órdenes, paradas, paradas de máquina y arranques de línea repartidos por día"""
+    orders, stops, line_starts = [], [], []
+    for d in range(days):
+        day = first_day + timedelta(days=d)
+        for _ in range(DOCS_PER_DAY):
+            machine_id = random.choice(machine_ids())
+            ts = day + timedelta(minutes=random.randint(0, 1439))
+            order_type = random.choice(["preventivo", "correctivo"])
+            order = {
+                "id": str(uuid.uuid4()),
+                "title": random.choice(["Fuga de aceite", "Rotura de correa", "Revisión general"]),
+                "description": "",
+                "type": order_type,
+                "priority": "media",
+                "status": random.choice(["pendiente", "completada"]),
+                "machine_id": machine_id,
+                "failure_cause": random.choice(["desgaste", "golpe"]) if order_type == "correctivo" else "",
+                "scheduled_date": ts.isoformat() if order_type == "preventivo" else None,
+                "created_at": ts.isoformat()
+            }
+            if order_type == "correctivo":
+                order.update(server.issue_fields(order["title"], order["description"]))
+            order.update(server.date_shadow_fields("work_orders", order))
+            orders.append(order)
+
+            stop = {
+                "id": str(uuid.uuid4()),
+                "source": "stops",
+                "machine_id": machine_id,
+                "stop_type": random.choice(["averia", "calidad", "otros"]),
+                "reason": "",
+                "start_time": ts.isoformat(),
+                "end_time": (ts + timedelta(minutes=30)).isoformat(),
+                "duration_minutes": 30,
+                "created_at": ts.isoformat()
+            }
+            stop.update(server.date_shadow_fields("stops", stop))
+            stops.append(stop)
+            stops.append({**stop, "id": str(uuid.uuid4()), "source": "machine_stops"})
+
+            line_delay = random.choice([0, 10])
+            line_starts.append({
+                "id": str(uuid.uuid4()),
+                "line_id": f"line-{random.randint(0, 7)}",
+                "date": day.strftime("%Y-%m-%d"),
+                "actual_start_time": "06:00",
+                "delay_minutes": line_delay,
+                "delay_reason": "Avería" if line_delay else None,
+                "on_time": line_delay == 0,
+                "created_at": ts.isoformat()
+            })
+    await db.work_orders.insert_many(orders, ordered=False)
+    await db.stops.insert_many(stops, ordered=False)
+    await db.line_starts.insert_many(line_starts, ordered=False)
+    await server.rebuild_stop_rollups()
+    await server.rebuild_start_rollups()
+
+async def seed_catalog(db):
+    for name in ["departments", "machines", "lines", "work_orders", "stops", "line_starts"]:
+        await db[name].delete_many({})
+    await db.departments.insert_many([{"id": f"dept-{i}", "name": f"Departamento {i}"} for i in range(NUM_DEPARTMENTS)])
+    await db.machines.insert_many([{
+        "id": mid,
+        "name": f"Máquina {i}",
+        "department_id": f"dept-{i % NUM_DEPARTMENTS}",
+        "status": "operativa"
+    } for i, mid in enumerate(machine_ids())])
+    await db.lines.insert_many([{
+        "id": f"line-{i}",
+        "name": f"Línea {i}",
+        "department_id": f"dept-{i % NUM_DEPARTMENTS}",
+        "target_start_time": "06:00"
+    } for i in range(8)])
+    await server.create_indexes()
+
+CASES = [
+    ("preventive-vs-corrective", ["work_orders"], lambda: server.compute_preventive_vs_corrective(*WINDOW, DEPARTMENT)),
+    ("failure-causes", ["work_orders"], lambda: server.compute_failure_causes(*WINDOW, DEPARTMENT)),
+    ("recurring-correctives", ["work_orders"], lambda: server.compute_recurring_correctives(*WINDOW, DEPARTMENT)),
+    ("preventive-compliance", ["work_orders"], lambda: server.compute_preventive_compliance(*WINDOW, DEPARTMENT)),
+    ("stops", ["stop_rollups"], lambda: server.compute_stops_analytics(*WINDOW, DEPARTMENT)),
+    ("line-starts", ["line_start_rollups", "line_starts"], lambda: server.compute_line_starts_analytics(*WINDOW, DEPARTMENT)),
+    ("reliability", ["stops", "work_orders"], lambda: server.compute_reliability(*WINDOW, DEPARTMENT)),
+    ("availability", ["stops"], lambda: server.compute_availability(*WINDOW, DEPARTMENT))
+]
+
+class AnalyticsFiltersTester:
+    def __init__(self, db):
+        self.db = db
+        self.tests_run = 0
+        self.tests_passed = 0
+
+    async def docs_examined(self, fn, collections):
+        """Documentos examinados por colección según el profiler de Mongo"""
+        await self.db.command("profile", 0)
+        await self.db.system.profile.drop()
+        await self.db.command("profile", 2)
+        try:
+            await fn()
+        finally:
+            await self.db.command("profile", 0)
+        examined = {}
+        async for entry in self.db.system.profile.find({"ns": {"$in": [f"{self.db.name}.{c}" for c in collections]}}):
+            name = entry["ns"].split(".", 1)[1]
+            examined[name] = examined.get(name, 0) + entry.get("docsExamined", 0)
+        return {c: examined.get(c, 0) for c in collections}
+
+    async def measure(self):
+        return {name: await self.docs_examined(fn, collections) for name, collections, fn in CASES}
+
+    async def run(self):
+        print(f"🔧 Seeding {DOCS_PER_DAY} docs/day for 2024 in '{self.db.name}'...")
+        await seed_catalog(self.db)
+        await seed_days(self.db, datetime(2024, 1, 1, tzinfo=timezone.utc), 366)
+        before = await self.measure()
+
+        print("🔧 Adding three more years of out-of-window history...")
+        await seed_days(self.db, datetime(2021, 1, 1, tzinfo=timezone.utc), 3 * 365)
+        after = await self.measure()
+
+        for name, collections, _ in CASES:
+            for collection in collections:
+                self.tests_run += 1
+                b, a = before[name][collection], after[name][collection]
+                print(f"\n🔍 {name} on {collection}: {b} docs examined, {a} after growing the collection x4")
+                if a <= b + SLACK:
+                    self.tests_passed += 1
+                    print("✅ Scales with the window")
+                else:
+                    print("❌ Docs examined grow with the collection")
+
+        print(f"\n📊 Tests passed: {self.tests_passed}/{self.tests_run}")
+        return self.tests_passed == self.tests_run
+
+async def main():
+    db = server.db
+    try:
+        ok = await AnalyticsFiltersTester(db).run()
+    finally:
+        await server.client.drop_database(db.name)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
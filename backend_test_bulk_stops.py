@@ -0,0 +1,132 @@
+import requests
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+
+class BulkStopsTester:
+    def __init__(self, base_url="https://maint-checklist.preview.emergentagent.com/api"):
+        self.base_url = base_url
+        self.token = None
+        self.tests_run = 0
+        self.tests_passed = 0
+        self.machine_id = None
+        # Eventos únicos por ejecución, sobre una máquina creada para la prueba y borrada al final
+        self.run_id = uuid.uuid4().hex[:8]
+        self.base_time = datetime(2099, 1, 1, tzinfo=timezone.utc) + timedelta(days=int(self.run_id, 16) % 3650)
+
+    def check(self, name, condition, detail=None):
+        self.tests_run += 1
+        print(f"\n🔍 Testing {name}...")
+        if condition:
+            self.tests_passed += 1
+            print("✅ Passed")
+        else:
+            print(f"❌ Failed{f' - {detail}' if detail else ''}")
+        return condition
+
+    def post_bulk(self, json_rows=None, csv_text=None):
+        if csv_text is not None:
+            files = {'file': ('stops.csv', csv_text.encode('utf-8'), 'text/csv')}
+            return requests.post(f"{self.base_url}/stops/bulk", files=files, headers=self.headers())
+        return requests.post(f"{self.base_url}/stops/bulk", json=json_rows, headers=self.headers())
+
+    def headers(self):
+        return {'Authorization': f'Bearer {self.token}'}
+
+    def at(self, minutes):
+        return (self.base_time + timedelta(minutes=minutes)).isoformat()
+
+    def setup(self):
+        print("\n🔧 Setting up test data...")
+        response = requests.post(f"{self.base_url}/auth/login", json={"email": "admin@test.com", "password": "admin123"})
+        if response.status_code != 200:
+            print("❌ Admin login failed, cannot continue")
+            return False
+        self.token = response.json().get('token')
+        departments = requests.get(f"{self.base_url}/departments", headers=self.headers()).json()
+        if not departments:
+            print("❌ No departments available, cannot continue")
+            return False
+        machine = requests.post(f"{self.base_url}/machines", json={
+            "name": f"Bulk test {self.run_id}",
+            "code": f"BULK-{self.run_id}",
+            "department_id": departments[0]['id']
+        }, headers=self.headers())
+        if machine.status_code != 200:
+            print(f"❌ Could not create the test machine: {machine.text}")
+            return False
+        self.machine_id = machine.json()['id']
+        return True
+
+    def teardown(self):
+        """Borra las paradas creadas y la máquina de prueba para no dejar paradas en el entorno compartido"""
+        if not self.machine_id:
+            return
+        print("\n🧹 Cleaning up test data...")
+        stops = requests.get(f"{self.base_url}/stops", params={"machine_id": self.machine_id}, headers=self.headers()).json()
+        for stop in stops:
+            requests.delete(f"{self.base_url}/stops/{stop['id']}", headers=self.headers())
+        requests.delete(f"{self.base_url}/machines/{self.machine_id}", headers=self.headers())
+
+    def test_json_batch(self):
+        rows = [
+            {"external_id": f"{self.run_id}-1", "machine_id": self.machine_id, "stop_type": "averia", "reason": "PLC", "start_time": self.at(0), "end_time": self.at(45)},
+            {"external_id": f"{self.run_id}-2", "machine_id": self.machine_id, "stop_type": "calidad", "reason": "PLC", "start_time": self.at(60), "end_time": self.at(70)},
+            {"external_id": f"{self.run_id}-3", "machine_id": self.machine_id, "stop_type": "averia", "reason": "PLC", "start_time": self.at(30), "end_time": self.at(50)},
+            {"external_id": f"{self.run_id}-4", "machine_id": "no-existe", "stop_type": "averia", "start_time": self.at(0)},
+            {"external_id": f"{self.run_id}-5", "machine_id": self.machine_id, "stop_type": "averia", "start_time": "ayer"}
+        ]
+        response = self.post_bulk(rows)
+        if not self.check("JSON bulk returns 200", response.status_code == 200, response.text):
+            return False
+        report = response.json()
+        errors = {e["row"]: e for e in report["errors"]}
+        ok = self.check("Two valid stops inserted", report["inserted"] == 2, report)
+        ok &= self.check("Overlapping row reported with its conflict", 2 in errors and "conflicting_stop" in errors[2], errors.get(2))
+        ok &= self.check("Unknown machine reported", errors.get(3, {}).get("error") == "Máquina no encontrada", errors.get(3))
+        ok &= self.check("Invalid date reported", 4 in errors, errors.get(4))
+
+        stops = requests.get(f"{self.base_url}/stops", params={"machine_id": self.machine_id}, headers=self.headers()).json()
+        first = next((s for s in stops if s["start_time"] == self.at(0)), None)
+        ok &= self.check("Duration computed for the inserted stop", first is not None and first["duration_minutes"] == 45, first)
+
+        again = self.post_bulk(rows[:2]).json()
+        ok &= self.check("Resubmitting the same events is idempotent", again["inserted"] == 0 and len(again["duplicates"]) == 2, again)
+        return ok
+
+    def test_csv_batch(self):
+        csv_text = (
+            "external_id,machine_id,stop_type,reason,start_time,end_time,notes\n"
+            f"{self.run_id}-6,{self.machine_id},otros,CSV,{self.at(120)},{self.at(150)},\n"
+            f"{self.run_id}-6,{self.machine_id},otros,CSV,{self.at(200)},{self.at(210)},\n"
+        )
+        response = self.post_bulk(csv_text=csv_text)
+        if not self.check("CSV bulk returns 200", response.status_code == 200, response.text):
+            return False
+        report = response.json()
+        ok = self.check("CSV row inserted", report["inserted"] == 1, report)
+        ok &= self.check("Repeated external_id in the same upload reported", [e["row"] for e in report["errors"]] == [1], report["errors"])
+        return ok
+
+def main():
+    print("🧪 Starting Bulk Stops Testing...")
+    tester = BulkStopsTester()
+    if not tester.setup():
+        print("❌ Failed to setup test data")
+        return 1
+
+    try:
+        for test in [tester.test_json_batch, tester.test_csv_batch]:
+            try:
+                if not test():
+                    print(f"❌ Test {test.__name__} failed")
+            except Exception as e:
+                print(f"❌ Test {test.__name__} error: {e}")
+    finally:
+        tester.teardown()
+
+    print(f"\n📊 Tests passed: {tester.tests_passed}/{tester.tests_run}")
+    return 0 if tester.tests_passed == tester.tests_run else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
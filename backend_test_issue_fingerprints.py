@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Fingerprint test for Bonchef Mantenimiento - Recurring correctives
+Checks that the singular and plural of the same fault get the same issue fingerprint and the same
+MinHash/LSH bands, so they are counted as one recurring corrective.
+No database needed: only the pure fingerprint functions of server.py are used.
+Usage: python backend_test_issue_fingerprints.py
+"""
+
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bonchef_test")
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import server  # noqa: E402
+
+SAME_ISSUE = [
+    ("cables", "cable"),
+    ("engranajes", "engranaje"),
+    ("fuentes", "fuente"),
+    ("luces", "luz"),
+    ("motores", "motor"),
+    ("fugas", "fuga"),
+    ("camiones", "camión"),
+    ("Fuga de aceite en cilindros", "fuga aceite cilindro"),
+    ("Rotura de engranajes de la cinta", "rotura engranaje cinta")
+]
+
+class IssueFingerprintTester:
+    def __init__(self):
+        self.tests_run = 0
+        self.tests_passed = 0
+
+    def check(self, name, condition, detail=None):
+        self.tests_run += 1
+        print(f"\n🔍 Testing {name}...")
+        if condition:
+            self.tests_passed += 1
+            print("✅ Passed")
+        else:
+            print(f"❌ Failed{f' - {detail}' if detail else ''}")
+        return condition
+
+    def run(self):
+        for plural, singular in SAME_ISSUE:
+            a = server.issue_fields(plural, "")
+            b = server.issue_fields(singular, "")
+            self.check(
+                f"'{plural}' and '{singular}' share fingerprint and LSH bands",
+                a["issue_fingerprint"] == b["issue_fingerprint"] and a["issue_lsh"] == b["issue_lsh"],
+                f"{a['issue_fingerprint']!r} != {b['issue_fingerprint']!r}"
+            )
+        different = server.issue_fields("Fuga de aceite", "")["issue_fingerprint"] != server.issue_fields("Rotura de correa", "")["issue_fingerprint"]
+        self.check("Different faults keep different fingerprints", different)
+
+        print(f"\n📊 Tests passed: {self.tests_passed}/{self.tests_run}")
+        return self.tests_passed == self.tests_run
+
+def main():
+    return 0 if IssueFingerprintTester().run() else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Overlap edit test for Bonchef Mantenimiento - Machine stops
+Seeds two stops of the same machine that already overlap (history from before the overlap check, e.g. a
+quality stop during a breakdown) and checks that a PUT that only changes the reason is still accepted,
+while a PUT that moves the interval onto the other stop is still rejected with the 409 overlap error.
+
+Seeds a dedicated database (BENCH_DB_NAME, default "bonchef_bench") and drops it at the end.
+Usage: MONGO_URL=mongodb://localhost:27017 python backend_test_stop_overlap_edits.py
+"""
+
+import os
+import sys
+import asyncio
+from pathlib import Path
+from datetime import datetime, timezone
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", "bonchef_bench")
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import server  # noqa: E402
+
+USER = {"id": "user-test", "email": "admin@test.com", "role": "admin", "name": "Admin"}
+MACHINE_ID = "machine-overlap"
+
+def stop_doc(stop_id, stop_type, reason, start_time, end_time):
+    start = datetime.fromisoformat(start_time)
+    end = datetime.fromisoformat(end_time)
+    doc = {
+        "id": stop_id,
+        "machine_id": MACHINE_ID,
+        "stop_type": stop_type,
+        "reason": reason,
+        "start_time": start_time,
+        "end_time": end_time,
+        "duration_minutes": int((end - start).total_seconds() / 60),
+        "source": server.STOP_SOURCE_MACHINE_STOPS,
+        "created_by": USER["id"],
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    doc.update(server.date_shadow_fields("stops", doc))
+    return doc
+
+async def seed(db):
+    await server.create_indexes()
+    await db.departments.insert_one({"id": "dept-overlap", "name": "Envasado"})
+    await db.machines.insert_one({"id": MACHINE_ID, "name": "Llenadora", "department_id": "dept-overlap", "status": "operativa"})
+    # Avería de 8:00 a 10:00 y parada de calidad dentro de ella, insertadas sin pasar por la API
+    await db.stops.insert_many([
+        stop_doc("stop-breakdown", "averia", "Rotura de correa", "2024-06-03T08:00:00+00:00", "2024-06-03T10:00:00+00:00"),
+        stop_doc("stop-quality", "calidad", "Etiquetas torcdas", "2024-06-03T08:30:00+00:00", "2024-06-03T09:00:00+00:00")
+    ])
+
+class StopOverlapEditsTester:
+    def __init__(self, db):
+        self.db = db
+        self.tests_run = 0
+        self.tests_passed = 0
+
+    def check(self, name, condition, detail=None):
+        self.tests_run += 1
+        print(f"\n🔍 Testing {name}...")
+        if condition:
+            self.tests_passed += 1
+            print("✅ Passed")
+        else:
+            print(f"❌ Failed{f' - {detail}' if detail else ''}")
+        return condition
+
+    async def put(self, start_time, end_time, reason):
+        update = server.MachineStopCreate(
+            machine_id=MACHINE_ID, stop_type="calidad", reason=reason, start_time=start_time, end_time=end_time
+        )
+        try:
+            return 200, await server.update_machine_stop("stop-quality", update, USER)
+        except server.StopOverlapError as e:
+            return 409, e.conflicting_stop
+
+    async def run(self):
+        await seed(self.db)
+
+        status, body = await self.put("2024-06-03T08:30:00+00:00", "2024-06-03T09:00:00+00:00", "Etiquetas torcidas")
+        self.check("Reason-only PUT on an overlapping stop returns 200", status == 200, body)
+        stored = await self.db.stops.find_one({"id": "stop-quality"}, {"_id": 0})
+        self.check("Reason updated", stored["reason"] == "Etiquetas torcidas", stored["reason"])
+
+        status, body = await self.put("2024-06-03T08:30:00+00:00", "2024-06-03T09:30:00+00:00", "Etiquetas torcidas")
+        self.check(
+            "PUT that changes the interval onto another stop returns 409",
+            status == 409 and body.get("id") == "stop-breakdown", (status, body)
+        )
+
+        print(f"\n📊 Tests passed: {self.tests_passed}/{self.tests_run}")
+        return self.tests_passed == self.tests_run
+
+async def main():
+    db = server.db
+    try:
+        ok = await StopOverlapEditsTester(db).run()
+    finally:
+        await server.client.drop_database(db.name)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -34,12 +34,9 @@ export default function Dashboard() {
 
     const fetchDashboardData = async () => {
         try {
-            const [statsRes, ordersRes] = await Promise.all([
-                axios.get(`${API}/dashboard/stats`),
-                axios.get(`${API}/dashboard/recent-orders`)
-            ]);
-            setStats(statsRes.data);
-            setRecentOrders(ordersRes.data);
+            const response = await axios.get(`${API}/dashboard/bootstrap`);
+            setStats(response.data.stats);
+            setRecentOrders(response.data.recent_orders);
         } catch (error) {
             console.error('Error fetching dashboard data:', error);
         } finally {
@@ -50,6 +50,23 @@ export default function MyOrders() {
         }
     };
 
+    const loadMoreCompleted = async (type) => {
+        try {
+            const response = await axios.get(`${API}/my-orders/completed`, {
+                params: { type, skip: data[type].completadas.length }
+            });
+            setData(prev => ({
+                ...prev,
+                [type]: {
+                    ...prev[type],
+                    completadas: [...prev[type].completadas, ...response.data.items]
+                }
+            }));
+        } catch (error) {
+            console.error('Error fetching completed orders:', error);
+        }
+    };
+
     const priorityClass = {
         critica: 'priority-critica',
         alta: 'priority-alta',
@@ -226,14 +243,14 @@ export default function MyOrders() {
                         <Calendar className="w-4 h-4" />
                         Preventivas
                         <Badge variant="secondary" className="ml-1">
-                            {data.preventivo.pendientes.length + data.preventivo.en_progreso.length + data.preventivo.completadas.length}
+                            {data.preventivo.pendientes.length + data.preventivo.en_progreso.length + data.preventivo.completadas_total}
                         </Badge>
                     </TabsTrigger>
                     <TabsTrigger value="correctivo" className="flex items-center gap-2">
                         <Wrench className="w-4 h-4" />
                         Correctivas
                         <Badge variant="secondary" className="ml-1">
-                            {data.correctivo.pendientes.length + data.correctivo.en_progreso.length + data.correctivo.completadas.length}
+                            {data.correctivo.pendientes.length + data.correctivo.en_progreso.length + data.correctivo.completadas_total}
                         </Badge>
                     </TabsTrigger>
                 </TabsList>
@@ -279,6 +296,16 @@ export default function MyOrders() {
                                     icon={CheckCircle2}
                                     emptyMessage="Sin órdenes completadas"
                                 />
+                                {data.preventivo.completadas.length < data.preventivo.completadas_total && (
+                                    <Button
+                                        variant="outline"
+                                        className="w-full mt-4"
+                                        onClick={() => loadMoreCompleted('preventivo')}
+                                        data-testid="load-more-completed-preventivo"
+                                    >
+                                        Ver más completadas
+                                    </Button>
+                                )}
                             </CardContent>
                         </Card>
                     </div>
@@ -325,6 +352,16 @@ export default function MyOrders() {
                                     icon={CheckCircle2}
                                     emptyMessage="Sin órdenes completadas"
                                 />
+                                {data.correctivo.completadas.length < data.correctivo.completadas_total && (
+                                    <Button
+                                        variant="outline"
+                                        className="w-full mt-4"
+                                        onClick={() => loadMoreCompleted('correctivo')}
+                                        data-testid="load-more-completed-correctivo"
+                                    >
+                                        Ver más completadas
+                                    </Button>
+                                )}
                             </CardContent>
                         </Card>
                     </div>
@@ -76,6 +76,9 @@ export default function WorkOrderDetail() {
     const [spareParts, setSpareParts] = useState([]);
     const [selectedSparePartId, setSelectedSparePartId] = useState('');
     const [sparePartQuantity, setSparePartQuantity] = useState(1);
+    const [history, setHistory] = useState(null);
+    const [historyCursor, setHistoryCursor] = useState(null);
+    const [historyLoading, setHistoryLoading] = useState(false);
 
     const fetchOrder = useCallback(async () => {
         try {
@@ -85,6 +88,8 @@ export default function WorkOrderDetail() {
                 axios.get(`${API}/spare-parts`).catch(() => ({ data: [] }))
             ]);
             setOrder(orderRes.data);
+            setHistory(null);
+            setHistoryCursor(null);
             setChecklistData(orderRes.data.checklist || []);
             setEditData({
                 status: orderRes.data.status,
@@ -120,6 +125,22 @@ export default function WorkOrderDetail() {
         fetchOrder();
     }, [fetchOrder]);
 
+    const fetchHistory = async (cursor = null) => {
+        setHistoryLoading(true);
+        try {
+            const response = await axios.get(`${API}/work-orders/${id}/history`, {
+                params: cursor ? { cursor } : {}
+            });
+            setHistory(prev => (cursor && prev ? [...prev, ...response.data.items] : response.data.items));
+            setHistoryCursor(response.data.next_cursor);
+        } catch (error) {
+            console.error('Error fetching history:', error);
+            toast.error('Error al cargar el historial');
+        } finally {
+            setHistoryLoading(false);
+        }
+    };
+
     const handleUpdate = async () => {
         try {
             await axios.put(`${API}/work-orders/${id}`, editData);
@@ -943,13 +964,24 @@ export default function WorkOrderDetail() {
                             </CardTitle>
                         </CardHeader>
                         <CardContent>
-                            {!order.history?.length ? (
+                            {history === null ? (
+                                <Button
+                                    variant="outline"
+                                    className="w-full"
+                                    onClick={() => fetchHistory()}
+                                    disabled={historyLoading}
+                                    data-testid="show-history-btn"
+                                >
+                                    {historyLoading && <Loader2 className="w-4 h-4 mr-2 animate-spin" />}
+                                    Ver historial
+                                </Button>
+                            ) : !history.length ? (
                                 <p className="text-sm text-muted-foreground text-center py-4">
                                     Sin cambios registrados
                                 </p>
                             ) : (
                                 <div className="history-timeline">
-                                    {order.history.map((entry) => (
+                                    {history.map((entry) => (
                                         <div key={entry.id} className="history-item">
                                             <p className="text-sm font-medium">
                                                 {entry.action === 'creada' && 'Orden creada'}
@@ -967,6 +999,18 @@ export default function WorkOrderDetail() {
                                             </p>
                                         </div>
                                     ))}
+                                    {historyCursor && (
+                                        <Button
+                                            variant="ghost"
+                                            size="sm"
+                                            className="w-full mt-2"
+                                            onClick={() => fetchHistory(historyCursor)}
+                                            disabled={historyLoading}
+                                            data-testid="load-more-history-btn"
+                                        >
+                                            Cargar más
+                                        </Button>
+                                    )}
                                 </div>
                             )}
                         </CardContent>